@@ -1,19 +1,56 @@
 #!/usr/bin/env python3
-import os, time, asyncio
-from typing import List
-from dataclasses import dataclass
-import temperature_image, config
+import os, time, asyncio, logging, argparse, functools, shutil
+_IMPORT_START = time.perf_counter()
+from typing import List, Optional, Tuple
+from datetime import timedelta
+import config
+from renderer import RendererSession, Gif2UnicornHatBackend
+from display_coalescer import DisplayCoalescer
+from frame_scheduler import FrameScheduler, GifFrame
+from startup_profiler import StartupProfiler
 from WeatherCollectors.WeatherCollector import WeatherStatus
-from WeatherCollectors.OpenWeatherMapCollector import OpenWeatherMapCollector
-from WeatherCollectors.TempestUdpCollector import TempestUdpCollector
-from WeatherCollectors.AggregateCollector import AggregateCollector
-from WeatherCollectors.TempestCloudCollector import TempestCloudCollector
+import metrics, log
 
-@dataclass
-class GifFrame:
-    """Represents Gif, shown for a period of time."""
-    filename: str
-    show_time: float
+# Collectors, aiohttp and Pillow take seconds to import on a Pi Zero, so they're imported when they're first needed.
+# Only the collectors enabled in config.py are ever imported.
+
+logger = logging.getLogger(__name__)
+
+LOADING_FRAME = './icons/error.gif' # Shown until there's weather to display.
+PRIMARY_LOCATION = 'local' # The owm_locations name given to owm_config, the location shown on this display.
+
+_temperature_caches = {} # Created on first use, from the settings in config.py. Keyed by whether display settings are baked in.
+_asset_pack = None # Created on first use, if display settings are to be baked into the images.
+_render_worker = None # Created on first use, from the settings in config.py.
+
+def get_render_worker():
+    """Returns the pool that images are drawn and encoded on, so the event loop never waits on Pillow."""
+    global _render_worker
+    if _render_worker is None:
+        from render_worker import create_render_worker
+        _render_worker = create_render_worker(config)
+    return _render_worker
+
+def get_asset_pack():
+    """Returns the pack of images pre-rendered for the display, or None if the renderer applies the display settings itself."""
+    global _asset_pack
+    if _asset_pack is None and getattr(config, 'bake_display_settings', False):
+        from asset_pack import create_asset_pack
+        _asset_pack = create_asset_pack(config)
+    return _asset_pack
+
+def is_prebaked(filename : str) -> bool:
+    """Returns True if the gif already has the display's brightness and orientation baked in."""
+    return _asset_pack is not None and _asset_pack.contains(filename)
+
+def get_temperature_cache(baked : bool = True):
+    """Returns the cache that temperature images are rendered into. Unbaked images suit any display, like those at other locations."""
+    pack = get_asset_pack() if baked else None
+    cache = _temperature_caches.get(pack is not None)
+    if cache is None:
+        from render_cache import create_temperature_image_cache
+        cache = _temperature_caches[pack is not None] = create_temperature_image_cache(config, pack, get_render_worker())
+    return cache
 
 def convert_c_to_unit(temp_c: float, unit: str) -> float:
     """Converts a temperature in Celsius to the given unit ('C' or 'F')."""
@@ -24,11 +61,29 @@ def convert_c_to_unit(temp_c: float, unit: str) -> float:
     else:
         raise ValueError(f'Unknown temperature unit: {unit}')
 
-def get_weather_images(collector : WeatherStatus) -> List[GifFrame]:
-    """Returns a list of images filenames that fit the current weather conditions."""
+def is_lightning_nearby(status : WeatherStatus) -> bool:
+    """Returns True if there's been lightning close enough that it should interrupt the display."""
+    return (hasattr(config, 'lightning_alert_distance')
+        and status.lightning_count is not None and status.lightning_count.value > 0
+        and status.lightning_distance is not None and status.lightning_distance.value < config.lightning_alert_distance)
+
+def get_display_key(status : WeatherStatus) -> Tuple[Optional[str], Optional[int], str, bool]:
+    """Returns everything about a status that affects what's drawn. Frames only need rebuilding when this changes."""
+    icon = status.openweathermap_icon.value if status.openweathermap_icon is not None else None
+    temp = round(convert_c_to_unit(status.temp_c.value, config.tempurature_unit)) if status.temp_c is not None else None
+    return (icon, temp, config.tempurature_unit, is_lightning_nearby(status))
+
+async def get_weather_images(collector : WeatherStatus, baked : bool = True) -> List[GifFrame]:
+    """Returns a list of images filenames that fit the current weather conditions. baked=False skips baking in this display's settings."""
     
     # Condition icon.
-    if collector.openweathermap_icon is not None:
+    conditions_priority = 0
+    if is_lightning_nearby(collector):
+        # Nearby lightning trumps whatever the condition is, and is shown ahead of everything else.
+        daynight = collector.openweathermap_icon.value[-1:] if collector.openweathermap_icon is not None else 'd'
+        conditions_icon_path = os.path.join('./icons/', '11' + (daynight if daynight in ('d', 'n') else 'd') + '.gif')
+        conditions_priority = 1
+    elif collector.openweathermap_icon is not None:
         conditions_icon_path = os.path.join('./icons/', collector.openweathermap_icon.value + '.gif')
     else:
         conditions_icon_path = './icons/error.gif' 
@@ -38,111 +93,246 @@ def get_weather_images(collector : WeatherStatus) -> List[GifFrame]:
     if collector.temp_c is not None:
         cur_temp = round(convert_c_to_unit(collector.temp_c.value, config.tempurature_unit))
 
-        # Create cache file if it doesn't already exist.
-        temperature_image_path = os.path.join(config.cache_dir, str(cur_temp) + '.gif')
-        if not os.path.exists(temperature_image_path):
-            if not os.path.exists(config.cache_dir):
-                os.mkdir(config.cache_dir)
-                
-            # Put the image in the cache.
-            print('Creating new image. image=', temperature_image_path)
-            img = temperature_image.create_temperature_image(cur_temp)
-            img.save(temperature_image_path)
+        # Rendered the first time it's needed, then served from the cache.
+        temperature_image_path = await get_temperature_cache(baked).get(cur_temp)
+
+    # Swap the icon for one that's already scaled, rotated and dimmed for the display.
+    pack = get_asset_pack() if baked else None
+    if pack is not None:
+        try:
+            conditions_icon_path = await get_render_worker().run(pack.icon, conditions_icon_path) # Baking a new icon blocks on Pillow and the disk.
+        except Exception as ex:
+            logger.error('Error baking icon. Letting the renderer scale it: %s', ex)
     
     # Build the list of icons to show.
     icons = []
     if conditions_icon_path is not None:
-        icons.append(GifFrame(conditions_icon_path, config.condition_show_time))
+        icons.append(GifFrame(conditions_icon_path, config.condition_show_time, conditions_priority))
     
     if temperature_image_path is not None:
         icons.append(GifFrame(temperature_image_path, config.temperature_show_time))
 
     return icons
 
-async def terminate_proc(proc, graceful_timeout=5):
-    if proc is None:
-        return
-    
-    proc.terminate()
-    try:
-        await asyncio.wait_for(proc.communicate(), timeout=graceful_timeout)
-    except asyncio.TimeoutError:
-        print('Process took too long to exit. Killing process.')
-        proc.kill()
-    proc = None
-
-async def show_frames(frames: List[GifFrame]):
-    """Loops over the frames and shows each for the given show time."""
-    global proc
-    try:
-        for frame in frames:
-            print('Displaying:', frame.filename, 'Time:', frame.show_time)
-            await terminate_proc(proc)
-            proc = await asyncio.create_subprocess_exec(
-                './Gif2UnicornHat/Gif2UnicornHat',
-                '-d', config.hat_device,
-                frame.filename,
-                str(config.image_brightness),
-                str(config.image_orientation))
-            await asyncio.sleep(frame.show_time)
-    except Exception as ex:
-        print('Error updating display:', ex)
-        await asyncio.sleep(config.retry_time)
-
-
-async def main():
+async def publish_location_frames(name : str, status : WeatherStatus):
+    """Compiles a location's frames into one gif at location_frames_dir/{name}.gif, for a display at that location to show."""
+    import playlist # Pulls in Pillow.
+    frames = await get_weather_images(status, baked=False) # The display there has its own size and settings.
+    compiled = await get_render_worker().run(playlist.compile_playlist, frames, os.path.join(config.cache_dir, 'playlists'))
+    frames_dir = getattr(config, 'location_frames_dir', os.path.join(config.cache_dir, 'locations'))
+    await asyncio.to_thread(_publish_file, compiled.filename, os.path.join(frames_dir, name + '.gif'))
+    logger.info('Published frames for %s: %s', name, status)
+
+def _publish_file(source : str, destination : str):
+    # Copy to a temporary file first, so whatever serves the file never sees half of one.
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    shutil.copyfile(source, destination + '.tmp')
+    os.replace(destination + '.tmp', destination)
+
+async def _listen_all(collectors):
+    await asyncio.gather(*(collector.listen() for collector in collectors))
+
+async def main(profiler : Optional[StartupProfiler] = None, profile_startup : bool = False):
     """Entrypoint for the program."""
-    global proc
-    proc = None
-    frames = []
+    profiler = profiler or StartupProfiler()
+
+    # Start the renderer once. Frame switches are sent to it for the lifetime of the program.
+    # Put something on the display straight away, so it's obvious the device is alive while everything else loads.
+    with profiler.step('first pixel'):
+        session = RendererSession(Gif2UnicornHatBackend(config.hat_device, config.image_brightness, config.image_orientation, is_prebaked=is_prebaked))
+        await session.start()
+        try:
+            await session.show(LOADING_FRAME)
+        except Exception as ex:
+            logger.error('Error updating display: %s', ex)
+
+    # Expose metrics for the fleet dashboard.
+    metrics_server = None
+    lag_task = asyncio.create_task(metrics.monitor_event_loop_lag())
+    if hasattr(config, 'metrics_port'):
+        with profiler.step('metrics endpoint'):
+            try:
+                metrics_server = await metrics.serve_metrics(getattr(config, 'metrics_host', '127.0.0.1'), config.metrics_port)
+            except OSError as ex:
+                logger.error('Error starting metrics endpoint: %s', ex)
 
-    def update_frames(status : WeatherStatus):
-        print(status)
-        frames.clear()
-        frames.extend(get_weather_images(status))
+    # Bake every icon for the display in the background, so they're ready before the weather is.
+    # This gets its own thread rather than the render worker, so it doesn't hold up drawing the first frames.
+    pack = get_asset_pack()
+    bake_task = asyncio.create_task(asyncio.to_thread(pack.build_icons)) if pack is not None else None
+
+    # Cycles through the latest frames. New frames are picked up as soon as they're ready.
+    scheduler = FrameScheduler(session, GifFrame('./icons/error.gif', config.retry_time))
+
+    async def update_frames(status : WeatherStatus):
+        logger.info('Updating frames: %s', status)
+        try:
+            frames = await get_weather_images(status)
+        except Exception:
+            scheduler.set_frames([]) # Let the user know something went wrong by displaying the error icon.
+            raise
+        if getattr(config, 'compile_playlist', False) and len(frames) > 1:
+            # Play the whole cycle as one gif, so the renderer is only restarted when the weather changes.
+            try:
+                import playlist # Pulls in Pillow.
+                if pack is not None and all(pack.contains(frame.filename) for frame in frames):
+                    playlist_dir = os.path.join(pack.pack_dir, 'playlists') # Already baked, so it's shown as is.
+                else:
+                    # Something couldn't be baked. Baked and unbaked frames can't share a gif, so compile the unbaked
+                    # ones outside the pack, where the renderer applies the brightness and orientation itself.
+                    if pack is not None:
+                        frames = await get_weather_images(status, baked=False)
+                    playlist_dir = os.path.join(config.cache_dir, 'playlists')
+                frames = [await get_render_worker().run(playlist.compile_playlist, frames, playlist_dir)]
+            except Exception as ex:
+                logger.error('Error compiling playlist. Showing frames separately: %s', ex)
+        scheduler.set_frames(frames)
 
     # Set up all the weather collectors that are configured.
+    with profiler.step('history store'):
+        from WeatherCollectors.HistoryStore import HistoryStore
+        history = HistoryStore(config.history_length) if hasattr(config, 'history_length') else HistoryStore() # Shared by every collector.
+    replay_max_age = timedelta(seconds=config.datapoint_max_age)
     subCollectors = []
 
     if hasattr(config, 'tempest_udp_config'):
-        subCollectors.append(TempestUdpCollector(config.tempest_udp_config))
+        with profiler.step('TempestUdpCollector'):
+            from WeatherCollectors.TempestUdpCollector import TempestUdpCollector
+            subCollectors.append(TempestUdpCollector(config.tempest_udp_config, history=history))
+
+    owm_enabled = hasattr(config, 'owm_config') and hasattr(config, 'owm_poll_interval')
+    tempest_cloud_enabled = hasattr(config, 'tempest_cloud_station_name') and hasattr(config, 'tempest_cloud_token') and hasattr(config, 'tempest_cloud_poll_interval')
+
+    # HTTP collectors share one pooled session so connections and DNS lookups are reused between polls.
+    http_session = None
+    if owm_enabled or tempest_cloud_enabled:
+        with profiler.step('HTTP client'):
+            import http_client
+            from WeatherCollectors.ResponseCache import ResponseCache
+            from WeatherCollectors.PollScheduler import PollScheduler, get_budget
+            http_session = http_client.create_session()
+            response_cache = ResponseCache(os.path.join(config.cache_dir, 'responses'))
+
+    owm_locations = {}
+    if owm_enabled:
+        with profiler.step('OpenWeatherMapCollector'):
+            # Every collector polling with the same API key shares its daily request budget.
+            budget = get_budget(config.owm_config['appid'], config.owm_request_budget) if hasattr(config, 'owm_request_budget') else None
+            if getattr(config, 'owm_locations', None):
+                # Poll every location together, and feed this display from the local one.
+                from WeatherCollectors.OpenWeatherMapMultiCollector import OpenWeatherMapMultiCollector
+                owm_locations = {PRIMARY_LOCATION: config.owm_config}
+                for name, query in config.owm_locations.items():
+                    if name == PRIMARY_LOCATION:
+                        logger.error('%r is the name of the owm_config location. Rename it in owm_locations.', name)
+                    else:
+                        owm_locations[name] = query
+                owm_multi = OpenWeatherMapMultiCollector(config.owm_config['appid'], owm_locations, config.owm_poll_interval,
+                    session=http_session, cache=response_cache, replay_max_age=replay_max_age, history=history, budget=budget)
+                subCollectors.append(owm_multi.location(PRIMARY_LOCATION))
+            else:
+                from WeatherCollectors.OpenWeatherMapCollector import OpenWeatherMapCollector
+                owm_scheduler = PollScheduler('openweathermap', config.owm_poll_interval, budget=budget)
+                subCollectors.append(OpenWeatherMapCollector(config.owm_config, config.owm_poll_interval, session=http_session,
+                    cache=response_cache, replay_max_age=replay_max_age, history=history, scheduler=owm_scheduler))
 
-    if hasattr(config, 'owm_config') and hasattr(config, 'owm_poll_interval'):
-        subCollectors.append(OpenWeatherMapCollector(config.owm_config, config.owm_poll_interval))
+    if tempest_cloud_enabled:
+        with profiler.step('TempestCloudCollector'):
+            from WeatherCollectors.TempestCloudCollector import TempestCloudCollector
+            budget = get_budget(config.tempest_cloud_token, config.tempest_cloud_request_budget) if hasattr(config, 'tempest_cloud_request_budget') else None
+            tempest_cloud_scheduler = PollScheduler('tempest_cloud', config.tempest_cloud_poll_interval, budget=budget, cost=2) # Observations and forecast.
+            subCollectors.append(TempestCloudCollector(config.tempest_cloud_station_name, config.tempest_cloud_token, config.tempest_cloud_poll_interval, session=http_session,
+                cache=response_cache, replay_max_age=replay_max_age, history=history, scheduler=tempest_cloud_scheduler))
 
-    if  hasattr(config, 'tempest_cloud_station_name') and hasattr(config, 'tempest_cloud_token') and hasattr(config, 'tempest_cloud_poll_interval'):
-        subCollectors.append(TempestCloudCollector(config.tempest_cloud_station_name, config.tempest_cloud_token, config.tempest_cloud_poll_interval))
+    with profiler.step('AggregateCollector'):
+        from WeatherCollectors.AggregateCollector import AggregateCollector
+        aggregateCollector = AggregateCollector(subCollectors)
 
-    aggregateCollector = AggregateCollector(subCollectors)
+    # Every other location gets a pipeline of its own, ending in a gif for the display there.
+    debounce_time = getattr(config, 'update_debounce_time', 1.0)
+    location_coalescers, location_collectors = [], []
+    for name in owm_locations:
+        if name != PRIMARY_LOCATION:
+            location_collector = AggregateCollector([owm_multi.location(name)])
+            location_coalescer = DisplayCoalescer(get_display_key, functools.partial(publish_location_frames, name), debounce_time)
+            location_collector.register_callback(location_coalescer.submit)
+            location_collectors.append(location_collector)
+            location_coalescers.append(location_coalescer)
+
+    # Log everything the collectors deliver, and pick up where the last run left off.
+    with profiler.step('observation log'):
+        from WeatherCollectors.ObservationLog import ObservationLog
+        observation_log = ObservationLog(os.path.join(config.cache_dir, 'observations'), getattr(config, 'observation_log_flush_interval', 60.0),
+            retention=getattr(config, 'observation_log_retention', 30 * 24 * 3600.0))
+        for collector in subCollectors:
+            observation_log.attach(collector, type(collector).__name__)
 
     # Register a callback to update the images when new weather data is received.
-    aggregateCollector.register_callback(lambda status: update_frames(status))
-    listenTask = asyncio.create_task(aggregateCollector.listen()) # Run the collector as a background task.
+    # Updates are debounced, and the images are only rebuilt when what's drawn would change.
+    coalescer = DisplayCoalescer(get_display_key, update_frames, debounce_time)
+    aggregateCollector.register_callback(coalescer.submit)
+    with profiler.step('restore observations'):
+        observation_log.restore(replay_max_age)
+    log_task = asyncio.create_task(observation_log.run())
+    listenTask = asyncio.create_task(_listen_all([aggregateCollector] + location_collectors)) # Run the collectors as a background task.
 
-    while True:
-        try:
-            # Loop over and display the latest images.
-            latest_frames = frames if len(frames) > 0 else [GifFrame('./icons/error.gif', config.retry_time)]
-            await show_frames(latest_frames)
-        except KeyboardInterrupt:
-            print('Exiting...')
-            break
-        except Exception as ex:
-            print('Error updating weather:', ex)
-            frames.clear() # Let the user know something went wrong by displaying the error icon on the next loop.
+    if profile_startup:
+        profiler.uninstall_import_hook()
+        profiler.log_report()
+    else:
+        logger.info('Started in %.1f ms', profiler.elapsed() * 1000)
+
+    try:
+        await scheduler.run() # Runs until the program is stopped.
+    except KeyboardInterrupt:
+        logger.info('Exiting...')
 
     # Cancel the listener and wait for it to clean up.    
+    coalescer.cancel()
+    for location_coalescer in location_coalescers:
+        location_coalescer.cancel()
     listenTask.cancel()
     try:
         await listenTask
     except asyncio.CancelledError:
         pass
 
+    if http_session is not None:
+        await http_session.close()
+
+    log_task.cancel() # Writes out anything still pending.
+    try:
+        await log_task
+    except asyncio.CancelledError:
+        pass
+
+    lag_task.cancel()
+    if bake_task is not None:
+        bake_task.cancel() # The thread finishes in the background. Icons are written atomically, so it's safe to stop at any point.
+    if metrics_server is not None:
+        metrics_server.close()
+
+    if _render_worker is not None:
+        _render_worker.close()
+
     # Stop the image diplay.
-    await terminate_proc(proc)
+    await session.close()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description='Displays the current weather conditions on a Unicorn HAT.')
+    parser.add_argument('--profile-startup', action='store_true', help='Report how long each module took to import and initialise.')
+    args = parser.parse_args()
+
+    profiler = StartupProfiler(_IMPORT_START)
+    profiler.record('UnicornHatWeather imports', time.perf_counter() - _IMPORT_START)
+    if args.profile_startup:
+        profiler.install_import_hook()
+
+    log_listener = log.configure_logging(getattr(config, 'log_level', 'INFO'))
+    try:
+        asyncio.run(main(profiler, args.profile_startup))
+    finally:
+        log_listener.stop()
 
 #from PIL import Image
 #if __name__ == "__main__":
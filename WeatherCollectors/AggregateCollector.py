@@ -1,10 +1,15 @@
-import asyncio
-from dataclasses import dataclass, fields
+import asyncio, logging, math, time
+from dataclasses import dataclass, field, fields
 from datetime import datetime, timedelta, timezone
 import typing
-from typing import Optional, List, Tuple
+from typing import Optional, List, Dict, Tuple, Hashable
+import metrics
 from .WeatherCollector import WeatherCollector, WeatherStatus, Datapoint
 
+logger = logging.getLogger(__name__)
+
+_AGGREGATION_TIME = metrics.histogram('aggregation_seconds', 'Time spent folding a collector update into the aggregate status.')
+
 def is_datapoint(field) -> bool:
     # First, see if it's directly a Datapoint.
     if typing.get_origin(field.type) is Datapoint:
@@ -16,6 +21,17 @@ def is_datapoint(field) -> bool:
             return True
     return False
 
+# The names of every Datapoint field in WeatherStatus. Only needs to be worked out once.
+DATAPOINT_FIELDS : Tuple[str, ...] = tuple(f.name for f in fields(WeatherStatus) if is_datapoint(f))
+
+@dataclass(slots=True)
+class _Candidate:
+    """A single source's offer for one field of the aggregate."""
+    datapoint : Datapoint # Shared with the source's status. Never modified.
+    host_timestamp : float # Seconds since the epoch.
+    score : float # Quality with the age decay folded in. See AggregateCollector._score.
+    expires : float # Seconds since the epoch when this candidate becomes too old to use.
+
 class AggregateCollector(WeatherCollector):
     """Collects weather data from multiple sources and aggregates it based on age and quality."""
 
@@ -24,16 +40,34 @@ class AggregateCollector(WeatherCollector):
         """Represents the data from a single collector."""
         status : Optional[WeatherStatus]
         callback : typing.Callable[[WeatherStatus], None] # Need to hold onto the callback so we can unregister it later.
+        forget_callback : typing.Callable[[Optional[str]], None]
+
+    @dataclass
+    class SourceData:
+        """Represents the data from a single station of a collector. Most collectors only have one."""
+        status : Optional[WeatherStatus]
+        candidates : Dict[str, _Candidate] = field(default_factory=dict) # What this source offers for each field.
 
     def __init__(self, collectors : Optional[List[WeatherCollector]] = None, datapoint_max_age : Optional[timedelta] = None, quality_decay : float = .001):
         super().__init__()
         self._collectors  = {}
         self._datapoint_max_age = datapoint_max_age
         for c in collectors or []:
-            self._collectors[c] = self.CollectorData(None, lambda status, c=c: self._update_collector_status(c, status)) # No data yet.
+            self._collectors[c] = self.CollectorData(None, lambda status, c=c: self._update_collector_status(c, status), # No data yet.
+                lambda station_id, c=c: self._forget_source(c, station_id))
             c.register_callback(self._collectors[c].callback)
+            c.register_forget_callback(self._collectors[c].forget_callback)
         self._quality_decay = quality_decay # Every second, reduce the quality of each datapoint by this amount.
 
+        # Every (collector, station_id) pair is weighed independently.
+        self._sources : Dict[Tuple[WeatherCollector, Optional[str]], AggregateCollector.SourceData] = {}
+
+        # The aggregate is kept up to date in place, along with which source won each field.
+        self._aggregate = WeatherStatus(source='aggregate')
+        self._winners : Dict[str, Tuple[Hashable, _Candidate]] = {}
+        self._next_expiry = math.inf # Earliest time one of the winners gets too old.
+        self._next_prune = 0.0 # When to next look for sources that haven't been heard from in datapoint_max_age.
+
     async def listen(self):
         """Starts all registered collectors and begins delivering aggregate updates."""
         await asyncio.gather(*(collector.listen() for collector in self._collectors.keys()))
@@ -42,51 +76,142 @@ class AggregateCollector(WeatherCollector):
         """Updates the status for a given collector and recomputes the aggregate status."""
         if collector not in self._collectors.keys():
             return # Not registered. Collector might be mid-register/unregister.
-        
-        print(f'{type(collector).__name__} received new status: {status}')
 
+        logger.debug('%s received new status: %s', type(collector).__name__, status)
+
+        start = time.perf_counter()
+        now = time.time()
         self._collectors[collector].status = status
-        aggregate_status = self._generate_aggregate_status()
-        self._deliver_update(aggregate_status)
+        source_key = (collector, status.station_id)
+        source = self._sources.get(source_key)
+        if source is None:
+            source = self._sources[source_key] = self.SourceData(None)
+        source.status = status
+        for name in self._update_candidates(source, status):
+            self._rescore_field(name, source_key, now)
+        self._expire_winners(now)
+        self._prune_sources(now)
+        _AGGREGATION_TIME.observe(time.perf_counter() - start)
+
+        self._aggregate.host_timestamp = datetime.fromtimestamp(now, timezone.utc)
+        self._deliver_update(self._aggregate)
+
+    def _forget_source(self, collector : WeatherCollector, station_id : Optional[str]):
+        """Drops a station the collector no longer tracks, and replaces any fields it was winning."""
+        source_key = (collector, station_id)
+        if self._sources.pop(source_key, None) is None:
+            return
+        now = time.time()
+        for name, (winner_key, _) in list(self._winners.items()):
+            if winner_key == source_key:
+                self._select_winner(name, now)
+
+    def _prune_sources(self, now : float):
+        """
+        Forgets sources that haven't been heard from in datapoint_max_age. None of their data can win any more, and keeping
+        them would make every winner search slower as stations come and go.
+        """
+        if now < self._next_prune or self._datapoint_max_age is None:
+            return
+        max_age = self._datapoint_max_age.total_seconds()
+        self._next_prune = now + max_age
+        for (collector, station_id), source in list(self._sources.items()):
+            status = source.status
+            if status is None or status.host_timestamp is None or status.host_timestamp.timestamp() + max_age <= now:
+                self._forget_source(collector, station_id)
 
     def _generate_aggregate_status(self) -> WeatherStatus:
-        """Generates an aggregate WeatherStatus based on the current data from all collectors."""
-        aggregate = WeatherStatus()
-        aggregate.source = 'aggregate'
-        aggregate.host_timestamp = datetime.now(timezone.utc)
-
-        # For each Datapoint field in WeatherStatus, find the highest-quality datapoint from all collectors.
-        for f in fields(WeatherStatus):
-            if not is_datapoint(f):
-                continue # Skip non-datapoint fields.
-
-            candidates : List[Tuple[Datapoint, float]] = []
-            for collector_data in self._collectors.values():
-                status = collector_data.status
-                if status is None:
-                    continue
-                
-                datapoint = getattr(status, f.name)
-                if not isinstance(datapoint, Datapoint) or datapoint.value is None:
-                    continue # No data for this field. Skip it.
-                
-                # Decay the datapoint quality based on how old it is. This will make a good, but old datapoint eventually
-                # fall out of favour compared to a newer but lower-quality datapoint.
-                age_seconds = (datetime.now(tz=status.host_timestamp.tzinfo) - status.host_timestamp).total_seconds()
-                if self._datapoint_max_age is None or timedelta(seconds=age_seconds) < self._datapoint_max_age:
-                    aged_quality = datapoint.quality - age_seconds * self._quality_decay
-                    candidates.append((datapoint, aged_quality))
-            
-            # Combine the field values into a single datapoint for the aggregate status.
-            if len(candidates) == 0:
-                setattr(aggregate, f.name, None) # No data for this field from any collector.
+        """Rebuilds the whole aggregate WeatherStatus from the current data of every source."""
+        now = time.time()
+        for source in self._sources.values():
+            self._update_candidates(source, source.status)
+        self._winners.clear()
+        self._next_expiry = math.inf
+        for name in DATAPOINT_FIELDS:
+            self._select_winner(name, now)
+
+        self._aggregate.host_timestamp = datetime.fromtimestamp(now, timezone.utc)
+        return self._aggregate
+
+    def _score(self, quality : float, host_timestamp : float) -> float:
+        """
+        Decay the datapoint quality based on how old it is. This will make a good, but old datapoint eventually
+        fall out of favour compared to a newer but lower-quality datapoint.
+        The aged quality is quality - (now - host_timestamp) * decay. Every candidate shares the same now, so the
+        ordering of candidates never changes as time passes, and the time-independent part is all that needs comparing.
+        """
+        return quality + host_timestamp * self._quality_decay
+
+    def _update_candidates(self, source : SourceData, status : Optional[WeatherStatus]) -> List[str]:
+        """Refreshes a source's candidates from its latest status. Returns the names of the fields that changed."""
+        candidates = source.candidates
+        if status is None or status.host_timestamp is None:
+            changed = list(candidates.keys())
+            candidates.clear()
+            return changed
+
+        host_timestamp = status.host_timestamp.timestamp()
+        max_age = self._datapoint_max_age.total_seconds() if self._datapoint_max_age is not None else math.inf
+        changed = []
+        for name in DATAPOINT_FIELDS:
+            datapoint = getattr(status, name)
+            previous = candidates.get(name)
+            if not isinstance(datapoint, Datapoint) or datapoint.value is None:
+                if previous is not None:
+                    del candidates[name] # No data for this field anymore.
+                    changed.append(name)
                 continue
 
-            # Sort by aged quality, highest first.
-            candidates.sort(key=lambda c: c[1], reverse=True)
-            # Find the max quality element in linear time
-            best_datapoint = max(candidates, key=lambda c: c[1])[0]
-            best_datapoint = candidates[0][0] # Take the highest-quality datapoint.
-            setattr(aggregate, f.name, Datapoint(best_datapoint.value, best_datapoint.quality))
+            if (previous is not None and previous.host_timestamp == host_timestamp
+              and (previous.datapoint is datapoint or previous.datapoint == datapoint)):
+                continue # Nothing new for this field.
+
+            candidates[name] = _Candidate(datapoint, host_timestamp,
+                self._score(datapoint.quality, host_timestamp), host_timestamp + max_age)
+            changed.append(name)
+        return changed
+
+    def _rescore_field(self, name : str, source_key : Hashable, now : float):
+        """Updates the winner of a field after one source's candidate for it changed."""
+        winner = self._winners.get(name)
+        candidate = self._sources[source_key].candidates.get(name)
+        if winner is not None and winner[0] == source_key:
+            if candidate is not None and candidate.expires > now and candidate.score >= winner[1].score:
+                self._set_winner(name, source_key, candidate) # Still the best. Only the value changed.
+            else:
+                self._select_winner(name, now) # The old winner got worse. It may no longer be the best.
+        elif candidate is not None and candidate.expires > now and (winner is None or candidate.score > winner[1].score):
+            self._set_winner(name, source_key, candidate)
+
+    def _select_winner(self, name : str, now : float):
+        """Picks the best candidate for a field from every source."""
+        best = None
+        for source_key, source in self._sources.items():
+            candidate = source.candidates.get(name)
+            if candidate is None or candidate.expires <= now:
+                continue
+            if best is None or candidate.score > best[1].score:
+                best = (source_key, candidate)
+
+        if best is None:
+            self._winners.pop(name, None)
+            setattr(self._aggregate, name, None) # No data for this field from any collector.
+        else:
+            self._set_winner(name, *best)
+
+    def _set_winner(self, name : str, source_key : Hashable, candidate : _Candidate):
+        self._winners[name] = (source_key, candidate)
+        self._next_expiry = min(self._next_expiry, candidate.expires)
+        if getattr(self._aggregate, name) != candidate.datapoint:
+            setattr(self._aggregate, name, candidate.datapoint) # Datapoints are never modified, so the source's can be shared.
 
-        return aggregate
\ No newline at end of file
+    def _expire_winners(self, now : float):
+        """Replaces any winners that have become too old to use."""
+        if now < self._next_expiry:
+            return
+        self._next_expiry = math.inf
+        for name, (_, candidate) in list(self._winners.items()):
+            if candidate.expires <= now:
+                self._select_winner(name, now)
+            else:
+                self._next_expiry = min(self._next_expiry, candidate.expires)
@@ -0,0 +1,171 @@
+import math, operator, time
+from array import array
+from bisect import bisect_left
+from datetime import timedelta
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+import metrics
+from .WeatherCollector import WeatherStatus, Datapoint
+
+_SERIES = metrics.gauge('history_series', 'Number of time series held in the history store.')
+
+class Series:
+    """
+    A fixed-size ring buffer of (timestamp, value) samples for a single field from a single source.
+    Samples are kept in two array('d')s, so each one costs 16 bytes no matter how long the program runs.
+    """
+    __slots__ = ('_times', '_values', '_capacity', '_start', '_count')
+
+    def __init__(self, capacity : int):
+        self._times = array('d', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        self._capacity = capacity
+        self._start = 0 # Physical index of the oldest sample.
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def last_time(self) -> Optional[float]:
+        return self._times[(self._start + self._count - 1) % self._capacity] if self._count else None
+
+    @property
+    def last_value(self) -> Optional[float]:
+        return self._values[(self._start + self._count - 1) % self._capacity] if self._count else None
+
+    def append(self, timestamp : float, value : float) -> bool:
+        """Adds a sample, overwriting the oldest one if the buffer is full. Returns False if the sample isn't newer than the last one."""
+        if self._count and timestamp <= self.last_time:
+            return False # Repeated or out of order. Keeping timestamps sorted is what makes window lookups a bisect.
+        if self._count < self._capacity:
+            i = (self._start + self._count) % self._capacity
+            self._count += 1
+        else:
+            i = self._start
+            self._start = (self._start + 1) % self._capacity
+        self._times[i] = timestamp
+        self._values[i] = value
+        return True
+
+    def window(self, since : float) -> Tuple[array, array]:
+        """Returns the timestamps and values of every sample at or after since, oldest first."""
+        capacity, start = self._capacity, self._start
+        first = bisect_left(range(self._count), since, key=lambda i: self._times[(start + i) % capacity])
+        lo, hi = start + first, start + self._count
+        if hi <= capacity:
+            return self._times[lo:hi], self._values[lo:hi]
+        if lo >= capacity:
+            return self._times[lo - capacity:hi - capacity], self._values[lo - capacity:hi - capacity]
+        # The window wraps around the end of the buffer.
+        return (self._times[lo:] + self._times[:hi - capacity],
+                self._values[lo:] + self._values[:hi - capacity])
+
+    def min(self, since : float) -> Optional[float]:
+        _, values = self.window(since)
+        return min(values) if values else None
+
+    def max(self, since : float) -> Optional[float]:
+        _, values = self.window(since)
+        return max(values) if values else None
+
+    def mean(self, since : float) -> Optional[float]:
+        _, values = self.window(since)
+        return math.fsum(values) / len(values) if values else None
+
+    def sum(self, since : float) -> Optional[float]:
+        _, values = self.window(since)
+        return math.fsum(values) if values else None
+
+    def slope(self, since : float) -> Optional[float]:
+        """Returns the least-squares rate of change per second, or None if there aren't enough samples to tell."""
+        times, values = self.window(since)
+        n = len(times)
+        if n < 2:
+            return None
+        # Shift the timestamps so the products stay small enough to keep their precision.
+        t0 = times[0]
+        times = array('d', map(operator.sub, times, [t0] * n))
+        sum_t, sum_v = math.fsum(times), math.fsum(values)
+        sum_tt = math.fsum(map(operator.mul, times, times))
+        sum_tv = math.fsum(map(operator.mul, times, values))
+        denominator = n * sum_tt - sum_t * sum_t
+        if denominator == 0:
+            return None
+        return (n * sum_tv - sum_t * sum_v) / denominator
+
+
+class HistoryStore:
+    """
+    Keeps recent readings for every numeric WeatherStatus field from every source, so trends and totals can be queried
+    instead of recomputed. Memory is capped at max_series * capacity * 16 bytes. With the defaults that's 24 hours of
+    one-minute readings for 256 series, about 6 MB.
+    """
+
+    def __init__(self, capacity : int = 1440, max_series : int = 256):
+        self._capacity = capacity
+        self._max_series = max_series
+        self._series : Dict[Tuple[Hashable, str], Series] = {}
+
+    def series(self, source : Hashable, name : str) -> Optional[Series]:
+        """Returns the history of a field from a source, or None if nothing has been recorded for it."""
+        return self._series.get((source, name))
+
+    def append(self, source : Hashable, name : str, timestamp : float, value : float) -> bool:
+        """Records a single reading. Returns False if it was a repeat of one that's already recorded."""
+        key = (source, name)
+        series = self._series.get(key)
+        if series is None:
+            if len(self._series) >= self._max_series:
+                # Forget the series that has gone the longest without a reading.
+                stalest = min(self._series, key=lambda k: self._series[k].last_time)
+                del self._series[stalest]
+            series = self._series[key] = Series(self._capacity)
+            _SERIES.set(len(self._series))
+        return series.append(timestamp, value)
+
+    def record(self, source : Hashable, status : WeatherStatus, names : Optional[Iterable[str]] = None):
+        """
+        Records the numeric readings in a status, timestamped with when they were observed.
+        If names is given, only those fields are recorded. Collectors that only update some fields at a time should pass it,
+        so unchanged fields aren't recorded again with a newer timestamp.
+        """
+        timestamp = status.source_timestamp or status.host_timestamp
+        if timestamp is None:
+            return
+        timestamp = timestamp.timestamp()
+        for name in names if names is not None else _NUMERIC_CANDIDATES:
+            datapoint = getattr(status, name)
+            if isinstance(datapoint, Datapoint) and isinstance(datapoint.value, (int, float)):
+                self.append(source, name, timestamp, datapoint.value)
+
+    def sample_count(self) -> int:
+        """Returns how many samples are held across every series."""
+        return sum(len(series) for series in self._series.values())
+
+    def _query(self, method : str, source : Hashable, name : str, window : timedelta, now : Optional[float]) -> Optional[float]:
+        series = self._series.get((source, name))
+        if series is None:
+            return None
+        since = (now if now is not None else time.time()) - window.total_seconds()
+        return getattr(series, method)(since)
+
+    def min(self, source : Hashable, name : str, window : timedelta, now : Optional[float] = None) -> Optional[float]:
+        return self._query('min', source, name, window, now)
+
+    def max(self, source : Hashable, name : str, window : timedelta, now : Optional[float] = None) -> Optional[float]:
+        return self._query('max', source, name, window, now)
+
+    def mean(self, source : Hashable, name : str, window : timedelta, now : Optional[float] = None) -> Optional[float]:
+        return self._query('mean', source, name, window, now)
+
+    def sum(self, source : Hashable, name : str, window : timedelta, now : Optional[float] = None) -> Optional[float]:
+        return self._query('sum', source, name, window, now)
+
+    def slope(self, source : Hashable, name : str, window : timedelta, now : Optional[float] = None) -> Optional[float]:
+        """Returns the rate of change per second over the window."""
+        return self._query('slope', source, name, window, now)
+
+
+# Every field that could hold a Datapoint. Fields whose values aren't numbers are skipped when recording.
+_NUMERIC_CANDIDATES : List[str] = [name for name in WeatherStatus.__slots__
+    if name not in ('source', 'station_id', 'host_timestamp', 'source_timestamp')]
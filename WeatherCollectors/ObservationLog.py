@@ -0,0 +1,285 @@
+import asyncio, json, logging, mmap, os, struct, threading, time
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+import metrics
+from .WeatherCollector import WeatherCollector, WeatherStatus, status_to_dict, status_from_dict
+
+logger = logging.getLogger(__name__)
+
+_FLUSH_TIME = metrics.histogram('observation_log_flush_seconds', 'Time taken to write a batch of observations to disk.')
+_RECORDS = metrics.counter('observation_log_records_total', 'Observations written to the observation log.')
+
+# Every record is a header, a JSON payload and a trailer. The trailer repeats the payload length so the
+# log can be read backwards from the end, which is how the latest state is found quickly at startup.
+RECORD_HEADER = struct.Struct('<dI') # When the status was delivered (seconds since the epoch), payload length.
+RECORD_TRAILER = struct.Struct('<I') # Payload length, again.
+SEGMENT_SUFFIX = '.obslog'
+
+class ObservationLog:
+    """
+    An append-only, segmented log of every status delivered by a set of collectors.
+    Statuses are buffered in memory and written out in batches to spare the SD card. Segments are named after the
+    time of their first record, so a time range only has to look at the segments that can contain it, and old
+    segments are deleted whole once they fall outside the retention period or the size limit.
+    """
+
+    def __init__(self, log_dir : str, flush_interval : float = 60.0, max_batch : int = 500,
+                 segment_bytes : int = 4 * 1024 * 1024, segment_duration : float = 24 * 3600.0,
+                 retention : float = 30 * 24 * 3600.0, max_bytes : int = 64 * 1024 * 1024):
+        self._log_dir = log_dir
+        self._flush_interval = flush_interval
+        self._max_batch = max_batch # Flush early if this many statuses are waiting.
+        self._segment_bytes = segment_bytes
+        self._segment_duration = segment_duration
+        self._retention = retention
+        self._max_bytes = max_bytes
+        self._pending : List[Tuple[str, float, WeatherStatus]] = []
+        self._callbacks : Dict[WeatherCollector, tuple] = {} # collector -> (name, callback)
+        self._flush_requested = asyncio.Event()
+        self._restoring = False
+        self._file = None # Only touched with _file_lock held, since writes happen on a worker thread.
+        self._file_lock = threading.Lock()
+        self._file_start = 0.0
+
+    def attach(self, collector : WeatherCollector, name : str):
+        """Records every status the collector delivers. The name identifies the collector's statuses across restarts."""
+        def record(status : WeatherStatus):
+            if self._restoring:
+                return # Don't write restored statuses back into the log.
+            # Collectors update their statuses in place, so keep a copy of what was delivered.
+            # Records are stamped with when they were delivered, rather than the status's own timestamps, so the log is always in order.
+            self._pending.append((name, time.time(), status.copy()))
+            if len(self._pending) >= self._max_batch:
+                self._flush_requested.set()
+        self._callbacks[collector] = (name, record)
+        collector.register_callback(record)
+
+    def restore(self, max_age : Optional[timedelta] = None) -> int:
+        """
+        Redelivers the most recent status logged for every attached collector and station, so the display has something to
+        show straight after a restart. Statuses older than max_age are skipped. Returns how many statuses were delivered.
+        """
+        start = time.perf_counter()
+        latest = self.latest(max_age)
+        delivered = 0
+        self._restoring = True
+        try:
+            for collector, (name, _) in self._callbacks.items():
+                for (logged_name, _), status in latest.items():
+                    if logged_name == name:
+                        collector._deliver_update(status)
+                        delivered += 1
+        finally:
+            self._restoring = False
+        logger.info('Restored %d statuses from the observation log in %.1f ms', delivered, (time.perf_counter() - start) * 1000)
+        return delivered
+
+    def latest(self, max_age : Optional[timedelta] = None) -> Dict[Tuple[str, Optional[str]], WeatherStatus]:
+        """Returns the most recent logged status for every (collector name, station id), reading backwards from the end of the log."""
+        cutoff = time.time() - max_age.total_seconds() if max_age is not None else 0.0
+        latest = {}
+        for path in reversed(self._segments()):
+            for timestamp, name, status in self._read_backwards(path):
+                if timestamp < cutoff:
+                    return latest # Everything further back is older still.
+                if status.host_timestamp is None or status.host_timestamp.timestamp() < cutoff:
+                    continue # e.g. a cached status a collector replayed at startup.
+                latest.setdefault((name, status.station_id), status)
+            if max_age is None and latest:
+                break # Without a cutoff, the newest segment is all that's worth reading.
+        return latest
+
+    def read(self, start : datetime, end : datetime) -> Iterator[Tuple[str, WeatherStatus]]:
+        """Yields (collector name, status) for every status delivered between start and end, oldest first."""
+        start_ts, end_ts = start.timestamp(), end.timestamp()
+        segments = self._segments()
+        for i, path in enumerate(segments):
+            # A segment can only hold records from its own start up to the next segment's start.
+            if self._segment_start(path) > end_ts:
+                break
+            if i + 1 < len(segments) and self._segment_start(segments[i + 1]) < start_ts:
+                continue
+            for timestamp, name, status in self._read_forwards(path, start_ts):
+                if timestamp > end_ts:
+                    break
+                yield name, status
+
+    async def run(self):
+        """Writes out pending statuses in batches until cancelled. Anything still pending is written before returning."""
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._flush_requested.wait(), timeout=self._flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                await self.flush()
+        finally:
+            if self._pending:
+                self._write(self._take_pending()) # Cancelled, so there's no point going through a thread.
+            with self._file_lock:
+                self._close_segment()
+
+    async def flush(self):
+        """Writes every pending status to disk."""
+        self._flush_requested.clear()
+        batch = self._take_pending()
+        if batch:
+            await asyncio.to_thread(self._write, batch) # Keep slow SD card writes off the event loop.
+
+    def _take_pending(self) -> List[Tuple[str, float, WeatherStatus]]:
+        batch, self._pending = self._pending, []
+        return batch
+
+    def _write(self, batch : List[Tuple[str, float, WeatherStatus]]):
+        # A cancelled flush can still be writing on its thread when run() writes the last batch, so serialise them.
+        with self._file_lock:
+            self._write_locked(batch)
+
+    def _write_locked(self, batch : List[Tuple[str, float, WeatherStatus]]):
+        start = time.perf_counter()
+        try:
+            first = batch[0][1]
+            if self._file is None or self._file.tell() >= self._segment_bytes or first - self._file_start >= self._segment_duration:
+                self._open_segment(first)
+
+            chunks = []
+            for name, timestamp, status in batch:
+                payload = json.dumps({'collector': name, 'status': status_to_dict(status)}, separators=(',', ':')).encode('utf-8')
+                chunks.append(RECORD_HEADER.pack(timestamp, len(payload)))
+                chunks.append(payload)
+                chunks.append(RECORD_TRAILER.pack(len(payload)))
+            self._file.write(b''.join(chunks))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            _RECORDS.inc(len(batch))
+        except OSError as e:
+            logger.error('Error writing observation log: %s', e)
+            self._close_segment() # Start a fresh segment next time, rather than appending to a possibly torn one.
+        _FLUSH_TIME.observe(time.perf_counter() - start)
+
+    def _open_segment(self, first : float):
+        """Starts a new segment, named after the timestamp of the first record that will go in it."""
+        self._close_segment()
+        os.makedirs(self._log_dir, exist_ok=True)
+        # Always start a new segment, rather than appending to one a crash may have left half-written.
+        self._file = open(os.path.join(self._log_dir, f'{int(first * 1000):016d}{SEGMENT_SUFFIX}'), 'ab')
+        self._file_start = first
+        self._compact(time.time())
+
+    def _close_segment(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError as e:
+                logger.error('Error closing observation log segment: %s', e)
+            self._file = None
+
+    def _compact(self, now : float):
+        """Deletes the oldest segments once they're past the retention period, or once the log is over its size limit."""
+        segments = self._segments()
+        sizes = [os.path.getsize(path) for path in segments]
+        total = sum(sizes)
+        for i, path in enumerate(segments[:-1]): # Never the current segment.
+            segment_end = self._segment_start(segments[i + 1])
+            if now - segment_end <= self._retention and total <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= sizes[i]
+            except OSError as e:
+                logger.error('Error removing observation log segment %s: %s', path, e)
+                break
+
+    def _segments(self) -> List[str]:
+        try:
+            names = sorted(n for n in os.listdir(self._log_dir) if n.endswith(SEGMENT_SUFFIX))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self._log_dir, n) for n in names]
+
+    def _segment_start(self, path : str) -> float:
+        return int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)]) / 1000
+
+    def _read_forwards(self, path : str, since : float) -> Iterator[Tuple[float, str, WeatherStatus]]:
+        with _map_segment(path) as data:
+            offset, size = 0, len(data)
+            while offset + RECORD_HEADER.size <= size:
+                timestamp, length = RECORD_HEADER.unpack_from(data, offset)
+                payload_start = offset + RECORD_HEADER.size
+                offset = payload_start + length + RECORD_TRAILER.size
+                if offset > size:
+                    break # Torn write at the end of the segment.
+                if timestamp < since:
+                    continue # Only the header needs reading to skip a record.
+                record = _decode(data[payload_start:payload_start + length])
+                if record is not None:
+                    yield timestamp, record[0], record[1]
+
+    def _read_backwards(self, path : str) -> Iterator[Tuple[float, str, WeatherStatus]]:
+        with _map_segment(path) as data:
+            end = len(data)
+            while end >= RECORD_HEADER.size + RECORD_TRAILER.size:
+                (length,) = RECORD_TRAILER.unpack_from(data, end - RECORD_TRAILER.size)
+                start = end - RECORD_TRAILER.size - length - RECORD_HEADER.size
+                if start < 0 or RECORD_HEADER.unpack_from(data, start)[1] != length:
+                    # Torn or corrupt, most likely by a crash mid-append. The trailers can't be trusted to line up any
+                    # more, so find the intact records before this point by walking the headers from the start instead.
+                    for start, length in reversed(_intact_records(data, end)):
+                        yield from self._decode_at(data, start, length)
+                    return
+                yield from self._decode_at(data, start, length)
+                end = start
+
+    def _decode_at(self, data, start : int, length : int) -> Iterator[Tuple[float, str, WeatherStatus]]:
+        timestamp = RECORD_HEADER.unpack_from(data, start)[0]
+        record = _decode(data[start + RECORD_HEADER.size:start + RECORD_HEADER.size + length])
+        if record is not None:
+            yield timestamp, record[0], record[1]
+
+
+def _intact_records(data, end : int) -> List[Tuple[int, int]]:
+    """Returns the (offset, payload length) of every record from the start of a segment up to the first torn one or end."""
+    records = []
+    offset = 0
+    while offset + RECORD_HEADER.size <= end:
+        length = RECORD_HEADER.unpack_from(data, offset)[1]
+        next_offset = offset + RECORD_HEADER.size + length + RECORD_TRAILER.size
+        if next_offset > end or RECORD_TRAILER.unpack_from(data, next_offset - RECORD_TRAILER.size)[0] != length:
+            break
+        records.append((offset, length))
+        offset = next_offset
+    return records
+
+
+class _map_segment:
+    """Memory maps a segment for reading. Empty files can't be mapped, so they read as empty bytes."""
+
+    def __init__(self, path : str):
+        self._path = path
+        self._file = None
+        self._map = None
+
+    def __enter__(self):
+        try:
+            self._file = open(self._path, 'rb')
+            if os.fstat(self._file.fileno()).st_size > 0:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                return self._map
+        except OSError as e:
+            logger.warning('Error reading observation log segment %s: %s', self._path, e)
+        return b''
+
+    def __exit__(self, *exc):
+        if self._map is not None:
+            self._map.close()
+        if self._file is not None:
+            self._file.close()
+
+
+def _decode(payload : bytes) -> Optional[Tuple[str, WeatherStatus]]:
+    try:
+        record = json.loads(payload)
+        return record['collector'], status_from_dict(record['status'])
+    except (ValueError, KeyError, TypeError, IndexError) as e:
+        logger.warning('Skipping unreadable observation log record: %s', e)
+        return None
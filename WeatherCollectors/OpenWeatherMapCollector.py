@@ -1,15 +1,84 @@
 #!/usr/bin/env python3
-import asyncio, aiohttp, urllib.parse
-from datetime import datetime, timezone
+import asyncio, aiohttp, logging, urllib.parse, dataclasses
+from datetime import datetime, timezone, timedelta
+from typing import Optional
+from http_client import borrow_session
+import metrics
 from .WeatherCollector import WeatherCollector, WeatherStatus, Datapoint
+from .ResponseCache import ResponseCache, get_json, url_key
+from .HistoryStore import HistoryStore
+from .PollScheduler import PollScheduler
+
+logger = logging.getLogger(__name__)
+
+_POLL_TIME = metrics.histogram('collector_poll_seconds', 'Time taken to poll a REST API and parse the response.', ['collector']).labels('openweathermap')
+_POLL_ERRORS = metrics.counter('collector_poll_errors_total', 'Polls that failed.', ['collector']).labels('openweathermap')
+
+def status_from_response(body : dict) -> WeatherStatus:
+    """Converts one location's current weather, as returned by OpenWeatherMap, into a WeatherStatus."""
+    main = body.get('main', {})
+    wind = body.get('wind', {})
+    weather = body.get('weather', [{}])[0] # Only interested in the primary weather object.
+
+    status = WeatherStatus()
+    status.source = "openweathermap"
+    status.host_timestamp = datetime.now(timezone.utc)
+
+    if 'dt' in body:
+        status.source_timestamp = datetime.fromtimestamp(body['dt'], timezone.utc)
+
+    if 'temp' in main:
+        status.temp_c = Datapoint(main['temp'], 0.5) # Quality is good, but not as good as a local sensor.
+
+    if 'humidity' in main:
+        status.humidity_pct = Datapoint(main['humidity'], 0.5)
+    
+    if 'pressure' in main:
+        status.pressure_mb = Datapoint(main['pressure'], 0.5)
+
+    if 'speed' in wind:
+        status.wind_avg_mps = Datapoint(wind['speed'], .75) # I trust the OWM wind speed more than a ground-mounted sensor.
+    
+    if 'description' in weather:
+        status.condition_string = Datapoint(weather['description'], 1.0) # Real weather services use FAR more reliable models for conditions than a local sensor.
+
+    if 'icon' in weather:
+        status.openweathermap_icon = Datapoint(weather['icon'], 1.0)
+    
+    # Determine if it's precipitating based on the weather code.
+    # See: https://openweathermap.org/weather-conditions
+    if 'id' in weather:
+        id = weather['id']
+        precip_type = ("rain" if id >= 200 and id < 400
+            else "rain" if id >= 500 and id < 600
+            else "snow" if id >= 600 and id < 700
+            else None)
+        if precip_type is not None:
+            quality = 0.0 if precip_type == "rain" else 0.75 # The rain values are worse than a local station, but snow is better.
+            status.precip_type = Datapoint(precip_type, quality)
+
+        if 'rain' in body and '1h' in body['rain']:
+            status.precip_type = Datapoint('rain', 0.75)
+            status.rain_mm = Datapoint(body['rain']['1h'], 0.75)
+
+    return status
+
 
 class OpenWeatherMapCollector(WeatherCollector):
     """Collects weather data from OpenWeatherMap."""
 
-    def __init__(self, config : dict, poll_interval : float = 300.0):
+    def __init__(self, config : dict, poll_interval : float = 300.0, session : Optional[aiohttp.ClientSession] = None,
+                 cache : Optional[ResponseCache] = None, replay_max_age : Optional[timedelta] = None,
+                 history : Optional[HistoryStore] = None, scheduler : Optional[PollScheduler] = None):
         super().__init__()
         self._config = config
         self._poll_interval = poll_interval
+        self._scheduler = scheduler or PollScheduler('openweathermap', poll_interval) # Decides when to poll. Backs off after errors.
+        self._session = session # Shared, pooled HTTP session. If None, a new session is made for every poll.
+        self._cache = cache # Optional on-disk response cache.
+        self._replay_max_age = replay_max_age # How old a cached status can be and still be replayed at startup.
+        self._last_status : Optional[WeatherStatus] = None
+        self.history = history # Optional store that new readings are recorded in.
 
         # Force units to metric so we can convert to the units specified in config.py ourselves.
         self._config['units'] = 'metric'
@@ -22,72 +91,62 @@ class OpenWeatherMapCollector(WeatherCollector):
         """Retrieves the current WeatherConditions from the web."""
         
         url = self._get_weather_url()
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                body = await response.json()
+        async with borrow_session(self._session) as session:
+            body, changed = await get_json(session, url, self._cache)
 
-        if int(body['cod']) == 200:
-            main = body.get('main', {})
-            wind = body.get('wind', {})
-            weather = body.get('weather', [{}])[0] # Only interested in the primary weather object.
-
-            status = WeatherStatus()
-            status.source = "openweathermap"
-            status.host_timestamp = datetime.now(timezone.utc)
-
-            if 'dt' in body:
-                status.source_timestamp = datetime.fromtimestamp(body['dt'], timezone.utc)
-
-            if 'temp' in main:
-                status.temp_c = Datapoint(main['temp'], 0.5) # Quality is good, but not as good as a local sensor.
-
-            if 'humidity' in main:
-                status.humidity_pct = Datapoint(main['humidity'], 0.5)
-            
-            if 'pressure' in main:
-                status.pressure_mb = Datapoint(main['pressure'], 0.5)
-
-            if 'speed' in wind:
-                status.wind_avg_mps = Datapoint(wind['speed'], .75) # I trust the OWM wind speed more than a ground-mounted sensor.
-            
-            if 'description' in weather:
-                status.condition_string = Datapoint(weather['description'], 1.0) # Real weather services use FAR more reliable models for conditions than a local sensor.
-
-            if 'icon' in weather:
-                status.openweathermap_icon = Datapoint(weather['icon'], 1.0)
-            
-            # Determine if it's precipitating based on the weather code.
-            # See: https://openweathermap.org/weather-conditions
-            if 'id' in weather:
-                id = weather['id']
-                precip_type = ("rain" if id >= 200 and id < 400
-                    else "rain" if id >= 500 and id < 600
-                    else "snow" if id >= 600 and id < 700
-                    else None)
-                if precip_type is not None:
-                    quality = 0.0 if precip_type == "rain" else 0.75 # The rain values are worse than a local station, but snow is better.
-                    status.precip_type = Datapoint(precip_type, quality)
-
-                if 'rain' in body and '1h' in body['rain']:
-                    status.precip_type = Datapoint('rain', 0.75)
-                    status.rain_mm = Datapoint(body['rain']['1h'], 0.75)
+        # Nothing new upstream, so there's nothing to re-parse. The old readings have just been confirmed as current.
+        if not changed and self._last_status is not None:
+            return dataclasses.replace(self._last_status, host_timestamp=datetime.now(timezone.utc))
 
+        if int(body['cod']) == 200:
+            status = status_from_response(body)
+            self._last_status = status
+            if self.history is not None:
+                self.history.record(('openweathermap', None), status)
+            if self._cache is not None:
+                self._cache.store_status(self._get_cache_name(), status)
             return status
         else:
             raise RuntimeError(f'Weather query failed. {body["cod"]} - {body["message"]}')
     
+    def _get_cache_name(self) -> str:
+        return 'openweathermap-' + url_key(self._get_weather_url())
+
+    def _replay_cached_status(self):
+        """Delivers the last good status from a previous run, so the display has something to show before the first poll finishes."""
+        if self._cache is None:
+            return
+        status = self._cache.load_status(self._get_cache_name(), self._replay_max_age)
+        if status is not None:
+            self._last_status = status
+            try:
+                self._deliver_update(status)
+            except Exception as e:
+                logger.error('Error delivering weather data: %s', e) # Don't let a callback stop polling before it starts.
+
     async def listen(self):
         """Starts polling for weather updates. This will run until cancelled."""
+        self._replay_cached_status()
 
         while True:
+            await self._scheduler.wait()
             try:
-                status = await self._get_current_weather_conditions()
-                self._deliver_update(status)
-                await asyncio.sleep(self._poll_interval)
+                with _POLL_TIME.time():
+                    status = await self._get_current_weather_conditions()
             except asyncio.CancelledError:
                 raise # Propagate task cancellations to the awaiter.
             except Exception as e:
-                print(f'Error getting weather data: {e}') # Suppress other types of exception.
+                _POLL_ERRORS.inc()
+                delay = self._scheduler.failed() # Back off, rather than retrying straight away.
+                logger.error('Error getting weather data: %s Retrying in %.0f seconds.', e, delay) # Suppress other types of exception.
+                continue
+
+            # The poll worked, whatever happens downstream. An error in a callback shouldn't make it back off.
+            self._scheduler.succeeded(status)
+            try:
+                self._deliver_update(status)
+            except Exception as e:
+                logger.error('Error delivering weather data: %s', e)
 
 
 async def debug_status():
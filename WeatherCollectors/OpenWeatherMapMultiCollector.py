@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+import asyncio, aiohttp, logging, urllib.parse, dataclasses
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Tuple
+from http_client import borrow_session
+import metrics
+from .WeatherCollector import WeatherCollector, WeatherStatus
+from .ResponseCache import ResponseCache, get_json, url_key
+from .HistoryStore import HistoryStore
+from .OpenWeatherMapCollector import status_from_response
+from .PollScheduler import PollScheduler, RequestBudget
+
+logger = logging.getLogger(__name__)
+
+_POLL_TIME = metrics.histogram('collector_poll_seconds', 'Time taken to poll a REST API and parse the response.', ['collector']).labels('openweathermap_multi')
+_POLL_ERRORS = metrics.counter('collector_poll_errors_total', 'Polls that failed.', ['collector']).labels('openweathermap_multi')
+
+WEATHER_URL = 'https://api.openweathermap.org/data/2.5/weather?'
+GROUP_URL = 'https://api.openweathermap.org/data/2.5/group?'
+GROUP_SIZE = 20 # Most city ids OpenWeatherMap accepts in one group request.
+
+class OpenWeatherMapLocation(WeatherCollector):
+    """One location polled by an OpenWeatherMapMultiCollector. Delivers that location's statuses like a collector of its own."""
+
+    def __init__(self, parent : 'OpenWeatherMapMultiCollector', name : str, query : dict):
+        super().__init__()
+        self.name = name
+        self.query = query # Query parameters that pick out the location, e.g. {'zip': '44060'} or {'id': '5150529'}.
+        self._parent = parent
+        self._last_status : Optional[WeatherStatus] = None
+
+    def weather_url(self) -> str:
+        """The URL that fetches this location on its own."""
+        return WEATHER_URL + urllib.parse.urlencode(self.query)
+
+    async def listen(self):
+        """Polls until cancelled. Every location shares the parent's polling, so listening to more of them costs nothing extra."""
+        await self._parent._listen_for(self)
+
+
+@dataclasses.dataclass
+class _Request:
+    """One request in a poll, and the locations it fetches."""
+    url : str
+    locations : List[OpenWeatherMapLocation]
+    is_group : bool
+
+
+class OpenWeatherMapMultiCollector:
+    """
+    Polls OpenWeatherMap for many locations with one appid. Locations given by city id are fetched up to GROUP_SIZE at a
+    time with the group endpoint. The rest are fetched one request each, a few at a time, over the shared HTTP session.
+    Locations with identical queries share one request. Every location shares one poll schedule, one request budget
+    and one response cache, so another location only costs its share of a request and one more status.
+    """
+
+    def __init__(self, appid : str, locations : Dict[str, dict], poll_interval : float = 300.0, session : Optional[aiohttp.ClientSession] = None,
+                 cache : Optional[ResponseCache] = None, replay_max_age : Optional[timedelta] = None,
+                 history : Optional[HistoryStore] = None, budget : Optional[RequestBudget] = None, max_concurrency : int = 2):
+        self._session = session # Shared, pooled HTTP session. If None, a new session is made for every request.
+        self._cache = cache # Optional on-disk response cache.
+        self._replay_max_age = replay_max_age # How old a cached status can be and still be replayed at startup.
+        self.history = history # Optional store that new readings are recorded in.
+        self._max_concurrency = max_concurrency # Requests in flight at once.
+
+        # Force units to metric so we can convert to the units specified in config.py ourselves.
+        self.locations : Dict[str, OpenWeatherMapLocation] = {}
+        for name, query in locations.items():
+            query = {key: value for key, value in query.items() if key != 'units'}
+            query['appid'], query['units'] = appid, 'metric'
+            self.locations[name] = OpenWeatherMapLocation(self, name, query)
+        self._requests = self._plan_requests()
+        self._scheduler = PollScheduler('openweathermap_multi', poll_interval, budget=budget, cost=len(self._requests))
+        self._task : Optional[asyncio.Task] = None
+        self._listeners = 0
+
+    def location(self, name : str) -> OpenWeatherMapLocation:
+        return self.locations[name]
+
+    def _plan_requests(self) -> List[_Request]:
+        """Works out the fewest requests that fetch every location. Only needs doing once, since locations don't change."""
+        groups : Dict[Tuple, List[OpenWeatherMapLocation]] = {} # Other query parameters -> locations given by city id.
+        singles : Dict[Tuple, List[OpenWeatherMapLocation]] = {} # Query -> locations asking for exactly that.
+        for location in self.locations.values():
+            if 'id' in location.query:
+                others = tuple(sorted((key, value) for key, value in location.query.items() if key != 'id'))
+                groups.setdefault(others, []).append(location)
+            else:
+                singles.setdefault(tuple(sorted(location.query.items())), []).append(location)
+
+        requests = []
+        for others, locations in groups.items():
+            ids = list(dict.fromkeys(str(location.query['id']) for location in locations))
+            if len(ids) == 1:
+                requests.append(_Request(locations[0].weather_url(), locations, False)) # A group of one is just a normal request.
+                continue
+            for i in range(0, len(ids), GROUP_SIZE):
+                chunk = set(ids[i:i + GROUP_SIZE])
+                url = GROUP_URL + urllib.parse.urlencode([('id', ','.join(ids[i:i + GROUP_SIZE]))] + list(others))
+                requests.append(_Request(url, [location for location in locations if str(location.query['id']) in chunk], True))
+        requests.extend(_Request(locations[0].weather_url(), locations, False) for locations in singles.values())
+        return requests
+
+    async def _listen_for(self, location : OpenWeatherMapLocation):
+        # The first location to listen starts the polling. It stops once nobody is listening any more.
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._poll_forever())
+        task = self._task
+        self._listeners += 1
+        try:
+            await asyncio.shield(task)
+        finally:
+            self._listeners -= 1
+            if self._listeners == 0:
+                task.cancel()
+
+    async def _poll_forever(self):
+        self._replay_cached_statuses()
+        primary = next(iter(self.locations.values()), None) # Its weather decides how often to poll.
+        while True:
+            await self._scheduler.wait()
+            with _POLL_TIME.time():
+                updates = await self._poll()
+            if updates is None:
+                delay = self._scheduler.failed() # Back off, rather than retrying straight away.
+                logger.error('Every OpenWeatherMap request failed. Retrying in %.0f seconds.', delay)
+                continue
+
+            # The poll worked, whatever happens downstream. An error in a callback shouldn't make it back off.
+            # Always tell the scheduler, even before the primary location has any weather, or it would poll again straight away.
+            paced_by = primary._last_status if primary is not None else None
+            if paced_by is None and updates:
+                paced_by = updates[0][1]
+            self._scheduler.succeeded(paced_by or WeatherStatus())
+            for location, status in updates:
+                try:
+                    location._deliver_update(status)
+                except Exception as e:
+                    logger.error('Error delivering weather data for %s: %s', location.name, e)
+
+    async def _poll(self) -> Optional[List[Tuple[OpenWeatherMapLocation, WeatherStatus]]]:
+        """Makes every request in a poll. Returns the statuses to deliver, or None if every request failed."""
+        slots = asyncio.Semaphore(self._max_concurrency)
+
+        async def fetch(request : _Request):
+            async with slots:
+                async with borrow_session(self._session) as session:
+                    return await get_json(session, request.url, self._cache)
+
+        results = await asyncio.gather(*(fetch(request) for request in self._requests), return_exceptions=True)
+        updates, succeeded = [], False
+        for request, result in zip(self._requests, results):
+            names = ', '.join(location.name for location in request.locations) # Never the URL. It holds the appid.
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+            try:
+                if isinstance(result, BaseException):
+                    raise result
+                updates.extend(self._handle_response(request, *result))
+                succeeded = True
+            except Exception as e:
+                _POLL_ERRORS.inc()
+                logger.error('Error getting weather data for %s: %s', names, e)
+        return updates if succeeded else None
+
+    def _handle_response(self, request : _Request, body, changed : bool) -> List[Tuple[OpenWeatherMapLocation, WeatherStatus]]:
+        """Parses a response into a status for each of its locations."""
+        now = datetime.now(timezone.utc)
+        if not changed and all(location._last_status is not None for location in request.locations):
+            # Nothing new upstream, so there's nothing to re-parse. The old readings have just been confirmed as current.
+            return [(location, dataclasses.replace(location._last_status, host_timestamp=now)) for location in request.locations]
+
+        if int(body.get('cod', 200)) != 200: # Group responses have no cod when they succeed.
+            raise RuntimeError(f'Weather query failed. {body["cod"]} - {body.get("message")}')
+        updates = []
+        if request.is_group:
+            by_id = {str(item.get('id')): item for item in body.get('list', [])}
+            for location in request.locations:
+                item = by_id.get(str(location.query['id']))
+                if item is None:
+                    logger.warning('No weather returned for %s.', location.name)
+                else:
+                    updates.append(self._accept(location, status_from_response(item)))
+        else:
+            status = status_from_response(body)
+            for location in request.locations:
+                updates.append(self._accept(location, status if len(request.locations) == 1 else status.copy()))
+        return updates
+
+    def _accept(self, location : OpenWeatherMapLocation, status : WeatherStatus) -> Tuple[OpenWeatherMapLocation, WeatherStatus]:
+        """Records a location's new status, ready to be delivered."""
+        status.station_id = location.name # Keeps locations apart in the observation log.
+        location._last_status = status
+        if self.history is not None:
+            self.history.record(('openweathermap', location.name), status)
+        if self._cache is not None:
+            self._cache.store_status(self._get_cache_name(location), status)
+        return location, status
+
+    def _get_cache_name(self, location : OpenWeatherMapLocation) -> str:
+        return 'openweathermap-' + url_key(location.weather_url()) # The same name OpenWeatherMapCollector uses, so switching between them keeps the cache.
+
+    def _replay_cached_statuses(self):
+        """Delivers the last good status of every location from a previous run, so there's something to show before the first poll finishes."""
+        if self._cache is None:
+            return
+        for location in self.locations.values():
+            status = self._cache.load_status(self._get_cache_name(location), self._replay_max_age)
+            if status is not None:
+                location._last_status = status
+                try:
+                    location._deliver_update(status)
+                except Exception as e:
+                    logger.error('Error delivering weather data for %s: %s', location.name, e) # Don't let a callback stop polling before it starts.
@@ -0,0 +1,274 @@
+import asyncio, heapq, itertools, logging, math, random, statistics, time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+import metrics
+from .WeatherCollector import WeatherStatus
+
+logger = logging.getLogger(__name__)
+
+_DELAY = metrics.gauge('poll_scheduler_delay_seconds', 'Seconds until a collector next polls.', ['collector'])
+_BUDGET_WAITS = metrics.counter('poll_budget_waits_total', 'Polls held back because the API key had used up its request budget.', ['collector'])
+
+class Clock:
+    """Wall clock time and sleeping. Polls are scheduled against this, so a simulation can swap in a VirtualClock."""
+
+    def time(self) -> float:
+        """Seconds since the epoch. Wall clock time, since upstream timestamps are compared against it."""
+        return time.time()
+
+    async def sleep(self, seconds : float):
+        await asyncio.sleep(seconds)
+
+
+class VirtualClock(Clock):
+    """
+    A clock that only moves when it's told to, so hours of polling can be simulated in an instant. Sleepers are woken in
+    order as advance() passes their wake time, and each one gets to run before the clock moves on.
+    """
+
+    def __init__(self, start : float = 0.0):
+        self._now = start
+        self._sleepers : List[Tuple[float, int, asyncio.Future]] = [] # Heap of (wake time, tiebreak, future).
+        self._counter = itertools.count()
+
+    def time(self) -> float:
+        return self._now
+
+    async def sleep(self, seconds : float):
+        if seconds <= 0:
+            await asyncio.sleep(0)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers, (self._now + seconds, next(self._counter), future))
+        await future
+
+    async def advance(self, seconds : float):
+        """Moves the clock forward, waking every sleeper that's due along the way."""
+        target = self._now + seconds
+        await _settle()
+        while self._sleepers and self._sleepers[0][0] <= target:
+            wake, _, future = heapq.heappop(self._sleepers)
+            self._now = max(self._now, wake)
+            if not future.done(): # Cancelled sleepers are left in the heap. Skip them.
+                future.set_result(None)
+                await _settle()
+        self._now = target
+
+
+async def _settle(rounds : int = 20):
+    """Gives woken tasks a chance to run until they next sleep."""
+    for _ in range(rounds):
+        await asyncio.sleep(0)
+
+
+class RequestBudget:
+    """
+    Limits the requests made with one API key to a number per period, over a sliding window, which is how providers
+    count their quotas. Every collector using the same key should share a budget. See get_budget().
+    """
+
+    def __init__(self, requests : int, period : float, clock : Optional[Clock] = None):
+        self.requests = requests
+        self.period = period
+        self._clock = clock or Clock()
+        self._sent : Deque[float] = deque() # When each request in the current window was made, oldest first.
+
+    def acquire(self, cost : int = 1) -> float:
+        """
+        Takes cost requests from the budget if they're available and returns 0. Otherwise takes nothing and returns the
+        seconds until they will be.
+        """
+        now = self._clock.time()
+        while self._sent and (self._sent[0] <= now - self.period or self._sent[0] > now): # Also forget anything from before the clock was set back.
+            self._sent.popleft()
+        if len(self._sent) + cost <= self.requests:
+            self._sent.extend([now] * cost)
+            return 0.0
+        if cost > self.requests:
+            raise ValueError(f'A poll costing {cost} requests can never fit in a budget of {self.requests}.')
+        return self._sent[len(self._sent) + cost - self.requests - 1] + self.period - now
+
+    def remaining(self) -> int:
+        now = self._clock.time()
+        return self.requests - sum(1 for t in self._sent if now - self.period < t <= now)
+
+
+_budgets : Dict[str, RequestBudget] = {}
+
+def get_budget(api_key : str, requests : int, period : float = 24 * 3600.0, clock : Optional[Clock] = None) -> RequestBudget:
+    """Returns the budget shared by everything polling with an API key, creating it on first use."""
+    budget = _budgets.get(api_key)
+    if budget is None:
+        budget = _budgets[api_key] = RequestBudget(requests, period, clock)
+    return budget
+
+
+def is_changing(old : Optional[WeatherStatus], new : WeatherStatus, temp_delta : float = 0.5, pressure_delta : float = 0.5) -> bool:
+    """Returns True if the weather has moved enough between two statuses to be worth watching more closely."""
+    if old is None:
+        return False
+    for name in ('openweathermap_icon', 'condition_string', 'precip_type'):
+        a, b = getattr(old, name), getattr(new, name)
+        if (a.value if a is not None else None) != (b.value if b is not None else None):
+            return True
+    for name, delta in (('temp_c', temp_delta), ('pressure_mb', pressure_delta)):
+        a, b = getattr(old, name), getattr(new, name)
+        if a is not None and b is not None and abs(a.value - b.value) >= delta:
+            return True
+    return False
+
+
+class PollScheduler:
+    """
+    Decides when a REST collector polls next.
+    - After a failure, waits an exponentially growing, jittered time, so an outage doesn't turn into a tight retry loop.
+    - Polls faster while the weather is changing and slower while it's stable, between min_interval and max_interval.
+    - Learns how often upstream publishes new data from source_timestamp, and times polls just after it should have,
+      rather than fetching the same data again.
+    - Never polls faster than the API key's request budget allows.
+    """
+
+    def __init__(self, name : str, interval : float, min_interval : Optional[float] = None, max_interval : Optional[float] = None,
+                 min_backoff : float = 5.0, max_backoff : float = 1800.0, jitter : float = 0.1,
+                 budget : Optional[RequestBudget] = None, cost : int = 1, clock : Optional[Clock] = None,
+                 is_changing : Callable[[Optional[WeatherStatus], WeatherStatus], bool] = is_changing,
+                 rng : Optional[random.Random] = None):
+        self.name = name
+        self.interval = interval # The current adaptive interval.
+        self._min_interval = min_interval if min_interval is not None else interval / 4
+        self._max_interval = max_interval if max_interval is not None else interval * 2
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._jitter = jitter # Fraction of each delay that's randomised, so a fleet of displays doesn't poll in lockstep.
+        self._budget = budget
+        self._cost = cost # Requests each poll makes.
+        self._clock = clock or Clock()
+        self._is_changing = is_changing
+        self._rng = rng or random.Random()
+        self.failures = 0 # Failures in a row.
+        self._last_status : Optional[WeatherStatus] = None
+        self._last_source_time : Optional[float] = None
+        self._upstream_periods : Deque[float] = deque(maxlen=5) # Recent gaps between new upstream timestamps.
+        self._stale_since_new = False # Whether a poll has found nothing new since the last new data.
+        self._publish_lag : Optional[float] = None # Shortest seen time between a source timestamp and the data being fetchable.
+        self._next_delay = 0.0
+        self._delay_gauge = _DELAY.labels(name)
+        self._budget_waits = _BUDGET_WAITS.labels(name)
+
+    @property
+    def upstream_period(self) -> Optional[float]:
+        """How often upstream seems to publish new data, or None if it isn't known yet."""
+        return statistics.median(self._upstream_periods) if self._upstream_periods else None
+
+    def succeeded(self, status : WeatherStatus) -> float:
+        """Records a successful poll. Returns the seconds until the next poll."""
+        self.failures = 0
+        now = self._clock.time()
+        new_data = self._observe_source_time(status, now)
+        if new_data:
+            if self._is_changing(self._last_status, status):
+                self.interval = max(self._min_interval, self.interval / 2)
+            else:
+                self.interval = min(self._max_interval, self.interval * 1.25)
+            self._last_status = status
+        self._next_delay = self._align(now, self._jittered(self.interval))
+        self._delay_gauge.set(self._next_delay)
+        return self._next_delay
+
+    def failed(self) -> float:
+        """Records a failed poll. Returns the seconds until the next attempt."""
+        self.failures += 1
+        backoff = min(self._max_backoff, self._min_backoff * 2 ** (self.failures - 1))
+        self._next_delay = backoff / 2 + self._rng.uniform(0, backoff / 2) # Half fixed, so retries never bunch up at zero.
+        self._delay_gauge.set(self._next_delay)
+        return self._next_delay
+
+    async def wait(self):
+        """Sleeps until the next poll is due and the request budget has room for it."""
+        await self._clock.sleep(self._next_delay)
+        if self._budget is None:
+            return
+        while True:
+            wait = self._budget.acquire(self._cost)
+            if wait <= 0:
+                return
+            self._budget_waits.inc()
+            logger.warning('%s has used its request budget. Waiting %.0f seconds.', self.name, wait)
+            await self._clock.sleep(wait)
+
+    def _jittered(self, delay : float) -> float:
+        return delay * (1 + self._rng.uniform(-self._jitter, self._jitter))
+
+    def _observe_source_time(self, status : WeatherStatus, now : float) -> bool:
+        """Learns upstream's cadence from the status's source timestamp. Returns True if the status holds new data."""
+        if status.source_timestamp is None:
+            return True # No way to tell, so assume it's new.
+        source_time = status.source_timestamp.timestamp()
+        period = self.upstream_period
+        if self._last_source_time is not None and source_time <= self._last_source_time:
+            # Nothing new yet. If an update was expected by now, upstream takes longer to publish than was thought.
+            if period is not None and now > self._last_source_time + period:
+                self._publish_lag = max(self._publish_lag or 0.0, now - self._last_source_time - period)
+            self._stale_since_new = True
+            return False
+        if self._last_source_time is not None:
+            # The gap only shows upstream's cadence if polls were coming faster than it. Otherwise it's just the poll interval.
+            if self._stale_since_new:
+                self._upstream_periods.append(source_time - self._last_source_time)
+            # Once polls are aligned, creep a little earlier each time, so the estimate closes in on how soon new data can
+            # really be fetched. Until then, every poll lands at some random time after an update, so just keep the soonest.
+            lag = max(0.0, now - source_time)
+            if period is not None and lag >= period:
+                # A newer update was due but couldn't be fetched yet, so upstream takes longer to publish than was thought.
+                self._publish_lag = max(self._publish_lag or 0.0, lag % period)
+            elif self._publish_lag is None:
+                self._publish_lag = lag
+            else:
+                self._publish_lag = min(lag, self._publish_lag * 0.9 if period is not None else self._publish_lag)
+        self._last_source_time = source_time
+        self._stale_since_new = False
+        return True
+
+    def _align(self, now : float, delay : float) -> float:
+        """Pushes a delay back to just after upstream's next expected update, so the poll finds new data."""
+        period = self.upstream_period
+        if period is None or self._last_source_time is None or period > self._max_interval:
+            return delay
+        # A little past when it's expected to be fetchable, jittered so a fleet of displays doesn't all poll at once.
+        slack = (self._publish_lag or 0.0) + self._rng.uniform(0.5, 1.0) * min(30.0, period * 0.05)
+        # The update nearest to when the interval says to poll, but never one that's already been fetched.
+        next_update = math.floor((now - slack - self._last_source_time) / period) + 1
+        updates = max(next_update, round((now + delay - slack - self._last_source_time) / period))
+        return max(0.0, self._last_source_time + updates * period + slack - now)
+
+
+async def simulate(hours : float = 6.0, upstream_period : float = 600.0, publish_lag : float = 90.0, outage : Tuple[float, float] = (3600.0, 5400.0)):
+    """Polls a fake upstream on a virtual clock and prints when each poll happened. Shows the scheduler without a network."""
+    from datetime import datetime, timezone
+    from .WeatherCollector import Datapoint
+
+    clock = VirtualClock(1_700_000_000.0)
+    start = clock.time()
+    scheduler = PollScheduler('simulation', 300.0, budget=RequestBudget(100, 24 * 3600.0, clock), clock=clock, rng=random.Random(1))
+
+    async def poll():
+        while True:
+            elapsed = clock.time() - start
+            if outage[0] <= elapsed < outage[1]:
+                delay = scheduler.failed()
+                print(f'{elapsed:8.0f}s  failed,    retry in {delay:6.0f}s')
+            else:
+                published = start + ((elapsed - publish_lag) // upstream_period) * upstream_period
+                temp = 20.0 + max(0.0, elapsed - 4 * 3600) / 1200 # Steady, then warming 3 degrees an hour after four hours.
+                status = WeatherStatus(source='simulation', source_timestamp=datetime.fromtimestamp(published, timezone.utc), temp_c=Datapoint(temp, 0.5))
+                delay = scheduler.succeeded(status)
+                print(f'{elapsed:8.0f}s  succeeded, next in  {delay:6.0f}s  interval={scheduler.interval:.0f}s')
+            await scheduler.wait()
+
+    task = asyncio.create_task(poll())
+    await clock.advance(hours * 3600)
+    task.cancel()
+
+
+if __name__ == '__main__':
+    asyncio.run(simulate())
@@ -0,0 +1,141 @@
+import os, json, time, hashlib, logging, re
+import aiohttp
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+from .WeatherCollector import WeatherStatus, status_to_dict, status_from_dict
+
+logger = logging.getLogger(__name__)
+
+def url_key(url : str) -> str:
+    """Returns a filename-safe key for a URL. URLs are hashed so API keys in query strings don't end up in filenames."""
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def _parse_max_age(cache_control : Optional[str]) -> Optional[float]:
+    """Returns the max-age from a Cache-Control header, or None if the response shouldn't be considered fresh."""
+    if not cache_control or 'no-cache' in cache_control or 'no-store' in cache_control:
+        return None
+    match = re.search(r'max-age=(\d+)', cache_control)
+    return float(match.group(1)) if match else None
+
+
+class ResponseCache:
+    """
+    Remembers HTTP responses on disk so polling collectors can make conditional requests, skip
+    re-parsing bodies that haven't changed, and replay their last good status after a restart.
+    """
+
+    def __init__(self, cache_dir : str):
+        self._cache_dir = cache_dir
+        self._entries : Dict[str, Dict[str, Any]] = {}
+
+    async def get_json(self, session : aiohttp.ClientSession, url : str) -> Tuple[Any, bool]:
+        """Returns the JSON body for a URL and whether it differs from the last time it was fetched."""
+        key = url_key(url)
+        entry = self._load_entry(key)
+        now = time.time()
+
+        # Still fresh according to Cache-Control, so there's no need to ask the server.
+        if entry is not None and entry.get('expires', 0) > now:
+            return entry['body'], False
+
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304 and entry is not None:
+                if self._update_validators(entry, response, now):
+                    self._save_entry(key, entry)
+                return entry['body'], False
+
+            raw = await response.read()
+            if response.status != 200:
+                return json.loads(raw), True # Don't cache errors. Let the collector report them.
+
+            digest = hashlib.sha1(raw).hexdigest()
+            if entry is not None and entry.get('digest') == digest:
+                if self._update_validators(entry, response, now):
+                    self._save_entry(key, entry)
+                return entry['body'], False # Server didn't support validators, but the body is the same.
+
+            entry = {'digest': digest, 'body': json.loads(raw)}
+            self._update_validators(entry, response, now)
+            self._save_entry(key, entry)
+            return entry['body'], True
+
+    def store_status(self, name : str, status : WeatherStatus):
+        """Saves the last good status for a collector so it can be replayed at startup."""
+        self._write_json(name + '.status.json', status_to_dict(status))
+
+    def load_status(self, name : str, max_age : Optional[timedelta]) -> Optional[WeatherStatus]:
+        """Returns the last good status for a collector if it isn't older than max_age."""
+        d = self._read_json(name + '.status.json')
+        if d is None:
+            return None
+        try:
+            status = status_from_dict(d)
+        except (ValueError, TypeError, IndexError) as e:
+            logger.warning('Ignoring unreadable cached status %s: %s', name, e)
+            return None
+        if status.host_timestamp is None:
+            return None
+        if max_age is not None and datetime.now(timezone.utc) - status.host_timestamp > max_age:
+            return None
+        return status
+
+    def _update_validators(self, entry : Dict[str, Any], response : aiohttp.ClientResponse, now : float) -> bool:
+        """
+        Refreshes an entry from a response's headers. Returns True if the validators changed and the entry is worth saving.
+        A new expiry alone isn't, since every unchanged poll brings one. Losing it at a restart only costs a revalidation.
+        """
+        etag = response.headers.get('ETag') or entry.get('etag')
+        last_modified = response.headers.get('Last-Modified') or entry.get('last_modified')
+        changed = etag != entry.get('etag') or last_modified != entry.get('last_modified')
+        entry['etag'], entry['last_modified'] = etag, last_modified
+        max_age = _parse_max_age(response.headers.get('Cache-Control'))
+        entry['expires'] = now + max_age if max_age is not None else 0
+        return changed
+
+    def _load_entry(self, key : str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._read_json(key + '.json')
+            if entry is not None:
+                self._entries[key] = entry
+        return entry
+
+    def _save_entry(self, key : str, entry : Dict[str, Any]):
+        self._entries[key] = entry
+        self._write_json(key + '.json', entry)
+
+    def _read_json(self, filename : str) -> Optional[Any]:
+        try:
+            with open(os.path.join(self._cache_dir, filename), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring unreadable cache file %s: %s', filename, e)
+            return None
+
+    def _write_json(self, filename : str, value : Any):
+        # Write to a temporary file first so a crash never leaves a half-written cache entry behind.
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            path = os.path.join(self._cache_dir, filename)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(value, f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logger.error('Error writing cache file %s: %s', filename, e)
+
+
+async def get_json(session : aiohttp.ClientSession, url : str, cache : Optional[ResponseCache] = None) -> Tuple[Any, bool]:
+    """Fetches a JSON body, going through the response cache if there is one. Returns the body and whether it changed."""
+    if cache is not None:
+        return await cache.get_json(session, url)
+    async with session.get(url) as response:
+        return await response.json(), True
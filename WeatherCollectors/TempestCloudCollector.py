@@ -1,17 +1,35 @@
 #!/usr/bin/env python3
-import asyncio, aiohttp
+import asyncio, aiohttp, logging, dataclasses
 from typing import Optional
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
+from http_client import borrow_session
+import metrics
 from .WeatherCollector import WeatherCollector, WeatherStatus, Datapoint
+from .ResponseCache import ResponseCache, get_json, url_key
+from .HistoryStore import HistoryStore
+from .PollScheduler import PollScheduler
+
+logger = logging.getLogger(__name__)
+
+_POLL_TIME = metrics.histogram('collector_poll_seconds', 'Time taken to poll a REST API and parse the response.', ['collector']).labels('tempest_cloud')
+_POLL_ERRORS = metrics.counter('collector_poll_errors_total', 'Polls that failed.', ['collector']).labels('tempest_cloud')
 
 class TempestCloudCollector(WeatherCollector):
     """Collects weather data from Weatherflow's REST API. https://weatherflow.github.io/Tempest/api/"""
 
-    def __init__(self, station_name : str, token : str, poll_interval : float = 300.0):
+    def __init__(self, station_name : str, token : str, poll_interval : float = 300.0, session : Optional[aiohttp.ClientSession] = None,
+                 cache : Optional[ResponseCache] = None, replay_max_age : Optional[timedelta] = None,
+                 history : Optional[HistoryStore] = None, scheduler : Optional[PollScheduler] = None):
         super().__init__()
         self._station_name = station_name
         self._token = token
         self._poll_interval = poll_interval
+        self._scheduler = scheduler or PollScheduler('tempest_cloud', poll_interval, cost=2) # Decides when to poll. Backs off after errors.
+        self._session = session # Shared, pooled HTTP session. If None, a new session is made for every poll.
+        self._cache = cache # Optional on-disk response cache.
+        self._replay_max_age = replay_max_age # How old a cached status can be and still be replayed at startup.
+        self._last_status : Optional[WeatherStatus] = None
+        self.history = history # Optional store that new readings are recorded in.
         self._is_listening = False
 
     def _get_observation_url(self):
@@ -56,17 +74,15 @@ class TempestCloudCollector(WeatherCollector):
         """Retrieves the current WeatherConditions from the web."""
         
         # Request both the observations (current conditions) and the forecast at the same time.
-        async with aiohttp.ClientSession() as session:
-            obs_response, forecast_response = await asyncio.gather(
-                session.get(self._get_observation_url()),
-                session.get(self._get_forecast_url()),
+        async with borrow_session(self._session) as session:
+            (obs_body, obs_changed), (forecast_body, forecast_changed) = await asyncio.gather(
+                get_json(session, self._get_observation_url(), self._cache),
+                get_json(session, self._get_forecast_url(), self._cache),
             )
 
-            # Await both REST responses before processing them.
-            async with obs_response:
-                obs_body = await obs_response.json()
-            async with forecast_response:
-                forecast_body = await forecast_response.json()
+        # Nothing new upstream, so there's nothing to re-parse. The old readings have just been confirmed as current.
+        if not obs_changed and not forecast_changed and self._last_status is not None:
+            return dataclasses.replace(self._last_status, host_timestamp=datetime.now(timezone.utc))
 
         status = WeatherStatus()
         status.source = "tempest_cloud"
@@ -118,21 +134,52 @@ class TempestCloudCollector(WeatherCollector):
             icon = self._decode_icon(current_conditions['icon'], status.illuminance_lux.value if status.illuminance_lux else None)
             if icon is not None:
                 status.openweathermap_icon = Datapoint(icon, 0.25)
-         
+
+        self._last_status = status
+        if self.history is not None:
+            self.history.record(('tempest_cloud', None), status)
+        if self._cache is not None:
+            self._cache.store_status(self._get_cache_name(), status)
         return status
     
+    def _get_cache_name(self) -> str:
+        return 'tempest_cloud-' + url_key(self._get_observation_url())
+
+    def _replay_cached_status(self):
+        """Delivers the last good status from a previous run, so the display has something to show before the first poll finishes."""
+        if self._cache is None:
+            return
+        status = self._cache.load_status(self._get_cache_name(), self._replay_max_age)
+        if status is not None:
+            self._last_status = status
+            try:
+                self._deliver_update(status)
+            except Exception as e:
+                logger.error('Error delivering weather data: %s', e) # Don't let a callback stop polling before it starts.
+
     async def listen(self):
         """Starts polling for weather updates. This will run until cancelled."""
+        self._replay_cached_status()
 
         while True:
+            await self._scheduler.wait()
             try:
-                status = await self._get_current_weather_conditions()
-                self._deliver_update(status)
-                await asyncio.sleep(self._poll_interval)
+                with _POLL_TIME.time():
+                    status = await self._get_current_weather_conditions()
             except asyncio.CancelledError:
                 raise # Propagate task cancellations to the awaiter.
             except Exception as e:
-                print(f'Error getting weather data: {e}') # Suppress other types of exception.
+                _POLL_ERRORS.inc()
+                delay = self._scheduler.failed() # Back off, rather than retrying straight away.
+                logger.error('Error getting weather data: %s Retrying in %.0f seconds.', e, delay) # Suppress other types of exception.
+                continue
+
+            # The poll worked, whatever happens downstream. An error in a callback shouldn't make it back off.
+            self._scheduler.succeeded(status)
+            try:
+                self._deliver_update(status)
+            except Exception as e:
+                logger.error('Error delivering weather data: %s', e)
 
 async def debug_status():
     import sys, os
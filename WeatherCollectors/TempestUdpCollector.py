@@ -1,11 +1,36 @@
-import json
+import json, logging, re, time
 import asyncio
+from collections import Counter
 from datetime import datetime, timezone, timedelta
-from typing import Optional
-from .WeatherCollector import WeatherCollector, WeatherStatus, Datapoint
+from typing import Dict, Optional
+import metrics
+from .WeatherCollector import WeatherCollector, WeatherStatus, Datapoint, update_datapoint
+from .HistoryStore import HistoryStore
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson # Optional. Decodes packets noticeably faster than the json module on slow boards.
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 UDP_PORT = 50222
 OBS_ST_MAX_AGE = timedelta(seconds=120)
+MAX_STATIONS = 64 # Stop a LAN full of hubs (or garbage packets) from growing the station table without bound.
+RAIN_WINDOW = timedelta(minutes=10) # How far back to look when deciding between showers and steady rain.
+PRESSURE_TREND_WINDOW = timedelta(hours=3) # The standard period for a barometric tendency.
+PRESSURE_FALLING_MB = -1.6 # Change over PRESSURE_TREND_WINDOW below which the pressure is considered to be falling.
+
+_PACKET_TIME = metrics.histogram('tempest_udp_packet_seconds', 'Time taken to handle an accepted Tempest UDP datagram, including callbacks.', ['type'])
+_DROPPED_PACKETS = metrics.counter('tempest_udp_dropped_packets_total', 'Tempest UDP datagrams that were thrown away.', ['type'])
+
+# Finds the packet type in a raw datagram without decoding the rest of it.
+PACKET_TYPE_PATTERN = re.compile(rb'"type"\s*:\s*"([^"]*)"')
+
+# Every packet type the UDP API documents. Drops of anything else are counted as 'other', since the type comes off the
+# network and anything on the LAN could otherwise fill the counters with made up types.
+KNOWN_PACKET_TYPES = frozenset(("evt_precip", "evt_strike", "rapid_wind", "obs_air", "obs_sky", "obs_st", "device_status", "hub_status"))
 
 OBS_AIR_IDX = {
     "Time Epoch"                    : 0, # Seconds
@@ -56,6 +81,23 @@ OBS_ST_IDX = {
     "Report Interval"               : 17, # Minutes
 }
 
+CONDITION_ICON_NUMBERS = {
+    "clear sky": "01",
+    "scattered clouds": "02",
+    "cloudy": "03",
+    "shower rain": "09",
+    "rain": "10",
+    "lightning": "11",
+    "snow": "13",
+    "mist": "50",
+}
+
+PRECIPITATION_TYPES = {0: "none", 1: "rain", 2: "hail", 3: "hail"}
+
+# The numeric fields each kind of packet reports. Only these are recorded in the history when the packet arrives.
+OBS_AIR_FIELDS = ('temp_c', 'humidity_pct', 'pressure_mb', 'lightning_count', 'lightning_distance')
+OBS_SKY_FIELDS = ('illuminance_lux', 'uv_index', 'wind_avg_mps', 'rain_mm')
+
 ICONS = (
     "clear sky",
     "scattered clouds",
@@ -68,50 +110,95 @@ ICONS = (
 )
 
 
+class _StationState:
+    """Everything known about a single device. Several devices can report through one hub, and each keeps its own readings."""
+    __slots__ = ('status', 'last_obs_st')
+
+    def __init__(self, station_id : Optional[str]):
+        self.status = WeatherStatus(station_id=station_id)
+        self.last_obs_st : Optional[datetime] = None # When this device last sent an obs_st packet.
+
+
 class TempestUdpCollector(WeatherCollector):
-    def __init__(self, config : dict):
+    def __init__(self, config : dict, port : int = UDP_PORT, host : str = "0.0.0.0", history : Optional[HistoryStore] = None):
         super().__init__()
-        self.status = WeatherStatus()
+        self.history = history if history is not None else HistoryStore() # Condition inference relies on it, so always have one.
+        self.status = WeatherStatus() # The most recently updated station's status.
+        self._stations : Dict[Optional[str], _StationState] = {}
         self._udp_transport = None
         self._config = config
+        self._local_addr = (host, port)
+
+        # The allowed source lists are checked for every packet, so turn them into sets up front.
+        def allowed_set(key):
+            return frozenset(config[key]) if config is not None and key in config else None
+        self._allowed_hub_ips = allowed_set('allowed_hub_ips')
+        self._allowed_hub_sns = allowed_set('allowed_hub_sns')
+        self._allowed_station_sns = allowed_set('allowed_station_sns')
+
+        # Only packet types with a handler are fully decoded. Everything else is dropped based on its raw bytes.
+        self._packet_handlers = {
+            "obs_st": self._handle_obs_st_packet,
+            "obs_air": self._handle_obs_air_packet,
+            "obs_sky": self._handle_obs_sky_packet,
+        }
+        self._handled_types = {t.encode('ascii'): t for t in self._packet_handlers}
+        self._known_types = {t.encode('ascii'): t for t in KNOWN_PACKET_TYPES}
+        self.accepted_packets = Counter() # Per packet type, packets that were decoded and processed.
+        self.dropped_packets = Counter() # Per known packet type, plus 'other' and 'malformed', packets that were thrown away.
+        self._packet_time = {t: _PACKET_TIME.labels(t) for t in self._packet_handlers}
+        self._dropped = {t: _DROPPED_PACKETS.labels(t) for t in KNOWN_PACKET_TYPES | {'other', 'malformed'}} # The only labels ever exported.
 
     def _decode_precipitation(self, v) -> str:
         """Converts the Weatherflow precipitation type code to a human readable string."""
-        return {0: "none", 1: "rain", 2: "hail", 3: "hail"}.get(v) or "none" # 3 == rain|hail, but it's experimental and rare, so just call it hail.
-
-    def _handle_obs_air(self, obs, idx = OBS_AIR_IDX):
-        self.status.source = "obs_air"
-        self.status.host_timestamp = datetime.now(timezone.utc)
-        self.status.source_timestamp = datetime.fromtimestamp(obs[idx["Time Epoch"]], tz=timezone.utc)
-        self.status.temp_c = Datapoint(obs[idx["Air Temperature"]], 1.0) # Air temp and other direct readings are reliable, so quality=1.0
-        self.status.humidity_pct = Datapoint(obs[idx["Relative Humidity"]], 1.0)
-        self.status.pressure_mb = Datapoint(obs[idx["Station Pressure"]], 1.0)
-        self.status.lightning_count = Datapoint(obs[idx["Lightning Strike Count"]], 1.0)
-        self.status.lightning_distance = Datapoint(obs[idx["Lightning Strike Avg Distance"]], 1.0)
+        return PRECIPITATION_TYPES.get(v) or "none" # 3 == rain|hail, but it's experimental and rare, so just call it hail.
+
+    def _source_timestamp(self, ws : WeatherStatus, epoch) -> datetime:
+        """Converts a packet's epoch to a datetime, reusing the status's existing one if it hasn't changed."""
+        if ws.source_timestamp is not None and ws.source_timestamp.timestamp() == epoch:
+            return ws.source_timestamp
+        return datetime.fromtimestamp(epoch, tz=timezone.utc)
+
+    def _handle_obs_air(self, ws : WeatherStatus, obs, now : datetime, idx = OBS_AIR_IDX):
+        ws.source = "obs_air"
+        ws.host_timestamp = now
+        ws.source_timestamp = self._source_timestamp(ws, obs[idx["Time Epoch"]])
+        ws.temp_c = update_datapoint(ws.temp_c, obs[idx["Air Temperature"]], 1.0) # Air temp and other direct readings are reliable, so quality=1.0
+        ws.humidity_pct = update_datapoint(ws.humidity_pct, obs[idx["Relative Humidity"]], 1.0)
+        ws.pressure_mb = update_datapoint(ws.pressure_mb, obs[idx["Station Pressure"]], 1.0)
+        ws.lightning_count = update_datapoint(ws.lightning_count, obs[idx["Lightning Strike Count"]], 1.0)
+        ws.lightning_distance = update_datapoint(ws.lightning_distance, obs[idx["Lightning Strike Avg Distance"]], 1.0)
+        self.history.record(self._history_source(ws), ws, OBS_AIR_FIELDS)
         
-    def _handle_obs_sky(self, obs, idx = OBS_SKY_IDX):
-        self.status.source = "obs_sky"
-        self.status.host_timestamp = datetime.now(timezone.utc)
-        self.status.source_timestamp = datetime.fromtimestamp(obs[idx["Time Epoch"]], tz=timezone.utc)
-        self.status.illuminance_lux = Datapoint(obs[idx["Illuminance"]], 1.0)
-        self.status.uv_index = Datapoint(obs[idx["UV"]], 1.0)
-        self.status.wind_avg_mps = Datapoint(obs[idx["Wind Avg"]], 1.0)
-        self.status.rain_mm = Datapoint(obs[idx["Rain amount"]], 0.5) # Instantaneous rain amount is a bit noisy.
-        self.status.precip_type = Datapoint(self._decode_precipitation(obs[idx["Precipitation Type"]]), 1.0)
+    def _handle_obs_sky(self, ws : WeatherStatus, obs, now : datetime, idx = OBS_SKY_IDX):
+        ws.source = "obs_sky"
+        ws.host_timestamp = now
+        ws.source_timestamp = self._source_timestamp(ws, obs[idx["Time Epoch"]])
+        ws.illuminance_lux = update_datapoint(ws.illuminance_lux, obs[idx["Illuminance"]], 1.0)
+        ws.uv_index = update_datapoint(ws.uv_index, obs[idx["UV"]], 1.0)
+        ws.wind_avg_mps = update_datapoint(ws.wind_avg_mps, obs[idx["Wind Avg"]], 1.0)
+        ws.rain_mm = update_datapoint(ws.rain_mm, obs[idx["Rain amount"]], 0.5) # Instantaneous rain amount is a bit noisy.
+        ws.precip_type = update_datapoint(ws.precip_type, self._decode_precipitation(obs[idx["Precipitation Type"]]), 1.0)
+        self.history.record(self._history_source(ws), ws, OBS_SKY_FIELDS)
         
-    def _handle_obs_st(self, obs):
+    def _handle_obs_st(self, ws : WeatherStatus, obs, now : datetime):
         # obs_st packets contain readings from both obs_air and obs_sky.
         # We can reuse the same handlers, with the indexes from OBS_ST_IDX.
-        self._handle_obs_air(obs, idx = OBS_ST_IDX)
-        self._handle_obs_sky(obs, idx = OBS_ST_IDX)
-        self.status.source = "obs_st"
+        self._handle_obs_air(ws, obs, now, idx = OBS_ST_IDX)
+        self._handle_obs_sky(ws, obs, now, idx = OBS_ST_IDX)
+        ws.source = "obs_st"
+
+    def _history_source(self, ws : WeatherStatus):
+        """The key a station's readings are recorded under in the history store."""
+        return ('tempest_udp', ws.station_id)
 
     def _calculate_condition_string(self, ws : WeatherStatus) -> Optional[Datapoint[str]]:
         """
-        Determines the condition_string based on the current readings.
-        This is mostly a wild guess at the moment. Good condition estimates
-        require far more inputs, and/or historical data.
+        Determines the condition_string based on the current readings and recent history.
+        This is still mostly a guess. Good condition estimates require far more inputs.
         """
+        source = self._history_source(ws)
+        now = ws.source_timestamp.timestamp() if ws.source_timestamp is not None else None
 
         # First, see if there should be a lightning icon.
         if (ws.lightning_count and ws.lightning_count.value > 0
@@ -120,7 +207,10 @@ class TempestUdpCollector(WeatherCollector):
 
         # Next, consider precipication.
         if ws.precip_type and ws.precip_type.value == "rain":
-            if ws.rain_mm is not None and ws.rain_mm.value < 0.5:
+            # Judge the intensity on the last few minutes of rain, rather than a single noisy reading.
+            # Each reading is already mm/minute, so the mean is the recent rate.
+            rain_rate = self.history.mean(source, 'rain_mm', RAIN_WINDOW, now) if ws.rain_mm is not None else None
+            if rain_rate is not None and rain_rate < 0.5:
                 return Datapoint("shower rain", 0.5)
             else:
                 return Datapoint("rain", 1.0)
@@ -135,113 +225,178 @@ class TempestUdpCollector(WeatherCollector):
                 if ws.illuminance_lux.value > 100000:
                     return Datapoint("clear sky", 0.0) # If it's bright enough, we can be pretty sure it's clear.
                 elif ws.illuminance_lux.value > 5000:
+                    if self._is_pressure_falling(source, now):
+                        return Datapoint("cloudy", -1.0) # Falling pressure usually means weather is moving in.
                     return Datapoint("scattered clouds", -1.0) # Less reliable when it's night bright. Could be dawn/dusk/winter.
                 elif ws.illuminance_lux.value > 500:
                     return Datapoint("cloudy", -1.0)
                 else:
                     return None # If its completely dark outside, there's no way to know cloud cover.
 
+    def _is_pressure_falling(self, source, now : Optional[float]) -> bool:
+        """Returns True if the station's pressure has been dropping over the last few hours."""
+        if now is None:
+            return False
+        series = self.history.series(source, 'pressure_mb')
+        if series is None:
+            return False
+        times, _ = series.window(now - PRESSURE_TREND_WINDOW.total_seconds())
+        if not times or times[-1] - times[0] < PRESSURE_TREND_WINDOW.total_seconds() / 2:
+            return False # Not enough history yet for a trend to mean anything.
+        slope = series.slope(now - PRESSURE_TREND_WINDOW.total_seconds())
+        return slope is not None and slope * PRESSURE_TREND_WINDOW.total_seconds() < PRESSURE_FALLING_MB
+
     def _calculate_openweathermap_icon(self, ws : WeatherStatus) -> Optional[Datapoint[str]]:
         """
         Use the condition_string to determines the closest openweathermap_icon.
         """
         if not ws.condition_string or not ws.condition_string.value:
             return None
-        mapping = {
-            "clear sky": "01",
-            "scattered clouds": "02",
-            "cloudy": "03",
-            "shower rain": "09",
-            "rain": "10",
-            "lightning": "11",
-            "snow": "13",
-            "mist": "50",
-        }
 
-        icon_number = mapping[ws.condition_string.value]
+        icon_number = CONDITION_ICON_NUMBERS[ws.condition_string.value]
         icon_daynight = "d" if ws.illuminance_lux is None or ws.illuminance_lux.value > 5000 else "n"
         return Datapoint(icon_number + icon_daynight, ws.condition_string.quality)
 
     def _update_condition_and_icon(self, ws : WeatherStatus):
-        ws.condition_string = self._calculate_condition_string(ws)
-        ws.openweathermap_icon = self._calculate_openweathermap_icon(ws)
+        # Keep the existing Datapoints when nothing changed, so downstream consumers can tell by identity.
+        condition_string = self._calculate_condition_string(ws)
+        if condition_string != ws.condition_string:
+            ws.condition_string = condition_string
+        openweathermap_icon = self._calculate_openweathermap_icon(ws)
+        if openweathermap_icon != ws.openweathermap_icon:
+            ws.openweathermap_icon = openweathermap_icon
 
     def _is_packet_from_allowed_source(self, msg, addr) -> bool:
-        if self._config is None:
-            return True # No filtering configured.
-        
         try:
-            if 'allowed_hub_ips' in self._config:
-                if not isinstance(addr, tuple) or addr[0] not in self._config['allowed_hub_ips']:
-                    print(f'Received message from IP not in allowed list: {addr}')
+            if self._allowed_hub_ips is not None:
+                ip = addr[0] if isinstance(addr, tuple) else addr
+                if ip not in self._allowed_hub_ips:
+                    logger.info('Received message from IP not in allowed list: %s', ip, extra={'rate_key': ('rejected_ip', ip)})
                     return False
                 
-            if 'allowed_hub_sns' in self._config:
+            if self._allowed_hub_sns is not None:
                 hub_sn = msg.get('hub_sn')
-                if hub_sn is None or hub_sn not in self._config['allowed_hub_sns']:
-                    print(f'Received message from hub_sn not in allowed list: {hub_sn}')
+                if hub_sn not in self._allowed_hub_sns:
+                    logger.info('Received message from hub_sn not in allowed list: %s', hub_sn, extra={'rate_key': ('rejected_hub_sn', hub_sn)})
                     return False
                 
-            if 'allowed_station_sns' in self._config:
+            if self._allowed_station_sns is not None:
                 station_sn = msg.get('serial_number')
-                if station_sn is None or station_sn not in self._config['allowed_station_sns']:
-                    print(f'Received message from station_sn not in allowed list: {station_sn}')
+                if station_sn not in self._allowed_station_sns:
+                    logger.info('Received message from station_sn not in allowed list: %s', station_sn, extra={'rate_key': ('rejected_station_sn', station_sn)})
                     return False
         except Exception as e:
-            print(f'Error checking allowed source lists: {e}')
+            logger.error('Error checking allowed source lists: %s', e)
             return False
     
         return True
 
-    def _process_packet(self, msg):
-        t = msg.get("type")
+    def _get_station(self, msg, addr) -> _StationState:
+        """
+        Finds the state for the device that sent a packet, creating it if this is the first packet from that device.
+        Only hub-level packets have no serial number of their own, so they fall back to the hub's.
+        """
+        station_id = msg.get('serial_number') or msg.get('hub_sn') or (addr[0] if isinstance(addr, tuple) else None)
+        state = self._stations.get(station_id)
+        if state is None:
+            if len(self._stations) >= MAX_STATIONS:
+                # Forget the station that's gone the longest without an update.
+                stalest = min(self._stations, key=lambda k: self._stations[k].status.host_timestamp or datetime.min.replace(tzinfo=timezone.utc))
+                del self._stations[stalest]
+                self._forget_station(stalest)
+            state = self._stations[station_id] = _StationState(station_id)
+        return state
+
+    def _is_obs_st_fresh(self, state : _StationState, now : datetime) -> bool:
+        """Returns True if the device sent an obs_st packet recently enough that obs_air and obs_sky packets should be ignored."""
+        return state.last_obs_st is not None and (now - state.last_obs_st) <= OBS_ST_MAX_AGE
+
+    def _handle_obs_st_packet(self, state : _StationState, obs, now : datetime) -> bool:
+        self._handle_obs_st(state.status, obs, now)
+        state.last_obs_st = now
+        return True
+
+    def _handle_obs_air_packet(self, state : _StationState, obs, now : datetime) -> bool:
+        if self._is_obs_st_fresh(state, now):
+            return False
+        self._handle_obs_air(state.status, obs, now)
+        return True
+
+    def _handle_obs_sky_packet(self, state : _StationState, obs, now : datetime) -> bool:
+        if self._is_obs_st_fresh(state, now):
+            return False
+        self._handle_obs_sky(state.status, obs, now)
+        return True
+
+    def _process_packet(self, msg, addr = None):
+        handler = self._packet_handlers.get(msg.get("type"))
+        if handler is None:
+            return False # Not a packet type we use.
+
         obs = msg.get("obs")
         if not obs:
-            return
+            return False
 
         # obs is a list of lists. Unwrap it.
-        obs = obs[0]
-
-        if t == "obs_st":
-            self._handle_obs_st(obs)
-        elif t == "obs_air":
-            if (self.status.source != "obs_st"
-              or self.status.host_timestamp is None or
-              (datetime.now(timezone.utc) - self.status.host_timestamp) > OBS_ST_MAX_AGE):
-                self._handle_obs_air(obs)
-        elif t == "obs_sky" and self.status.source != "obs_st":
-            if (self.status.source != "obs_st"
-              or self.status.host_timestamp is None or
-              (datetime.now(timezone.utc) - self.status.host_timestamp) > OBS_ST_MAX_AGE):
-                self._handle_obs_sky(obs)
-        else:
+        state = self._get_station(msg, addr)
+        if not handler(state, obs[0], datetime.now(timezone.utc)):
             return False # No new data.
 
-        self._update_condition_and_icon(self.status)
+        self._update_condition_and_icon(state.status)
+        self.status = state.status
         return True # New data in self.status.
 
+    def _classify_packet(self, data : bytes) -> Optional[str]:
+        """Returns the type of a raw packet if it has a handler, otherwise None. Counts the packets that are dropped."""
+        match = PACKET_TYPE_PATTERN.search(data)
+        if match is None:
+            self._drop('malformed')
+            return None
+        packet_type = self._handled_types.get(match.group(1))
+        if packet_type is None:
+            self._drop(self._known_types.get(match.group(1), 'other'))
+        return packet_type
+
+    def _drop(self, packet_type : str):
+        self.dropped_packets[packet_type] += 1
+        self._dropped[packet_type].inc()
+
+    def _handle_datagram(self, data : bytes, addr):
+        """Triages, decodes and processes a single datagram, delivering an update if it contained new data."""
+        start = time.perf_counter()
+        packet_type = self._classify_packet(data)
+        if packet_type is None:
+            return # Not a packet type we use. Don't bother decoding it.
+
+        try:
+            msg = _json_loads(data)
+        except ValueError:
+            self._drop('malformed')
+            return # Malformed packet, ignore.
+
+        if not self._is_packet_from_allowed_source(msg, addr):
+            self._drop(packet_type)
+            return # Packet not from an allowed source.
+
+        self.accepted_packets[packet_type] += 1
+
+        # Process the packet and deliver the station's updated status to callbacks if there is new data.
+        if self._process_packet(msg, addr):
+            self._deliver_update(self.status)
+        self._packet_time[packet_type].observe(time.perf_counter() - start)
+
     class _DatagramProtocol(asyncio.DatagramProtocol):
         def __init__(self, collector):
             self.collector = collector
 
         def datagram_received(self, data, addr):
-            try:
-                msg = json.loads(data)
-            except json.JSONDecodeError:
-                return # Malformed packet, ignore.
-            
-            if not self.collector._is_packet_from_allowed_source(msg, addr):
-                return # Packet not from an allowed source.
-
-            # Process the packet and deliver updates to callbacks if there is new data.
-            if self.collector._process_packet(msg):
-                self.collector._deliver_update(self.collector.status)
+            self.collector._handle_datagram(data, addr)
 
     async def listen(self):
         """Starts listening for UDP packets from the Tempest. This will run until cancelled."""
         self._udp_transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
             lambda: self._DatagramProtocol(self),
-            local_addr=("0.0.0.0", UDP_PORT),
+            local_addr=self._local_addr,
         )
 
         while True:
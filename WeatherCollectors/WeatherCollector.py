@@ -1,18 +1,34 @@
 from typing import Callable, List
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from datetime import datetime
-from typing import Generic, Optional, TypeVar
+from typing import Any, Dict, Generic, Optional, TypeVar
+import time
+import metrics
+
+_DELIVERY_TIME = metrics.histogram('collector_callback_fanout_seconds', 'Time spent calling every callback registered on a collector.', ['collector'])
 
 DatapointT = TypeVar("DatapointT")
-@dataclass
+@dataclass(slots=True)
 class Datapoint(Generic[DatapointT]):
+    """
+    A single reading and how much it can be trusted.
+    Datapoints are shared between statuses instead of copied, so never modify one in place. Replace it instead.
+    """
     value: DatapointT
     quality: float = 0.0 # Negative for untrusted values, 0.0 for acceptable, positive for very reliable.
 
 
-@dataclass
+def update_datapoint(current : Optional[Datapoint], value, quality : float) -> Datapoint:
+    """Returns current if it already holds the given value and quality, so unchanged readings don't allocate a new Datapoint."""
+    if current is not None and current.value == value and current.quality == quality:
+        return current
+    return Datapoint(value, quality)
+
+
+@dataclass(slots=True)
 class WeatherStatus:
     source: Optional[str] = None # Weatherflow: ("obs_air", "obs_sky", "obs_st"), OpenWeatherMap: "openweathermap", etc.
+    station_id: Optional[str] = None # Identifies the station when a collector hears from more than one. e.g. the Tempest hub serial number.
     host_timestamp: Optional[datetime] = None
     source_timestamp: Optional[datetime] = None
     
@@ -36,10 +52,65 @@ class WeatherStatus:
     condition_string: Optional[Datapoint[str]] = None
     openweathermap_icon: Optional[Datapoint[str]] = None
 
+    def copy(self) -> 'WeatherStatus':
+        """Returns a shallow copy. Cheap, since the Datapoints are shared rather than copied."""
+        other = WeatherStatus.__new__(WeatherStatus)
+        for name in _STATUS_SLOTS:
+            setattr(other, name, getattr(self, name))
+        return other
+
+    def diff(self, other : Optional['WeatherStatus']) -> List[str]:
+        """Returns the names of the fields that differ from another status."""
+        if other is None:
+            return [name for name in _STATUS_SLOTS if getattr(self, name) is not None]
+        changed = []
+        for name in _STATUS_SLOTS:
+            mine, theirs = getattr(self, name), getattr(other, name)
+            if mine is not theirs and mine != theirs:
+                changed.append(name)
+        return changed
+
+
+_STATUS_SLOTS = WeatherStatus.__slots__
+
+
+def status_to_dict(status : WeatherStatus) -> Dict[str, Any]:
+    """Converts a WeatherStatus into plain types that can be written out as JSON."""
+    d = {}
+    for f in fields(WeatherStatus):
+        v = getattr(status, f.name)
+        if v is None:
+            continue
+        elif isinstance(v, Datapoint):
+            d[f.name] = [v.value, v.quality]
+        elif isinstance(v, datetime):
+            d[f.name] = v.isoformat()
+        else:
+            d[f.name] = v
+    return d
+
+
+def status_from_dict(d : Dict[str, Any]) -> WeatherStatus:
+    """Rebuilds a WeatherStatus from the output of status_to_dict."""
+    status = WeatherStatus()
+    for f in fields(WeatherStatus):
+        v = d.get(f.name)
+        if v is None:
+            continue
+        elif f.name in ('host_timestamp', 'source_timestamp'):
+            setattr(status, f.name, datetime.fromisoformat(v))
+        elif isinstance(v, list):
+            setattr(status, f.name, Datapoint(v[0], v[1]))
+        else:
+            setattr(status, f.name, v)
+    return status
+
 
 class WeatherCollector:
     def __init__(self):
         self._callbacks : List[Callable[[WeatherStatus], None]] = []
+        self._forget_callbacks : List[Callable[[Optional[str]], None]] = []
+        self._delivery_time = _DELIVERY_TIME.labels(type(self).__name__)
 
     async def listen(self):
         """Client code calls this override to request that the collector to start collecting data and delivering callbacks."""
@@ -55,8 +126,25 @@ class WeatherCollector:
         if callback in self._callbacks:
             self._callbacks.remove(callback)
 
+    def register_forget_callback(self, callback):
+        """Registers a callback for when the collector forgets a station. The callback will be called with the station_id as an argument."""
+        if callback not in self._forget_callbacks:
+            self._forget_callbacks.append(callback)
+
+    def unregister_forget_callback(self, callback):
+        """Unregisters a previously registered forget callback."""
+        if callback in self._forget_callbacks:
+            self._forget_callbacks.remove(callback)
+
+    def _forget_station(self, station_id : Optional[str]):
+        """Tells registered callbacks that a station's data is gone. Collectors that track many stations call this when they drop one."""
+        for callback in self._forget_callbacks:
+            callback(station_id)
+
     def _deliver_update(self, status : WeatherStatus):
         """Delivers a new weather update to all registered callbacks. This should be called by the collector implementation when new data is received."""
+        start = time.perf_counter()
         for callback in self._callbacks:
             if callback is not None:
                 callback(status)
+        self._delivery_time.observe(time.perf_counter() - start)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Packs every icon and glyph into one indexed file, so starting up and rendering read one memory-mapped file instead of
+opening dozens of tiny gifs on the SD card. Without a bundle, or with one that's older than the loose files, everything
+is read from the loose files as before. Rebuild it after changing an asset.
+
+Temperature images aren't bundled. The renderer can only play a file, so they'd have to be copied back out onto the SD
+card before they could be shown, which saves nothing over rendering them into the cache in the first place.
+
+    ./asset_bundle.py
+"""
+import argparse, io, json, logging, mmap, os, struct, sys
+from typing import Dict, List, Optional, Tuple
+import config
+
+logger = logging.getLogger(__name__)
+
+# A bundle is a header, the contents of every file back to back, then a JSON index of where each file is.
+BUNDLE_HEADER = struct.Struct('<4sIQI') # Magic, version, index offset, index length.
+BUNDLE_MAGIC = b'UHWB'
+BUNDLE_VERSION = 2
+SOURCE_DIRS = ('icons', 'characters')
+
+class AssetBundle:
+    """
+    A read-only view of a bundle. Files are served as memoryviews of the mapped bundle, so nothing is copied until
+    something decodes it. Entries are looked up by their path relative to the program's directory, e.g. 'icons/01d.gif'.
+    """
+
+    def __init__(self, path : str, data : mmap.mmap, index : dict):
+        self.path = path
+        self._data = data
+        self._view = memoryview(data)
+        self._entries : Dict[str, Tuple[int, int, int, int]] = {name: tuple(entry) for name, entry in index['entries'].items()} # name -> (offset, length, size, mtime_ns)
+        self._dirs : Dict[str, List[str]] = index['dirs'] # Source directory -> names of the gifs it held.
+        self._dir_mtimes : Dict[str, int] = index['dir_mtimes'] # Source directory -> its mtime_ns when the bundle was built.
+
+    @classmethod
+    def open(cls, path : str) -> Optional['AssetBundle']:
+        """Maps a bundle. Returns None if it's missing, unreadable, or its source directories have changed since it was built."""
+        try:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) # The map keeps its own handle, so the file can close.
+        except (OSError, ValueError):
+            return None
+        try:
+            magic, version, index_offset, index_length = BUNDLE_HEADER.unpack_from(data, 0)
+            if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+                raise ValueError(f'unsupported bundle version {version}')
+            bundle = cls(path, data, json.loads(data[index_offset:index_offset + index_length]))
+        except (struct.error, ValueError, KeyError, TypeError) as e:
+            logger.warning('Ignoring unreadable asset bundle %s: %s', path, e)
+            data.close()
+            return None
+        if not bundle.is_current():
+            logger.info('Asset bundle %s is out of date. Reading loose files instead.', path)
+            bundle.close()
+            return None
+        return bundle
+
+    def is_current(self) -> bool:
+        """
+        Returns True if no source directory has changed since the bundle was built. Adding, removing or replacing a gif
+        changes its directory's mtime, so this costs one stat per directory rather than one per file. A file overwritten in
+        place isn't noticed.
+        """
+        for directory, mtime_ns in self._dir_mtimes.items():
+            try:
+                if os.stat(directory).st_mtime_ns != mtime_ns:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def get(self, path : str) -> Optional[memoryview]:
+        """Returns a view of a bundled file's contents, or None if it isn't bundled."""
+        entry = self._entries.get(_entry_name(path))
+        if entry is None:
+            return None
+        offset, length = entry[0], entry[1]
+        return self._view[offset:offset + length]
+
+    def stat(self, path : str) -> Optional[Tuple[int, int]]:
+        """Returns the (size, mtime_ns) a bundled source file had when the bundle was built."""
+        entry = self._entries.get(_entry_name(path))
+        return (entry[2], entry[3]) if entry is not None else None
+
+    def list_dir(self, directory : str) -> Optional[List[str]]:
+        """Returns the gifs in a bundled source directory, or None if the directory wasn't bundled."""
+        names = self._dirs.get(_entry_name(directory))
+        return list(names) if names is not None else None
+
+    def close(self):
+        self._view.release()
+        self._data.close()
+
+
+class _ViewReader(io.RawIOBase):
+    """A read-only file over a memoryview, so Pillow can decode straight out of the bundle."""
+
+    def __init__(self, view : memoryview):
+        self._view = view
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        count = max(0, min(len(buffer), len(self._view) - self._position))
+        buffer[:count] = self._view[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset : int, whence : int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+def _entry_name(path : str) -> str:
+    return os.path.normpath(os.path.relpath(path)).replace(os.sep, '/')
+
+
+_bundle = None
+_bundle_loaded = False
+
+def get_bundle() -> Optional[AssetBundle]:
+    """Returns the bundle configured in config.py, mapping it on first use. Returns None if there's no usable bundle."""
+    global _bundle, _bundle_loaded
+    if not _bundle_loaded:
+        _bundle_loaded = True
+        path = getattr(config, 'asset_bundle_path', None)
+        _bundle = AssetBundle.open(path) if path else None
+    return _bundle
+
+
+def open_image(path : str):
+    """Opens an image from the bundle if it's there, otherwise from the loose file."""
+    from PIL import Image # Only needed when decoding.
+    bundle = get_bundle()
+    view = bundle.get(path) if bundle is not None else None
+    return Image.open(_ViewReader(view) if view is not None else path)
+
+
+def list_gifs(directory : str) -> List[str]:
+    """Returns the names of the gifs in a directory, sorted, without listing the directory if it's bundled."""
+    bundle = get_bundle()
+    names = bundle.list_dir(directory) if bundle is not None else None
+    if names is None:
+        names = sorted(name for name in os.listdir(directory) if name.endswith('.gif'))
+    return names
+
+
+def stat(path : str) -> Tuple[int, int]:
+    """Returns (size, mtime_ns) of an asset file, without touching the disk if it's bundled."""
+    bundle = get_bundle()
+    result = bundle.stat(path) if bundle is not None else None
+    if result is None:
+        st = os.stat(path)
+        result = (st.st_size, st.st_mtime_ns)
+    return result
+
+
+def build_bundle(path : str, directories = SOURCE_DIRS) -> int:
+    """
+    Writes a bundle of every gif in the source directories, keyed by name. The bundle is written to a temporary file
+    first, so a running program never maps a half-written one. Returns how many files were bundled.
+    """
+    entries, dirs, dir_mtimes, chunks = {}, {}, {}, []
+    offset = BUNDLE_HEADER.size
+
+    def add(name : str, data : bytes, size : int, mtime_ns : int):
+        nonlocal offset
+        entries[name] = (offset, len(data), size, mtime_ns)
+        chunks.append(data)
+        offset += len(data)
+
+    for directory in directories:
+        dir_mtimes[_entry_name(directory)] = os.stat(directory).st_mtime_ns # Before listing, so a change during the build is caught next time.
+        names = dirs[_entry_name(directory)] = sorted(name for name in os.listdir(directory) if name.endswith('.gif'))
+        for name in names:
+            file_path = os.path.join(directory, name)
+            with open(file_path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                add(_entry_name(file_path), f.read(), st.st_size, st.st_mtime_ns)
+
+    index = json.dumps({'entries': entries, 'dirs': dirs, 'dir_mtimes': dir_mtimes}, separators=(',', ':')).encode('utf-8')
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, offset, len(index)))
+        f.writelines(chunks)
+        f.write(index)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(entries)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Packs every icon and glyph into one bundle.')
+    parser.add_argument('--output', help='Where to write the bundle. Defaults to asset_bundle_path in config.py.')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    os.chdir(os.path.dirname(os.path.abspath(__file__))) # Assets are loaded relative to the repo.
+    output = args.output or getattr(config, 'asset_bundle_path', None)
+    if not output:
+        parser.error('No --output given and no asset_bundle_path in config.py.')
+
+    count = build_bundle(output)
+    print(f'Bundled {count} files into {output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Pre-renders every asset for one display, at the display's own resolution and with its orientation and brightness baked
+in, so the renderer only has to push pixels. Packs are built ahead of time and cached on disk.
+
+    ./asset_pack.py           # Build the pack for the settings in config.py.
+"""
+import argparse, io, logging, os, shutil, sys, threading
+from typing import Dict, List, Optional
+from render_cache import fingerprint
+import asset_bundle
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_BAKE_TIME = metrics.histogram('asset_pack_bake_seconds', 'Time taken to bake an icon for the display.')
+
+ASSET_PACK_VERSION = 1 # Bump whenever baking changes what it produces, to invalidate every pack.
+HAT_SIZES = {'Unicorn HAT': 8, 'Unicorn HAT HD': 16} # Pixels along each side of the display.
+DEFAULT_FRAME_DURATION = 100 # Milliseconds. What a gif frame without a delay is shown for.
+
+# Gif2UnicornHat's orientation is a number of quarter turns. These are assumed to be clockwise, to match how it rotates.
+ORIENTATION_TRANSPOSES = {0: None, 1: 'ROTATE_270', 2: 'ROTATE_180', 3: 'ROTATE_90'}
+
+class AssetPack:
+    """
+    A directory of icons and temperature images baked for one display size, orientation and brightness. The directory is
+    named after a fingerprint of those settings and the source images, so changing any of them starts a fresh pack.
+    Gifs in the pack are meant to be shown at full brightness with no rotation.
+    """
+
+    def __init__(self, cache_dir : str, size : int, orientation : int, brightness : float, icon_dir : str = 'icons'):
+        self.size = size
+        self.orientation = orientation
+        self.brightness = brightness
+        self._icon_dir = icon_dir
+        self._assets_dir = os.path.join(cache_dir, 'assets')
+        icon_files = [os.path.join(icon_dir, name) for name in self._icon_names()]
+        self.key = fingerprint(ASSET_PACK_VERSION, size, orientation, brightness, files=icon_files)
+        self.pack_dir = os.path.join(self._assets_dir, self.key)
+        self._lock = threading.Lock() # Icons can be baked on demand while the whole set is being built on another thread.
+
+    def __getstate__(self):
+        # Packs are sent to render worker processes, which get a lock of their own.
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def contains(self, filename : str) -> bool:
+        """Returns True if the file belongs to this pack, so is already baked for the display."""
+        pack_dir = os.path.abspath(self.pack_dir)
+        return os.path.commonpath([pack_dir, os.path.abspath(filename)]) == pack_dir
+
+    def icon(self, filename : str) -> str:
+        """Returns the baked version of an icon, baking it first if needed. Blocks on the disk, so call it from a worker thread."""
+        path = os.path.join(self.pack_dir, 'icons', os.path.basename(filename))
+        if os.path.exists(path):
+            return path
+        with self._lock:
+            if not os.path.exists(path): # Someone else may have baked it while we waited.
+                with _BAKE_TIME.time():
+                    self._bake_icon(filename, path)
+        return path
+
+    def build_icons(self) -> int:
+        """Bakes every icon that isn't baked yet and removes packs for other settings. Returns how many icons were baked."""
+        self._remove_other_packs()
+        baked = 0
+        for name in self._icon_names():
+            if not os.path.exists(os.path.join(self.pack_dir, 'icons', name)):
+                try:
+                    self.icon(os.path.join(self._icon_dir, name))
+                    baked += 1
+                except Exception as ex:
+                    logger.error('Error baking icon %s: %s', name, ex)
+        if baked:
+            logger.info('Baked %d icons. pack=%s', baked, self.pack_dir)
+        return baked
+
+    def render_temperature(self, temperature : int) -> bytes:
+        """Renders a temperature image at the display's resolution, baked for the display, and encodes it as a gif."""
+        import temperature_image # Pulls in Pillow.
+        if self.size >= 16:
+            img = temperature_image.create_temperature_image_hd(temperature)
+        else:
+            img = temperature_image.create_temperature_image(temperature)
+        buffer = io.BytesIO()
+        self.bake(img).save(buffer, format='GIF')
+        return buffer.getvalue()
+
+    def render_temperatures(self, temperatures : List[int]) -> Dict[int, bytes]:
+        """Renders a list of temperature images in one pass, baked for the display, and encodes each as a gif."""
+        import temperature_image # Pulls in Pillow.
+        if self.size >= 16:
+            # The HD images are drawn one at a time. There's no strip renderer for them.
+            images = {temperature: temperature_image.create_temperature_image_hd(temperature) for temperature in temperatures}
+        else:
+            images = temperature_image.create_temperature_images(temperatures)
+        rendered = {}
+        for temperature, img in images.items():
+            buffer = io.BytesIO()
+            self.bake(img).save(buffer, format='GIF')
+            rendered[temperature] = buffer.getvalue()
+        return rendered
+
+    def bake(self, img):
+        """Returns a copy of an image scaled to the display, rotated to its orientation and dimmed to its brightness."""
+        from PIL import Image # Only needed when baking.
+
+        # Flatten transparency onto black, which is what an unlit LED looks like anyway.
+        rgba = img.convert('RGBA')
+        flat = Image.new('RGB', rgba.size, (0, 0, 0))
+        flat.paste(rgba, mask=rgba)
+
+        if flat.size != (self.size, self.size):
+            flat = flat.resize((self.size, self.size), Image.NEAREST) # Keep the pixel art crisp.
+        transpose = ORIENTATION_TRANSPOSES.get(self.orientation)
+        if transpose is not None:
+            flat = flat.transpose(getattr(Image.Transpose, transpose))
+        if self.brightness < 1.0:
+            flat = flat.point([round(v * self.brightness) for v in range(256)] * 3)
+        return flat
+
+    def _bake_icon(self, filename : str, path : str):
+        from PIL import ImageSequence # Only needed when baking.
+
+        images, durations = [], []
+        with asset_bundle.open_image(filename) as gif:
+            for frame in ImageSequence.Iterator(gif):
+                images.append(self.bake(frame))
+                durations.append(frame.info.get('duration') or DEFAULT_FRAME_DURATION)
+
+        # Write to a temporary file first so a crash never leaves a half-baked icon behind.
+        # It's named for this process, since render worker processes can bake the same icon at once.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        if len(images) == 1:
+            images[0].save(tmp_path, format='GIF')
+        else:
+            images[0].save(tmp_path, format='GIF', save_all=True, append_images=images[1:], duration=durations, loop=0)
+        os.replace(tmp_path, path)
+
+    def _icon_names(self):
+        try:
+            return asset_bundle.list_gifs(self._icon_dir)
+        except FileNotFoundError:
+            return []
+
+    def _remove_other_packs(self):
+        """Deletes packs baked for old settings or old icons, so they don't pile up on the SD card."""
+        try:
+            names = os.listdir(self._assets_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name != self.key:
+                shutil.rmtree(os.path.join(self._assets_dir, name), ignore_errors=True)
+
+
+def create_asset_pack(config) -> Optional[AssetPack]:
+    """Builds the asset pack for the display in config.py. Returns None for a display of unknown size."""
+    size = HAT_SIZES.get(config.hat_device)
+    if size is None:
+        logger.warning('Unknown hat_device %r. Display settings will not be baked into the images.', config.hat_device)
+        return None
+    return AssetPack(config.cache_dir, size, config.image_orientation, config.image_brightness)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bakes every icon and temperature image for the display in config.py.')
+    parser.add_argument('--min-temperature', type=int, default=-40, help='Lowest temperature to render.')
+    parser.add_argument('--max-temperature', type=int, default=120, help='Highest temperature to render.')
+    args = parser.parse_args(argv)
+
+    import config
+    from render_cache import create_temperature_image_cache
+    logging.basicConfig(level=logging.INFO)
+    os.chdir(os.path.dirname(os.path.abspath(__file__))) # Assets are loaded relative to the repo.
+
+    pack = create_asset_pack(config)
+    if pack is None:
+        return 1
+    pack.build_icons()
+
+    cache = create_temperature_image_cache(config, pack)
+    cache.prewarm(range(args.min_temperature, args.max_temperature + 1))
+    print(pack.pack_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the rendering and aggregation hot paths. Needs no hardware or network access.
+
+    ./benchmark.py --output results.json
+    ./benchmark.py --compare old_results.json
+"""
+import argparse, asyncio, json, os, platform, shutil, statistics, subprocess, sys, tempfile, time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+import config, temperature_image
+import UnicornHatWeather
+from WeatherCollectors.WeatherCollector import WeatherCollector, WeatherStatus, Datapoint
+from WeatherCollectors.AggregateCollector import AggregateCollector
+from WeatherCollectors.TempestUdpCollector import TempestUdpCollector
+
+OBS_ST = {"serial_number": "ST-00000001", "type": "obs_st", "hub_sn": "HB-00000001", "firmware_revision": 143,
+    "obs": [[1700000000, 0.18, 0.22, 0.27, 144, 6, 1017.57, 22.37, 50.26, 328, 0.03, 3, 0.000000, 0, 0, 0, 2.410, 1]]}
+OBS_AIR = {"serial_number": "AR-00000001", "type": "obs_air", "hub_sn": "HB-00000001", "firmware_revision": 17,
+    "obs": [[1700000000, 835.0, 10.0, 45, 0, 0, 3.46, 1]]}
+OBS_SKY = {"serial_number": "SK-00000001", "type": "obs_sky", "hub_sn": "HB-00000001", "firmware_revision": 29,
+    "obs": [[1700000000, 9000, 10, 0.0, 2.6, 4.6, 7.4, 187, 3.12, 1, 130, None, 0, 3]]}
+
+def measure(fn : Callable[[], object], repeat : int, setup : Optional[Callable[[], object]] = None) -> Dict[str, float]:
+    """Times repeat calls of fn. setup is run before each call and isn't timed."""
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return {
+        'repeat': repeat,
+        'mean_us': statistics.fmean(samples) * 1e6,
+        'median_us': statistics.median(samples) * 1e6,
+        'min_us': min(samples) * 1e6,
+        'stdev_us': (statistics.stdev(samples) if len(samples) > 1 else 0.0) * 1e6,
+    }
+
+
+def reset_temperature_image_caches():
+    temperature_image._atlas = None
+    temperature_image._color_lut.clear()
+
+
+def make_status(i : int) -> WeatherStatus:
+    now = datetime.now(timezone.utc)
+    return WeatherStatus(source=f'bench{i}', host_timestamp=now, source_timestamp=now,
+        temp_c=Datapoint(20.0 + i, 0.5 + i * 0.01), humidity_pct=Datapoint(50.0, 0.5), pressure_mb=Datapoint(1013.0, 0.5),
+        illuminance_lux=Datapoint(20000.0, 0.5), uv_index=Datapoint(3.0, 0.5), wind_avg_mps=Datapoint(2.0, 0.5),
+        precip_type=Datapoint('none', 0.5), rain_mm=Datapoint(0.0, 0.5), lightning_count=Datapoint(0, 0.5),
+        lightning_distance=Datapoint(0.0, 0.5), condition_string=Datapoint('clear sky', 0.5), openweathermap_icon=Datapoint('01d', 0.5))
+
+
+def bench_temperature_image(repeat : int) -> Dict[str, dict]:
+    results = {}
+    results['create_temperature_image/cold'] = measure(lambda: temperature_image.create_temperature_image(72), repeat, setup=reset_temperature_image_caches)
+    temperature_image.create_temperature_image(72)
+    results['create_temperature_image/warm'] = measure(lambda: temperature_image.create_temperature_image(72), repeat)
+    results['create_temperature_image_hd/warm'] = measure(lambda: temperature_image.create_temperature_image_hd(72), repeat)
+    results['create_temperature_images/full_range'] = measure(lambda: temperature_image.create_temperature_images(), max(1, repeat // 10))
+    return results
+
+
+def bench_get_weather_images(repeat : int, cache_dir : str) -> Dict[str, dict]:
+    status = make_status(0)
+    loop = asyncio.new_event_loop()
+    def get_weather_images():
+        return loop.run_until_complete(UnicornHatWeather.get_weather_images(status))
+    def clear_cache():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        UnicornHatWeather._temperature_caches.clear()
+        UnicornHatWeather._asset_pack = None
+    results = {}
+    try:
+        results['get_weather_images/cold'] = measure(get_weather_images, repeat, setup=clear_cache)
+        get_weather_images()
+        results['get_weather_images/disk'] = measure(get_weather_images, repeat, setup=lambda: UnicornHatWeather.get_temperature_cache().forget())
+        results['get_weather_images/warm'] = measure(get_weather_images, repeat)
+    finally:
+        loop.close()
+    return results
+
+
+def bench_aggregation(repeat : int) -> Dict[str, dict]:
+    results = {}
+    for n in (1, 2, 5, 10):
+        collectors = [WeatherCollector() for _ in range(n)]
+        aggregate = AggregateCollector(collectors)
+        for i, c in enumerate(collectors):
+            c._deliver_update(make_status(i))
+        results[f'aggregate/full_rebuild/{n}_collectors'] = measure(aggregate._generate_aggregate_status, repeat)
+
+        status = make_status(0)
+        def update(status=status, collector=collectors[0]):
+            status.temp_c = Datapoint(status.temp_c.value + 0.1, status.temp_c.quality)
+            collector._deliver_update(status)
+        results[f'aggregate/incremental_update/{n}_collectors'] = measure(update, repeat)
+    return results
+
+
+def bench_process_packet(repeat : int) -> Dict[str, dict]:
+    results = {}
+    for name, packet in (('obs_st', OBS_ST), ('obs_air', OBS_AIR), ('obs_sky', OBS_SKY)):
+        collector = TempestUdpCollector({})
+        results[f'tempest_udp/process_packet/{name}'] = measure(lambda: collector._process_packet(packet), repeat)
+        data = json.dumps(packet).encode()
+        results[f'tempest_udp/handle_datagram/{name}'] = measure(lambda: collector._handle_datagram(data, ('127.0.0.1', 50222)), repeat)
+    collector = TempestUdpCollector({})
+    rapid_wind = b'{"serial_number":"ST-00000001","type":"rapid_wind","hub_sn":"HB-00000001","ob":[1700000000,2.3,128]}'
+    results['tempest_udp/handle_datagram/rapid_wind_dropped'] = measure(lambda: collector._handle_datagram(rapid_wind, ('127.0.0.1', 50222)), repeat)
+    return results
+
+
+def bench_callback_chain(repeat : int) -> Dict[str, dict]:
+    """A datagram all the way through to a list of frames."""
+    collector = TempestUdpCollector({})
+    aggregate = AggregateCollector([collector])
+    frames = []
+    loop = asyncio.new_event_loop()
+    aggregate.register_callback(lambda status: frames.append(loop.run_until_complete(UnicornHatWeather.get_weather_images(status))))
+    data = json.dumps(OBS_ST).encode()
+    try:
+        return {'chain/datagram_to_frames/obs_st': measure(lambda: collector._handle_datagram(data, ('127.0.0.1', 50222)), repeat)}
+    finally:
+        loop.close()
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(repeat : int) -> dict:
+    cache_dir = tempfile.mkdtemp(prefix='uhw-bench-')
+    original_cache_dir = config.cache_dir
+    config.cache_dir = cache_dir # Keep the real cache out of the measurements.
+    UnicornHatWeather._temperature_caches.clear()
+    UnicornHatWeather._asset_pack = None
+    results = {}
+    try:
+        results.update(bench_temperature_image(repeat))
+        results.update(bench_get_weather_images(repeat, cache_dir))
+        results.update(bench_aggregation(repeat))
+        results.update(bench_process_packet(repeat))
+        results.update(bench_callback_chain(repeat))
+    finally:
+        config.cache_dir = original_cache_dir
+        UnicornHatWeather._temperature_caches.clear()
+        UnicornHatWeather._asset_pack = None
+        if UnicornHatWeather._render_worker is not None:
+            UnicornHatWeather._render_worker.close()
+            UnicornHatWeather._render_worker = None
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'node': platform.node(),
+        'results': results,
+    }
+
+
+def compare(old : dict, new : dict):
+    """Prints the change in median time for every benchmark that's in both runs."""
+    print(f'{"benchmark":<55} {"old us":>10} {"new us":>10} {"change":>8}')
+    for name, result in new['results'].items():
+        before = old['results'].get(name)
+        if before is None:
+            continue
+        change = (result['median_us'] - before['median_us']) / before['median_us'] * 100 if before['median_us'] else 0.0
+        print(f'{name:<55} {before["median_us"]:>10.1f} {result["median_us"]:>10.1f} {change:>+7.1f}%')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the rendering and aggregation hot paths.')
+    parser.add_argument('--repeat', type=int, default=200, help='Samples to take of each benchmark.')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='A previous results file to compare against.')
+    args = parser.parse_args(argv)
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__))) # Assets are loaded relative to the repo.
+    report = run(args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    elif not args.output:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,7 @@
 # OpenWeatherMap configuration parameters. See: https://openweathermap.org/current
 # Comment out these owm_* lines to disable OpenWeatherMap data collection.
-owm_poll_interval = 300.0 # Seconds between refreshing weather data.
+owm_poll_interval = 300.0 # Seconds between refreshing weather data. Polls speed up while the weather is changing and slow down while it's stable.
+owm_request_budget = 1000 # Most requests to make with this appid per day, across every collector using it.
 owm_config = {
     'appid': 'YOUR_OPENWEATHERMAP_API_KEY',
     'zip': '44060', # zip code
@@ -10,6 +11,14 @@ owm_config = {
 #   'lat': '41.63', 'lon': '-81.41',
 }
 
+# Uncomment to also poll other locations with the same appid, for displays there. Each location's frames are written to
+# location_frames_dir/<name>.gif. Locations given by city 'id' are fetched 20 at a time in one request. 'local' is reserved for owm_config.
+#owm_locations = {
+#   'cabin': {'lat': '45.37', 'lon': '-84.95'},
+#   'office': {'id': '5150529'},
+#}
+#location_frames_dir = './temperature_images/locations/'
+
 # Weatherflow Tempest UDP configuration parameters. See: https://weatherflow.github.io/Tempest/api/udp/v144/
 # Comment out these tempest_udp_* lines to disable local Tempest UDP data collection.
 tempest_udp_config = {
@@ -22,6 +31,7 @@ tempest_udp_config = {
 # Comment out to these tempest_cloud_* lines to disable Tempest Cloud collection.
 #tempest_cloud_token = 'YOUR_TEMPESTWX_API_KEY' # Weatherflow Tempest Cloud API token from: https://tempestwx.com/settings/tokens 
 #tempest_cloud_poll_interval = 610 # Seconds between refreshing weather data.
+#tempest_cloud_request_budget = 1000 # Most requests to make with this token per day. Each poll makes two.
 #tempest_cloud_station_name = '202637' # The station name to poll for data. Can be found in the URL when viewing the station: https://tempestwx.com/station/{station_name}
 
 # Control how tempuratures will be displayed and which temps map to cold (blue) and hot (red).
@@ -31,10 +41,26 @@ hot_tempertature = 99 # If Celsius, 38 is a decent choice. If Fahrenheit, 99.
 
 condition_show_time = 10.0 # Seconds to display the condition icon.
 temperature_show_time = 15.0 # Seconds to display the temperature icon.
+lightning_alert_distance = 10 # Kilometers. Lightning closer than this interrupts the display with the lightning icon.
+compile_playlist = True # Combine the condition and temperature images into one gif, so the display doesn't restart between them.
 retry_time = 15.0 # Seconds to wait before retrying when there's an error.
+update_debounce_time = 1.0 # Seconds to wait for more weather updates to arrive before redrawing the display.
 datapoint_max_age = 900.0 # Maximum age of datapoints in seconds before they are considered stale and ignored.
+history_length = 1440 # Readings kept per field per source for trends and totals. At one reading a minute, that's a day.
+observation_log_flush_interval = 60.0 # Seconds between writes to the observation log. Longer intervals mean fewer SD card writes.
+observation_log_retention = 30 * 24 * 3600.0 # Seconds of observations to keep on disk.
 image_brightness = .02 # Brightness to display the images. 0.0 to 1.0
 image_orientation = 0 # Rotates the image so the device can be mounted in a rotated orientation. Values: 0, 1, 2, or 3.
 hat_device = 'Unicorn HAT' # Which LED matrix is connected. Options: 'Unicorn HAT' or 'Unicorn HAT HD'
+bake_display_settings = True # Pre-render every image at the display's resolution, orientation and brightness, rather than converting them as they're shown.
 cache_dir = './temperature_images/' # Define an image cache that will be used to keep from re-generating gifs.
-leading_zero_char = ' ' # Set to '0' for temperatures to always be 2 digits.
\ No newline at end of file
+asset_bundle_path = './assets.bundle' # Built by ./asset_bundle.py. Icons and glyphs are read from it instead of the loose files, when it's up to date.
+temperature_cache_max_bytes = 8 * 1024 * 1024 # Oldest temperature images are removed once the cache is bigger than this.
+render_processes = 0 # Processes to draw images in. 0 draws on a thread instead, which suits a single core Pi. On a multi-core Pi, 1 keeps drawing off the core collecting weather.
+render_queue_length = 8 # Drawing jobs that can wait for the renderer at once. More wait for room.
+leading_zero_char = ' ' # Set to '0' for temperatures to always be 2 digits.
+log_level = 'INFO' # 'DEBUG' also logs every weather update. 'WARNING' only logs problems.
+
+# Serve Prometheus metrics at http://{metrics_host}:{metrics_port}/metrics. Comment out these metrics_* lines to disable the endpoint.
+metrics_host = '127.0.0.1' # Set to '0.0.0.0' to allow scraping from other machines.
+metrics_port = 9101
\ No newline at end of file
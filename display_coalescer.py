@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import asyncio, inspect, logging
+from typing import Awaitable, Callable, Hashable, Optional, Union
+from WeatherCollectors.WeatherCollector import WeatherStatus
+
+logger = logging.getLogger(__name__)
+
+class DisplayCoalescer:
+    """
+    Sits between the AggregateCollector and the display. Bursts of updates are debounced into one,
+    and the frames are only rebuilt when something that's actually drawn has changed.
+    """
+
+    def __init__(self, key_func : Callable[[WeatherStatus], Hashable], on_change : Callable[[WeatherStatus], Union[None, Awaitable[None]]], debounce_time : float = 1.0):
+        self._key_func = key_func # Cheaply computes what would be drawn for a status. e.g. (icon, rounded temperature, unit)
+        self._on_change = on_change # Called with the latest status whenever the display key changes. May be a coroutine function.
+        self._debounce_time = debounce_time
+        self._pending : Optional[WeatherStatus] = None
+        self._timer : Optional[asyncio.TimerHandle] = None
+        self._key : Optional[Hashable] = None
+        self._task : Optional[asyncio.Future] = None # The update still running, if on_change is asynchronous.
+        self.received = 0 # Every update submitted.
+        self.coalesced = 0 # Updates replaced by a newer one before the debounce time ran out.
+        self.suppressed = 0 # Updates that wouldn't have changed what's on the display.
+
+    def submit(self, status : WeatherStatus):
+        """Queues a new status. Register this as the AggregateCollector's callback."""
+        self.received += 1
+        if self._pending is not None:
+            self.coalesced += 1
+        self._pending = status
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self._debounce_time, self.flush)
+
+    def flush(self):
+        """Handles the pending status immediately instead of waiting out the debounce time."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        status, self._pending = self._pending, None
+        if status is None:
+            return
+
+        key = self._key_func(status)
+        if key == self._key:
+            self.suppressed += 1
+            return
+
+        try:
+            result = self._on_change(status)
+        except Exception as ex:
+            logger.error('Error updating frames: %s', ex)
+            self._key = None # Try again on the next update.
+            return
+
+        self._key = key
+        if inspect.isawaitable(result):
+            if self._task is not None:
+                self._task.cancel() # Superseded by this newer status.
+            task = self._task = asyncio.ensure_future(result)
+            task.add_done_callback(self._update_done)
+
+    def _update_done(self, task : asyncio.Future):
+        if task is self._task:
+            self._task = None
+        if task.cancelled():
+            return
+        ex = task.exception()
+        if ex is not None:
+            logger.error('Error updating frames: %s', ex)
+            if self._task is None:
+                self._key = None # Try again on the next update, unless a newer one is already running.
+
+    def invalidate(self):
+        """Forgets what's on the display, so the next update rebuilds the frames even if its key hasn't changed."""
+        self._key = None
+
+    def cancel(self):
+        """Drops any pending status, and stops any update that's still running."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._pending = None
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import asyncio, logging, time
+from dataclasses import dataclass
+from typing import Iterable, List, Optional
+from renderer import RendererSession
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_PREEMPTIONS = metrics.counter('frame_scheduler_preemptions_total', 'Frame cycles cut short by new or more important frames.')
+_LATE_SWITCHES = metrics.counter('frame_scheduler_late_switches_total', 'Frames that started so late the timeline had to be reset.')
+
+@dataclass
+class GifFrame:
+    """Represents Gif, shown for a period of time."""
+    filename: str
+    show_time: float
+    priority: int = 0 # Frames with a higher priority are shown first, and interrupt a cycle of lower priority frames when they appear.
+
+
+class FrameScheduler:
+    """
+    Cycles through the current frames on the display. New frames take effect as soon as they arrive instead of at the
+    end of a cycle, and frames are switched on a monotonic timeline so the time taken to start the renderer doesn't
+    push every later frame back.
+    """
+
+    def __init__(self, session : RendererSession, fallback : GifFrame):
+        self._session = session
+        self._fallback = fallback # Shown when there are no frames, or the display can't be updated.
+        self._frames : List[GifFrame] = []
+        self._position = -1 # Index of the frame being shown. The next frame is the one after it.
+        self._current : Optional[GifFrame] = None
+        self._wake = asyncio.Event()
+
+    @property
+    def current(self) -> Optional[GifFrame]:
+        """The frame that's on the display."""
+        return self._current
+
+    def set_frames(self, frames : Iterable[GifFrame]):
+        """
+        Replaces the frames being cycled through. If the frame on the display is still in the new set, the cycle carries on
+        from there. If it isn't, or a new frame with a higher priority has arrived, the new frames are shown straight away.
+        """
+        old_filenames = {frame.filename for frame in self._frames}
+        self._frames = sorted(frames, key=lambda frame: -frame.priority) # Stable, so equal priorities keep their order.
+
+        current = self._current
+        position = None
+        if current is not None:
+            position = next((i for i, frame in enumerate(self._frames) if frame.filename == current.filename), None)
+        current_priority = current.priority if current is not None else 0
+        preempt = any(frame.priority > current_priority and frame.filename not in old_filenames for frame in self._frames)
+
+        if position is not None and not preempt:
+            self._position = position # Still valid. Let it finish its show time.
+            return
+
+        self._position = -1
+        _PREEMPTIONS.inc()
+        self._wake.set()
+
+    async def run(self):
+        """Shows frames until cancelled."""
+        deadline = time.monotonic()
+        while True:
+            self._wake.clear()
+            frames = self._frames or [self._fallback]
+            self._position = (self._position + 1) % len(frames)
+            frame = self._current = frames[self._position]
+
+            logger.debug('Displaying: %s Time: %s', frame.filename, frame.show_time)
+            try:
+                await self._session.show(frame.filename)
+                show_time = frame.show_time
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.error('Error updating display: %s', ex)
+                show_time = self._fallback.show_time # Wait a while before retrying.
+                if frame is not self._fallback:
+                    await self._show_fallback() # Let the user know something went wrong until then.
+
+            # The next switch is due show_time after this one was due, not after it happened.
+            # If the renderer fell so far behind that the deadline has already passed, start the timeline again from now.
+            now = time.monotonic()
+            deadline += show_time
+            if deadline <= now:
+                _LATE_SWITCHES.inc()
+                deadline = now + show_time
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=deadline - now)
+                deadline = time.monotonic() # Interrupted. The next frame starts a new timeline.
+            except asyncio.TimeoutError:
+                pass
+
+    async def _show_fallback(self):
+        try:
+            await self._session.show(self._fallback.filename)
+            self._current = self._fallback
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            logger.error('Error showing the fallback frame: %s', ex)
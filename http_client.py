@@ -0,0 +1,28 @@
+import aiohttp
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+def create_session(limit : int = 10, limit_per_host : int = 2, dns_cache_ttl : float = 300.0,
+                   keepalive_timeout : float = 60.0, total_timeout : float = 30.0, connect_timeout : float = 10.0) -> aiohttp.ClientSession:
+    """
+    Creates the pooled HTTP session shared by every collector. Connections are kept alive between polls and
+    DNS lookups are cached, so a poll doesn't have to pay for a lookup, TCP handshake and TLS negotiation each time.
+    Must be called from within a running event loop.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        ttl_dns_cache=dns_cache_ttl,
+        keepalive_timeout=keepalive_timeout)
+    timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+@asynccontextmanager
+async def borrow_session(session : Optional[aiohttp.ClientSession]) -> AsyncIterator[aiohttp.ClientSession]:
+    """Yields the shared session if there is one. Otherwise, a throwaway session is created for the duration of the block."""
+    if session is not None and not session.closed:
+        yield session
+    else:
+        async with aiohttp.ClientSession() as temporary_session:
+            yield temporary_session
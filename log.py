@@ -0,0 +1,96 @@
+import logging, logging.handlers, queue, sys, time
+from typing import Dict, Hashable, List, Optional
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `burst` messages per key every `interval` seconds. When a key is let through again,
+    the message says how many similar ones were suppressed in the meantime.
+    A record's key is its `rate_key` extra if it has one, otherwise its logger and unformatted message.
+    If `sample_every` is set, every Nth suppressed message is still let through.
+    """
+
+    def __init__(self, interval : float = 60.0, burst : int = 5, sample_every : int = 0, max_keys : int = 1024):
+        super().__init__()
+        self._interval = interval
+        self._burst = burst
+        self._sample_every = sample_every
+        self._max_keys = max_keys
+        self._state : Dict[Hashable, List] = {} # key -> [window start, messages let through in window, suppressed count]
+
+    def filter(self, record : logging.LogRecord) -> bool:
+        key = getattr(record, 'rate_key', None) or (record.name, record.msg)
+        now = time.monotonic()
+        state = self._state.get(key)
+        if state is None:
+            if len(self._state) >= self._max_keys:
+                self._state.clear() # Don't let a flood of unique keys grow without bound.
+            state = self._state[key] = [now, 0, 0]
+        elif now - state[0] >= self._interval:
+            state[0], state[1] = now, 0
+
+        if state[1] >= self._burst:
+            state[2] += 1
+            if not self._sample_every or state[2] % self._sample_every != 0:
+                return False
+
+        state[1] += 1
+        if state[2]:
+            record.msg = f'{record.getMessage()} (suppressed {state[2]} similar)'
+            record.args = None
+            state[2] = 0
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that drops records instead of waiting when the queue is full, so the event loop never blocks on logging."""
+
+    def __init__(self, log_queue : queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record : logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+FORMAT = '%(levelname)s %(name)s: %(message)s'
+
+def configure_logging(level : str = 'INFO', interval : float = 60.0, burst : int = 5, sample_every : int = 0,
+                      queue_size : int = 1000, stream = None) -> logging.handlers.QueueListener:
+    """
+    Sends every log record through a rate limiter and a bounded queue to a background thread that writes to stdout.
+    Returns the started listener. Stop it at shutdown to flush anything still queued.
+    """
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(interval, burst, sample_every)) # Filter before queueing, so suppressed records cost almost nothing.
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter(FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, output)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener.start()
+    return listener
+
+
+def configure_worker_logging(level : str = 'INFO', interval : float = 60.0, burst : int = 5, stream = None):
+    """
+    Sets up logging in a worker process. The parent's queue lives in its own memory, so a worker writes to stdout
+    directly. There's no event loop in a worker to hold up, so there's no need for a queue of its own.
+    """
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter(FORMAT))
+    output.addFilter(RateLimitFilter(interval, burst))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(output)
+    root.setLevel(level)
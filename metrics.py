@@ -0,0 +1,202 @@
+import asyncio, math, time
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Seconds. Spans everything from parsing a single packet up to a slow HTTP poll.
+DEFAULT_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Counter:
+    """A value that only goes up."""
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount : float = 1.0):
+        self.value += amount
+
+    def _samples(self, name : str, labels : str) -> List[str]:
+        return [f'{name}{_braces(labels)} {_format(self.value)}']
+
+
+class Gauge:
+    """A value that can go up and down."""
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value : float):
+        self.value = value
+
+    def _samples(self, name : str, labels : str) -> List[str]:
+        return [f'{name}{_braces(labels)} {_format(self.value)}']
+
+
+class Histogram:
+    """Counts observations into fixed buckets. Observing is a bisect and two additions, so it's cheap enough to leave on."""
+
+    def __init__(self, buckets : Sequence[float] = DEFAULT_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._counts = [0] * (len(self._buckets) + 1) # The last slot is +Inf.
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value : float):
+        self._counts[bisect_left(self._buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> '_Timer':
+        """Returns a context manager that observes how long its block took."""
+        return _Timer(self)
+
+    def _samples(self, name : str, labels : str) -> List[str]:
+        samples = []
+        cumulative = 0
+        separator = ',' if labels else ''
+        for bound, count in zip(self._buckets, self._counts):
+            cumulative += count
+            samples.append(f'{name}_bucket{{{labels}{separator}le="{_format(bound)}"}} {cumulative}')
+        samples.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        samples.append(f'{name}_sum{_braces(labels)} {_format(self.sum)}')
+        samples.append(f'{name}_count{_braces(labels)} {self.count}')
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram : Histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class MetricFamily:
+    """A named metric, with one child per set of label values."""
+
+    def __init__(self, name : str, help : str, kind : str, factory, labelnames : Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self._factory = factory
+        self._labelnames = tuple(labelnames)
+        self._children : Dict[Tuple[str, ...], object] = {}
+        if not self._labelnames:
+            self._children[()] = factory()
+
+    def labels(self, *values : str):
+        """Returns the child metric for the given label values. Callers on hot paths should hold onto the result."""
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self._labelnames):
+                raise ValueError(f'{self.name} expects labels {self._labelnames}')
+            child = self._children[key] = self._factory()
+        return child
+
+    # Metrics without labels can be used directly.
+    def inc(self, amount : float = 1.0):
+        self._children[()].inc(amount)
+
+    def set(self, value : float):
+        self._children[()].set(value)
+
+    def observe(self, value : float):
+        self._children[()].observe(value)
+
+    def time(self):
+        return self._children[()].time()
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for values, child in self._children.items():
+            labels = ','.join(f'{k}="{_escape(v)}"' for k, v in zip(self._labelnames, values))
+            lines.extend(child._samples(self.name, labels))
+        return lines
+
+
+class Registry:
+    """Holds every metric and renders them in the Prometheus text format."""
+
+    def __init__(self):
+        self._families : Dict[str, MetricFamily] = {}
+
+    def counter(self, name : str, help : str, labelnames : Sequence[str] = ()) -> MetricFamily:
+        return self._get_or_create(name, help, 'counter', Counter, labelnames)
+
+    def gauge(self, name : str, help : str, labelnames : Sequence[str] = ()) -> MetricFamily:
+        return self._get_or_create(name, help, 'gauge', Gauge, labelnames)
+
+    def histogram(self, name : str, help : str, labelnames : Sequence[str] = (), buckets : Sequence[float] = DEFAULT_BUCKETS) -> MetricFamily:
+        return self._get_or_create(name, help, 'histogram', lambda: Histogram(buckets), labelnames)
+
+    def render(self) -> str:
+        lines = []
+        for family in self._families.values():
+            lines.extend(family.render())
+        return '\n'.join(lines) + '\n'
+
+    def _get_or_create(self, name, help, kind, factory, labelnames) -> MetricFamily:
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = MetricFamily(name, help, kind, factory, labelnames)
+        return family
+
+
+REGISTRY = Registry() # The process-wide registry that everything reports to.
+
+def counter(name : str, help : str, labelnames : Sequence[str] = ()) -> MetricFamily:
+    return REGISTRY.counter(name, help, labelnames)
+
+def gauge(name : str, help : str, labelnames : Sequence[str] = ()) -> MetricFamily:
+    return REGISTRY.gauge(name, help, labelnames)
+
+def histogram(name : str, help : str, labelnames : Sequence[str] = (), buckets : Sequence[float] = DEFAULT_BUCKETS) -> MetricFamily:
+    return REGISTRY.histogram(name, help, labelnames, buckets)
+
+
+async def serve_metrics(host : str, port : int, registry : Registry = REGISTRY) -> asyncio.AbstractServer:
+    """Starts a tiny HTTP server that answers every request with the current metrics."""
+
+    async def handle(reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+        try:
+            await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5.0) # Don't care what was asked for.
+            body = registry.render().encode('utf-8')
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n'
+                b'Connection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+async def monitor_event_loop_lag(interval : float = 1.0):
+    """Measures how late the event loop is to wake up a sleeping task. Runs until cancelled."""
+    lag_histogram = histogram('event_loop_lag_seconds', 'How late the event loop woke up a task sleeping for a fixed interval.')
+    lag_gauge = gauge('event_loop_lag_last_seconds', 'The most recent event loop lag measurement.')
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.monotonic() - start - interval)
+        lag_histogram.observe(lag)
+        lag_gauge.set(lag)
+
+
+def _braces(labels : str) -> str:
+    return '{' + labels + '}' if labels else ''
+
+def _escape(value : str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format(value : float) -> str:
+    if not math.isfinite(value):
+        return '+Inf' if value > 0 else ('-Inf' if value < 0 else 'NaN')
+    return str(int(value)) if value == int(value) else repr(float(value))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import hashlib, logging, os
+from typing import List, Sequence, Tuple
+from frame_scheduler import GifFrame
+import metrics
+import asset_bundle
+
+logger = logging.getLogger(__name__)
+
+_COMPILE_TIME = metrics.histogram('playlist_compile_seconds', 'Time taken to compile a set of frames into one gif.')
+_CACHE_HITS = metrics.counter('playlist_cache_hits_total', 'Compiled playlists found in the cache.')
+
+PLAYLIST_VERSION = 1 # Bump to invalidate every cached playlist when the output format changes.
+DEFAULT_FRAME_DURATION = 100 # Milliseconds. What a gif frame without a delay is shown for.
+
+def playlist_key(frames : Sequence[GifFrame]) -> str:
+    """Returns a key that changes whenever the frames, their show times, or the files behind them change."""
+    h = hashlib.sha1(str(PLAYLIST_VERSION).encode('ascii'))
+    for frame in frames:
+        size, mtime_ns = asset_bundle.stat(frame.filename)
+        h.update(f'{os.path.abspath(frame.filename)}|{mtime_ns}|{size}|{frame.show_time!r}\n'.encode('utf-8'))
+    return h.hexdigest()
+
+
+def compile_playlist(frames : Sequence[GifFrame], cache_dir : str, max_cached : int = 200) -> GifFrame:
+    """
+    Combines a cycle of frames into one animated gif that plays each frame's animation for its show time, so the
+    renderer only needs starting once for the whole cycle. Compiled playlists are cached by their content, so compiling
+    the same frames again just returns the existing file. Only the max_cached most recently used playlists are kept.
+    """
+    if not frames:
+        raise ValueError('A playlist needs at least one frame.')
+    frames = sorted(frames, key=lambda frame: -frame.priority) # The same order the scheduler would show them in.
+    show_time = sum(frame.show_time for frame in frames)
+    priority = max((frame.priority for frame in frames), default=0)
+    path = os.path.join(cache_dir, playlist_key(frames) + '.gif')
+    if os.path.exists(path):
+        _CACHE_HITS.inc()
+        os.utime(path) # Mark it as recently used, so it's the last to be pruned.
+        return GifFrame(path, show_time, priority)
+
+    with _COMPILE_TIME.time():
+        images, durations = [], []
+        for frame in frames:
+            frame_images, frame_durations = _load_for(frame.filename, round(frame.show_time * 1000))
+            images.extend(frame_images)
+            durations.extend(frame_durations)
+        if images and any(img.size != images[0].size for img in images):
+            raise ValueError('Frames in a playlist must all be the same size.')
+
+        # Write to a temporary file first so a crash never leaves a half-written playlist behind.
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp' # Render worker processes may compile the same playlist at once.
+        images[0].save(tmp_path, format='GIF', save_all=True, append_images=images[1:], duration=durations, loop=0)
+        os.replace(tmp_path, path)
+    logger.info('Compiled playlist of %d frames. playlist=%s', len(frames), path)
+    _prune(cache_dir, max_cached)
+    return GifFrame(path, show_time, priority)
+
+
+def _prune(cache_dir : str, max_cached : int):
+    """Deletes the least recently used playlists, so every combination of weather ever seen doesn't pile up on the SD card."""
+    try:
+        paths = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith('.gif')]
+        if len(paths) <= max_cached:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - max_cached]:
+            os.remove(path)
+    except OSError as e:
+        logger.warning('Error pruning playlist cache: %s', e)
+
+
+def _load_for(filename : str, show_time_ms : int) -> Tuple[List, List[int]]:
+    """Loads a gif's frames and repeats its animation until it fills show_time_ms. Returns the frames and their durations."""
+    from PIL import Image, ImageSequence # Only needed when compiling.
+
+    images, durations = [], []
+    with asset_bundle.open_image(filename) as gif:
+        for image in ImageSequence.Iterator(gif):
+            # Flatten transparency onto black, which is what an unlit LED looks like anyway.
+            rgba = image.convert('RGBA')
+            flat = Image.new('RGB', rgba.size, (0, 0, 0))
+            flat.paste(rgba, mask=rgba)
+            images.append(flat)
+            durations.append(image.info.get('duration') or DEFAULT_FRAME_DURATION)
+
+    if len(images) == 1:
+        return images, [show_time_ms] # A still image is just shown for the whole time.
+
+    looped_images, looped_durations = [], []
+    remaining = show_time_ms
+    while remaining > 0:
+        for image, duration in zip(images, durations):
+            looped_images.append(image)
+            looped_durations.append(min(duration, remaining)) # Cut the last frame short so the total comes out exact.
+            remaining -= duration
+            if remaining <= 0:
+                break
+    return looped_images, looped_durations
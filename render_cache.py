@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+import asyncio, hashlib, io, logging, os, time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional
+import metrics
+import asset_bundle
+
+logger = logging.getLogger(__name__)
+
+_RENDER_TIME = metrics.histogram('temperature_image_render_seconds', 'Time taken to render and save a temperature image.')
+_CACHE_HITS = metrics.counter('temperature_image_cache_hits_total', 'Temperature images found in the cache.', ['layer'])
+_CACHE_MISSES = metrics.counter('temperature_image_cache_misses_total', 'Temperature images that had to be rendered.')
+_EVICTIONS = metrics.counter('render_cache_evictions_total', 'Files removed from the render cache to stay under its limits.')
+
+RENDER_VERSION = 1 # Bump whenever temperature_image changes what it draws, to invalidate every cached image.
+
+class DiskCache:
+    """
+    A directory of rendered files. Files are written atomically, so a crash never leaves a truncated one behind. A file's
+    mtime is refreshed whenever it's used, and the least recently used files are removed once the directory goes over
+    max_bytes or they haven't been used for max_age seconds.
+    """
+
+    def __init__(self, cache_dir : str, max_bytes : int = 8 * 1024 * 1024, max_age : Optional[float] = None):
+        self.cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+
+    def path(self, name : str) -> str:
+        return os.path.join(self.cache_dir, name)
+
+    def get(self, name : str) -> Optional[str]:
+        """Returns the path of a cached file, or None if it isn't cached."""
+        path = self.path(name)
+        try:
+            os.utime(path) # Mark it as used, so eviction removes the least recently used files first.
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning('Error touching cached file %s: %s', path, e)
+        return path
+
+    def put(self, name : str, data) -> str:
+        """Writes a file into the cache and returns its path. Blocks on the disk, so call it from a worker thread."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(name)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return path
+
+    def evict(self, in_use : Iterable[str] = ()) -> int:
+        """
+        Removes files that haven't been used for max_age, then the least recently used files until the cache fits in
+        max_bytes. Files in in_use are being served from memory without touching the disk, so they count as just used.
+        Returns how many were removed.
+        """
+        now = time.time()
+        in_use = set(in_use)
+        try:
+            entries = []
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.is_file() and not entry.name.endswith('.tmp'):
+                        stat = entry.stat()
+                        entries.append((now if entry.path in in_use else stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            return 0
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        cutoff = now - self._max_age if self._max_age is not None else None
+        removed = 0
+        for mtime, size, path in entries:
+            if total <= self._max_bytes and (cutoff is None or mtime >= cutoff):
+                break
+            try:
+                os.remove(path)
+                total -= size
+                removed += 1
+                _EVICTIONS.inc()
+            except OSError as e:
+                logger.warning('Error evicting cached file %s: %s', path, e)
+        return removed
+
+
+def fingerprint(*parts, files : Iterable[str] = ()) -> str:
+    """Returns a short hash of every rendering parameter, plus the size and mtime of every asset file the rendering reads."""
+    h = hashlib.sha1(repr(parts).encode('utf-8'))
+    for path in sorted(files):
+        try:
+            size, mtime_ns = asset_bundle.stat(path)
+            h.update(f'{path}|{size}|{mtime_ns}\n'.encode('utf-8'))
+        except OSError:
+            h.update(f'{path}|missing\n'.encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+class TemperatureImageCache:
+    """
+    Caches rendered temperature gifs. Files are named after the temperature and a fingerprint of everything that affects
+    how it's drawn, so changing the unit, the color range, the leading zero character or the glyphs can never serve a
+    stale image. A small in-memory LRU in front of the disk saves a stat on the SD card for temperatures seen recently.
+    """
+
+    def __init__(self, disk : DiskCache, render : Callable[[int], bytes], key : str, memory_entries : int = 32, worker = None,
+                 render_many : Optional[Callable[[List[int]], Dict[int, bytes]]] = None):
+        self._disk = disk
+        self._render = render # Renders a temperature to gif bytes. Blocks on Pillow, so it's run off the event loop.
+        self._render_many = render_many # Renders a list of temperatures in one pass. Used to fill the cache ahead of time.
+        self._worker = worker # The RenderWorker to draw on. Without one, images are drawn on a plain worker thread.
+        self._key = key # Fingerprint of the rendering parameters.
+        self._memory_entries = memory_entries
+        self._memory : 'OrderedDict[int, str]' = OrderedDict() # temperature -> path
+        self._in_progress = {} # temperature -> Future, so concurrent requests for the same image only render it once.
+
+    def filename(self, temperature : int) -> str:
+        return f'{temperature}_{self._key}.gif'
+
+    async def get(self, temperature : int) -> str:
+        """Returns the path of the gif for a temperature, rendering it if it isn't cached yet."""
+        path = self._memory.get(temperature)
+        if path is not None:
+            self._memory.move_to_end(temperature)
+            _CACHE_HITS.labels('memory').inc()
+            return path
+
+        path = self._disk.get(self.filename(temperature))
+        if path is not None:
+            _CACHE_HITS.labels('disk').inc()
+        else:
+            in_progress = self._in_progress.get(temperature)
+            if in_progress is not None:
+                return await asyncio.shield(in_progress)
+            future = self._in_progress[temperature] = asyncio.get_running_loop().create_future()
+            try:
+                path = await self._render_to_disk(temperature)
+                future.set_result(path)
+            except BaseException as ex:
+                future.set_exception(ex)
+                future.exception() # Mark it retrieved, in case nobody else was waiting.
+                raise
+            finally:
+                del self._in_progress[temperature]
+
+        self._remember(temperature, path)
+        return path
+
+    def forget(self):
+        """Clears the in-memory LRU. The next lookups go to disk."""
+        self._memory.clear()
+
+    def prewarm(self, temperatures : Iterable[int]) -> int:
+        """
+        Renders every temperature that isn't cached yet in one pass and writes them all to disk. Blocks on Pillow and the
+        disk, so call it from a worker thread or a script. Returns how many were rendered.
+        """
+        missing = [temperature for temperature in temperatures if self._disk.get(self.filename(temperature)) is None]
+        if not missing:
+            return 0
+        _CACHE_MISSES.inc(len(missing))
+        logger.info('Creating %d new images.', len(missing))
+        if self._render_many is not None:
+            images = self._render_many(missing)
+        else:
+            images = {temperature: self._render(temperature) for temperature in missing}
+        for temperature, data in images.items():
+            self._disk.put(self.filename(temperature), data)
+        if self._disk.evict(list(self._memory.values())):
+            self.forget()
+        return len(missing)
+
+    async def _render_to_disk(self, temperature : int) -> str:
+        _CACHE_MISSES.inc()
+        logger.info('Creating new image. temperature=%s', temperature)
+        with _RENDER_TIME.time():
+            if self._worker is not None:
+                data = await self._worker.run(self._render, temperature)
+            else:
+                data = await asyncio.to_thread(self._render, temperature)
+            path = await asyncio.to_thread(self._disk.put, self.filename(temperature), data) # Keep the SD card writes off the event loop.
+        if await asyncio.to_thread(self._disk.evict, list(self._memory.values())):
+            self.forget() # Something the LRU points at may be gone.
+        return path
+
+    def _remember(self, temperature : int, path : str):
+        self._memory[temperature] = path
+        self._memory.move_to_end(temperature)
+        while len(self._memory) > self._memory_entries:
+            self._memory.popitem(last=False)
+
+
+def render_temperature_gif(temperature : int) -> bytes:
+    """Renders a temperature image and encodes it as a gif."""
+    import temperature_image # Pulls in Pillow. Not needed until something has to be drawn.
+    img = temperature_image.create_temperature_image(temperature)
+    buffer = io.BytesIO()
+    img.save(buffer, format='GIF')
+    return buffer.getvalue()
+
+
+def render_temperature_gifs(temperatures : List[int]) -> Dict[int, bytes]:
+    """Renders a list of temperature images in one pass and encodes each as a gif."""
+    import temperature_image
+    images = {}
+    for temperature, img in temperature_image.create_temperature_images(temperatures).items():
+        buffer = io.BytesIO()
+        img.save(buffer, format='GIF')
+        images[temperature] = buffer.getvalue()
+    return images
+
+
+def create_temperature_image_cache(config, pack=None, worker=None) -> TemperatureImageCache:
+    """
+    Builds the temperature image cache from config.py. With an asset pack, images are rendered at the display's
+    resolution with its display settings baked in, and cached inside the pack.
+    """
+    asset_files = [os.path.join(d, name) for d in ('characters', 'icons') if os.path.isdir(d) for name in asset_bundle.list_gifs(d)]
+    parts = (RENDER_VERSION, config.tempurature_unit, config.cold_temperature, config.hot_tempertature, config.leading_zero_char)
+    if pack is not None:
+        parts += (pack.key,)
+    key = fingerprint(*parts, files=asset_files)
+    max_bytes = getattr(config, 'temperature_cache_max_bytes', 8 * 1024 * 1024)
+    max_age = getattr(config, 'temperature_cache_max_age', None)
+    cache_dir = pack.pack_dir if pack is not None else config.cache_dir
+    disk = DiskCache(os.path.join(cache_dir, 'temperature'), max_bytes, max_age)
+    if pack is not None:
+        return TemperatureImageCache(disk, pack.render_temperature, key, worker=worker, render_many=pack.render_temperatures)
+    return TemperatureImageCache(disk, render_temperature_gif, key, worker=worker, render_many=render_temperature_gifs)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+import asyncio, concurrent.futures, logging, multiprocessing, time
+from typing import Callable, Optional
+import metrics, log
+
+logger = logging.getLogger(__name__)
+
+_JOB_TIME = metrics.histogram('render_worker_job_seconds', 'Time from a render job being submitted to it finishing, including time spent queued.')
+_JOBS = metrics.gauge('render_worker_jobs', 'Render jobs queued or running.')
+_FULL_WAITS = metrics.counter('render_worker_full_waits_total', 'Render jobs that had to wait for room in the queue.')
+
+class RenderWorker:
+    """
+    Runs blocking work like drawing and encoding gifs on a pool, so the event loop keeps receiving weather and switching
+    frames on time while Pillow works. At most max_workers jobs run and max_queued wait at once. Submitting more waits
+    for room rather than piling up work that will be out of date by the time it runs.
+
+    With use_processes, jobs run in separate processes, so rendering gets its own core on a multi-core Pi. Jobs and their
+    results then have to be picklable, and each process keeps its own caches.
+    """
+
+    def __init__(self, max_workers : int = 1, max_queued : int = 8, use_processes : bool = False, log_level : str = 'INFO'):
+        if use_processes:
+            # Processes are started lazily, once the logging and bake threads are running. Forking a process with threads
+            # can leave a lock held forever in the child, so start them from a clean forkserver process instead.
+            # The parent's log queue isn't shared with them, so each one sets up its own logging.
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('forkserver'),
+                initializer=log.configure_worker_logging, initargs=(log_level,))
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='render')
+        self._slots = asyncio.Semaphore(max_workers + max_queued)
+        self._jobs = 0
+
+    async def submit(self, fn : Callable, *args) -> asyncio.Future:
+        """Queues fn(*args), waiting if the queue is full. Returns a future for the result."""
+        if self._slots.locked():
+            _FULL_WAITS.inc()
+        await self._slots.acquire()
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+        try:
+            job = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        self._set_jobs(self._jobs + 1)
+
+        def finished(job):
+            # Called on the pool's thread. The slot is only freed once the job has really stopped, even if whoever
+            # submitted it stopped waiting, so the bound holds.
+            try:
+                loop.call_soon_threadsafe(self._finished, time.perf_counter() - submitted)
+            except RuntimeError:
+                pass # The loop has already closed. Nobody's left to free the slot for.
+        job.add_done_callback(finished)
+        return asyncio.wrap_future(job)
+
+    async def run(self, fn : Callable, *args):
+        """Runs fn(*args) on the pool and returns its result."""
+        return await (await self.submit(fn, *args))
+
+    def close(self):
+        """Stops accepting jobs. Jobs that haven't started are dropped. Ones already running finish in the background."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _finished(self, seconds : float):
+        _JOB_TIME.observe(seconds)
+        self._set_jobs(self._jobs - 1)
+        self._slots.release()
+
+    def _set_jobs(self, jobs : int):
+        self._jobs = jobs
+        _JOBS.set(jobs)
+
+
+def create_render_worker(config) -> RenderWorker:
+    """Builds the render worker from config.py."""
+    processes = getattr(config, 'render_processes', 0)
+    if processes > 0:
+        return RenderWorker(processes, getattr(config, 'render_queue_length', 8), use_processes=True, log_level=getattr(config, 'log_level', 'INFO'))
+    return RenderWorker(1, getattr(config, 'render_queue_length', 8))
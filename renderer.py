@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+import asyncio, logging, time
+from collections import deque
+from typing import Callable, Deque, List, Optional, Tuple
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_START_TIME = metrics.histogram('renderer_start_seconds', 'Time taken to start the renderer on a new gif.')
+_STOP_TIME = metrics.histogram('renderer_stop_seconds', 'Time taken to stop the renderer.')
+_SWITCHES = metrics.counter('renderer_switches_total', 'Frame switch requests.', ['result'])
+
+class RendererBackend:
+    """Something that can put a gif on the LED matrix. Implementations only need to know how to switch to a new file."""
+
+    async def show(self, filename : str):
+        """Switches the display over to the given gif."""
+        pass
+
+    def is_showing(self, filename : str) -> bool:
+        """Returns True if the backend is still displaying the given gif."""
+        return False
+
+    async def close(self):
+        """Stops displaying anything and releases the device."""
+        pass
+
+
+class Gif2UnicornHatBackend(RendererBackend):
+    """
+    Displays gifs using the Gif2UnicornHat program. It only takes a gif on its command line, so every switch to a
+    different file still stops the process and starts a new one. The session only saves the restarts for frames that
+    are already showing. With compile_playlist on, a whole cycle is one gif and the process is only restarted when the
+    weather changes.
+    """
+
+    def __init__(self, device : str, brightness : float, orientation : int,
+                 executable : str = './Gif2UnicornHat/Gif2UnicornHat', graceful_timeout : float = 5.0,
+                 is_prebaked : Optional[Callable[[str], bool]] = None):
+        self._device = device
+        self._brightness = brightness
+        self._orientation = orientation
+        self._is_prebaked = is_prebaked # Returns True for gifs that already have the brightness and orientation baked in.
+        self._executable = executable
+        self._graceful_timeout = graceful_timeout
+        self._proc = None
+        self._filename = None
+
+    async def show(self, filename : str):
+        await self._terminate()
+        brightness, orientation = self._brightness, self._orientation
+        if self._is_prebaked is not None and self._is_prebaked(filename):
+            brightness, orientation = 1.0, 0 # Applying them again would dim and rotate it twice.
+        with _START_TIME.time():
+            self._proc = await asyncio.create_subprocess_exec(
+                self._executable,
+                '-d', self._device,
+                filename,
+                str(brightness),
+                str(orientation))
+        self._filename = filename
+
+    def is_showing(self, filename : str) -> bool:
+        return self._proc is not None and self._proc.returncode is None and self._filename == filename
+
+    async def close(self):
+        await self._terminate()
+
+    async def _terminate(self):
+        proc, self._proc, self._filename = self._proc, None, None
+        if proc is None or proc.returncode is not None:
+            return
+
+        with _STOP_TIME.time():
+            proc.terminate()
+            try:
+                await asyncio.wait_for(proc.communicate(), timeout=self._graceful_timeout)
+            except asyncio.TimeoutError:
+                logger.warning('Process took too long to exit. Killing process.')
+                proc.kill()
+                await proc.wait()
+
+
+class FakeBackend(RendererBackend):
+    """Pretends to be a display. Records every switch so switch latency can be measured without hardware."""
+
+    def __init__(self, switch_delay : float = 0.0):
+        self.switch_delay = switch_delay # Simulated time it takes the device to start showing a new gif.
+        self.switches : List[Tuple[float, str]] = [] # (monotonic time, filename) of every switch.
+        self._filename = None
+
+    async def show(self, filename : str):
+        if self.switch_delay > 0:
+            await asyncio.sleep(self.switch_delay)
+        self._filename = filename
+        self.switches.append((time.monotonic(), filename))
+
+    def is_showing(self, filename : str) -> bool:
+        return self._filename == filename
+
+    async def close(self):
+        self._filename = None
+
+
+class RendererSession:
+    """
+    A long-lived connection to the display. Frame switches are sent over a queue to a single
+    task that owns the backend, so callers never wait on the device and identical frames never
+    cause the renderer to restart.
+    """
+
+    def __init__(self, backend : RendererBackend, latency_history : int = 100):
+        self._backend = backend
+        self._requests : asyncio.Queue = asyncio.Queue()
+        self._task : Optional[asyncio.Task] = None
+        self.switch_latencies : Deque[float] = deque(maxlen=latency_history) # Seconds from request to the frame being shown.
+        self.skipped_switches = 0 # Requests that didn't need a restart because the frame was already showing.
+        self._switched = _SWITCHES.labels('switched')
+        self._skipped = _SWITCHES.labels('skipped')
+
+    async def start(self):
+        """Starts the task that owns the display."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def show(self, filename : str) -> asyncio.Future:
+        """Asks the session to display a gif. Returns a future that completes once the frame is on the display."""
+        done = asyncio.get_running_loop().create_future()
+        self._requests.put_nowait((filename, time.monotonic(), done))
+        return done
+
+    async def close(self):
+        """Stops the session and turns off the display."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._backend.close()
+
+    async def _run(self):
+        while True:
+            filename, requested_at, done = await self._requests.get()
+
+            # Only the newest request matters. Anything queued behind it is already out of date.
+            while not self._requests.empty():
+                if not done.done():
+                    done.set_result(False)
+                filename, requested_at, done = self._requests.get_nowait()
+
+            try:
+                if self._backend.is_showing(filename):
+                    self.skipped_switches += 1
+                    self._skipped.inc()
+                else:
+                    await self._backend.show(filename)
+                    self._switched.inc()
+                self.switch_latencies.append(time.monotonic() - requested_at)
+                if not done.done():
+                    done.set_result(True)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                if not done.done():
+                    done.set_exception(ex)
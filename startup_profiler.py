@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import builtins, logging, sys, time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class StartupProfiler:
+    """
+    Times the steps of starting up. Steps are always timed, since it only costs a couple of clock reads each.
+    With the import hook installed, every module imported for the first time is timed too, both including and
+    excluding the modules it imports in turn.
+    """
+
+    def __init__(self, start : Optional[float] = None):
+        self.start = start if start is not None else time.perf_counter() # perf_counter() time that startup began.
+        self.steps : List[Tuple[str, float]] = [] # (name, seconds), in the order they finished.
+        self.imports : Dict[str, Tuple[float, float]] = {} # module -> (seconds including its imports, seconds excluding them)
+        self._original_import = None
+        self._child_time : List[float] = [] # Time spent in nested imports, one entry per import in progress.
+
+    @contextmanager
+    def step(self, name : str):
+        """Times a block of startup work."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.perf_counter() - start))
+
+    def record(self, name : str, seconds : float):
+        """Adds a step that was timed some other way."""
+        self.steps.append((name, seconds))
+
+    def elapsed(self) -> float:
+        """Seconds since the profiler was created."""
+        return time.perf_counter() - self.start
+
+    def install_import_hook(self):
+        """Starts timing every import of a module that isn't loaded yet."""
+        if self._original_import is not None:
+            return
+        original = self._original_import = builtins.__import__
+
+        def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+            module_name = name
+            if level > 0:
+                package = (globals or {}).get('__package__') or ''
+                module_name = '.'.join(package.split('.')[:len(package.split('.')) - level + 1] + ([name] if name else []))
+            if module_name in sys.modules:
+                return original(name, globals, locals, fromlist, level) # Already loaded. Nothing to time.
+
+            self._child_time.append(0.0)
+            start = time.perf_counter()
+            try:
+                return original(name, globals, locals, fromlist, level)
+            finally:
+                total = time.perf_counter() - start
+                children = self._child_time.pop()
+                if self._child_time:
+                    self._child_time[-1] += total
+                self.imports.setdefault(module_name, (total, total - children))
+
+        builtins.__import__ = timed_import
+
+    def uninstall_import_hook(self):
+        """Stops timing imports."""
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    def report(self, top : int = 20) -> List[str]:
+        """Returns a human readable report of the slowest steps and imports."""
+        lines = [f'Startup took {self.elapsed() * 1000:.1f} ms.', 'Steps:']
+        for name, seconds in self.steps:
+            lines.append(f'  {seconds * 1000:9.1f} ms  {name}')
+        if self.imports:
+            lines.append('Slowest imports (total / self):')
+            slowest = sorted(self.imports.items(), key=lambda item: item[1][0], reverse=True)[:top]
+            for module, (total, own) in slowest:
+                lines.append(f'  {total * 1000:9.1f} ms {own * 1000:9.1f} ms  {module}')
+        return lines
+
+    def log_report(self, level : int = logging.INFO):
+        logger.log(level, '%s', '\n'.join(self.report())) # One record, so the rate limiter doesn't cut the report short.
@@ -1,23 +1,75 @@
 #!/usr/bin/env python3
-import config
+import os, math
+import config, asset_bundle
 from PIL import Image, ImageChops
 import colorsys
 
+# Every glyph and icon used to draw temperatures, decoded once into a single in-memory sheet.
+class GlyphAtlas:
+    def __init__(self, char_dir : str = 'characters', icon_dir : str = 'icons', icons = ('degree_background', 'cold', 'hot')):
+        images = {}
+        for filename in asset_bundle.list_gifs(char_dir):
+            name = os.path.splitext(filename)[0]
+            if name.isdigit():
+                images[chr(int(name))] = asset_bundle.open_image(os.path.join(char_dir, filename)).convert('RGB')
+        for icon in icons:
+            images[icon] = asset_bundle.open_image(os.path.join(icon_dir, icon + '.gif')).convert('RGB')
+
+        # Pack everything left to right into one sheet and remember where each image landed.
+        width = sum(img.width for img in images.values())
+        height = max(img.height for img in images.values())
+        self.sheet = Image.new('RGB', (width, height))
+        self._boxes = {}
+        self._tiles = {}
+        x = 0
+        for key, img in images.items():
+            self.sheet.paste(img, (x, 0))
+            self._boxes[key] = (x, 0, x + img.width, img.height)
+            x += img.width
+
+    # Returns the (left, upper, right, lower) box of a glyph or icon within the sheet.
+    def box(self, key : str):
+        return self._boxes[key]
+
+    # Returns the image for a glyph or icon. Tiles are cut from the sheet once and reused.
+    def tile(self, key : str):
+        tile = self._tiles.get(key)
+        if tile is None:
+            tile = self._tiles[key] = self.sheet.crop(self._boxes[key])
+        return tile
+
+
+_atlas = None
+
+# Returns the shared glyph atlas, loading it on first use.
+def get_atlas():
+    global _atlas
+    if _atlas is None:
+        _atlas = GlyphAtlas()
+    return _atlas
+
+
 # Returns an image representing a given character.
 def open_char_image(character : str):
     if len(character) != 1:
         raise RuntimeError('Not a character.')
-    return Image.open(f'characters/{ord(character)}.gif').convert('RGB')
+    return get_atlas().tile(character).copy()
 
 
 # Draws a string of fixed width characters on to an image at the given location.
 def draw_msg_on_image(base_img, msg : str, x : int, y : int, padding : int = 1):
     img = base_img.copy()
+    blit_msg(img, msg, x, y, padding)
+    return img
+
+
+# Draws a string of fixed width characters directly on to an image, without copying it first.
+def blit_msg(img, msg : str, x : int, y : int, padding : int = 1):
+    atlas = get_atlas()
     for c in msg:
-        char_img = open_char_image(c)
+        char_img = atlas.tile(c)
         img.paste(char_img, (x, y))
         x += char_img.size[0] + padding
-    return img
 
 
 # Saturate a value to a given min or max.
@@ -39,31 +91,135 @@ def temperature_to_color(temperature : float):
     return (int(color[0]*255), int(color[1]*255), int(color[2]*255), 255)
 
 
+# Colour of every whole degree between the cold and hot temperatures. Anything outside that range is clamped to an end.
+_color_lut = {}
+
+# Looks up the colour for a temperature, computing the whole table the first time it's needed.
+def temperature_to_color_lut(temperature : int):
+    key = (config.cold_temperature, config.hot_tempertature)
+    table = _color_lut.get(key)
+    if table is None:
+        low, high = int(math.floor(key[0])), int(math.ceil(key[1]))
+        table = _color_lut[key] = (low, [temperature_to_color(t) for t in range(low, high + 1)])
+    low, colors = table
+    return colors[clamp(temperature - low, 0, len(colors) - 1)]
+
+
 # Tints an image with a given colour value.
 def apply_color_filter_to_image(base_img, color):
     filter_img = Image.new('RGB', (base_img.width, base_img.height), color)
     return ImageChops.multiply(base_img, filter_img)
 
 
-# Creates an 8x8 image with the current temperature on it.
-def create_temperature_image(temperature : int):
+# Formats a temperature the way it will be drawn.
+def temperature_string(temperature : int):
     temp_str = str(temperature)
     if config.leading_zero_char is not None:
         temp_str = temp_str.rjust(2, config.leading_zero_char)
+    return temp_str
+
+
+# Creates an 8x8 image with the current temperature on it.
+def create_temperature_image(temperature : int):
+    temp_str = temperature_string(temperature)
 
     # If the string is too long to draw, then show a different icon.
     if len(temp_str) > 2:
-        img = Image.open('icons/cold.gif') if (temperature < 0) else Image.open('icons/hot.gif')
-        return img.convert('RGB')
+        return get_atlas().tile('cold' if temperature < 0 else 'hot').copy()
     
     # Draw the temperature on top of the base image.
-    img = Image.open('icons/degree_background.gif').convert('RGB')
-    img = draw_msg_on_image(img, temp_str, 0, 3)
-    img = apply_color_filter_to_image(img, temperature_to_color(temperature))
+    img = draw_msg_on_image(get_atlas().tile('degree_background'), temp_str, 0, 3)
+    img = apply_color_filter_to_image(img, temperature_to_color_lut(temperature))
     
     return img
 
 
+# A larger fixed width font for the 16x16 Unicorn HAT HD. Drawn natively at 5x9, rather than doubling the 3x5 font.
+HD_GLYPHS = {
+    '0': ('.###.', '#...#', '#...#', '#...#', '#...#', '#...#', '#...#', '#...#', '.###.'),
+    '1': ('..#..', '.##..', '#.#..', '..#..', '..#..', '..#..', '..#..', '..#..', '#####'),
+    '2': ('.###.', '#...#', '....#', '....#', '...#.', '..#..', '.#...', '#....', '#####'),
+    '3': ('.###.', '#...#', '....#', '....#', '..##.', '....#', '....#', '#...#', '.###.'),
+    '4': ('...#.', '..##.', '.#.#.', '#..#.', '#..#.', '#####', '...#.', '...#.', '...#.'),
+    '5': ('#####', '#....', '#....', '####.', '....#', '....#', '....#', '#...#', '.###.'),
+    '6': ('.###.', '#...#', '#....', '#....', '####.', '#...#', '#...#', '#...#', '.###.'),
+    '7': ('#####', '....#', '....#', '...#.', '...#.', '..#..', '..#..', '.#...', '.#...'),
+    '8': ('.###.', '#...#', '#...#', '#...#', '.###.', '#...#', '#...#', '#...#', '.###.'),
+    '9': ('.###.', '#...#', '#...#', '#...#', '.####', '....#', '....#', '#...#', '.###.'),
+    '-': ('.....', '.....', '.....', '.....', '#####', '.....', '.....', '.....', '.....'),
+    ' ': ('.....', '.....', '.....', '.....', '.....', '.....', '.....', '.....', '.....'),
+}
+HD_DEGREE = ('.##.', '#..#', '#..#', '.##.')
+HD_SIZE = 16
+
+_hd_tiles = {}
+
+# Returns the image for an HD glyph, building it from its bitmap the first time it's needed.
+def hd_tile(character : str):
+    tile = _hd_tiles.get(character)
+    if tile is None:
+        rows = HD_GLYPHS[character] if character in HD_GLYPHS else HD_DEGREE
+        tile = _hd_tiles[character] = Image.new('RGB', (len(rows[0]), len(rows)))
+        tile.putdata([(255, 255, 255) if pixel == '#' else (0, 0, 0) for row in rows for pixel in row])
+    return tile
+
+
+# Creates a 16x16 image with the current temperature on it, for the Unicorn HAT HD.
+def create_temperature_image_hd(temperature : int):
+    temp_str = temperature_string(temperature)
+
+    # If the string is too long to draw, then show a different icon. There's no HD version, so double the pixels.
+    if len(temp_str) > 2:
+        icon = get_atlas().tile('cold' if temperature < 0 else 'hot')
+        return icon.resize((HD_SIZE, HD_SIZE), Image.NEAREST)
+
+    img = Image.new('RGB', (HD_SIZE, HD_SIZE))
+    img.paste(hd_tile('degree'), (12, 0))
+    x = 0
+    for c in temp_str:
+        tile = hd_tile(c)
+        img.paste(tile, (x, 4))
+        x += tile.width + 1
+    return apply_color_filter_to_image(img, temperature_to_color_lut(temperature))
+
+
+# Renders a list of temperatures side by side into one strip of 8x8 cells.
+# All of the cells are tinted at once by multiplying the strip with a strip of their colours.
+def create_temperature_strip(temperatures):
+    temperatures = list(temperatures)
+    atlas = get_atlas()
+    background = atlas.tile('degree_background')
+    cell_w, cell_h = background.size
+    strip = Image.new('RGB', (cell_w * len(temperatures), cell_h))
+    tint = Image.new('RGB', strip.size, (255, 255, 255))
+
+    icons = []
+    for i, temperature in enumerate(temperatures):
+        x = i * cell_w
+        temp_str = temperature_string(temperature)
+        if len(temp_str) > 2:
+            icons.append((x, 'cold' if temperature < 0 else 'hot'))
+            continue
+        strip.paste(background, (x, 0))
+        blit_msg(strip, temp_str, x, 3)
+        tint.paste(temperature_to_color_lut(temperature)[:3], (x, 0, x + cell_w, cell_h))
+
+    strip = ImageChops.multiply(strip, tint)
+
+    # The hot and cold icons are drawn untinted.
+    for x, icon in icons:
+        strip.paste(atlas.tile(icon), (x, 0))
+    return strip
+
+
+# Renders every temperature in one pass. Returns a dict mapping each temperature to its 8x8 image.
+def create_temperature_images(temperatures = range(-99, 200)):
+    temperatures = list(temperatures)
+    strip = create_temperature_strip(temperatures)
+    cell_w = strip.width // max(len(temperatures), 1)
+    return {t: strip.crop((i * cell_w, 0, (i + 1) * cell_w, strip.height)) for i, t in enumerate(temperatures)}
+
+
 if __name__ == "__main__":
     # Run through a demonstration of how various colors render.
     create_temperature_image(-10).show()
@@ -81,4 +237,7 @@ if __name__ == "__main__":
     create_temperature_image(90).show()
     create_temperature_image(99).show()
     create_temperature_image(100).show()
+
+    # And the whole displayable range at once.
+    create_temperature_strip(range(-10, 101)).show()
  
\ No newline at end of file
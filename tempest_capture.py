@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Records Tempest UDP traffic to a capture file and replays it against a TempestUdpCollector, so load and
+bug scenarios can be reproduced without a physical hub.
+
+    ./tempest_capture.py record capture.twx --duration 3600
+    ./tempest_capture.py replay capture.twx --speed 100
+    ./tempest_capture.py replay capture.twx --speed 0      # As fast as possible.
+"""
+import argparse, asyncio, json, socket, struct, sys, time
+from collections import defaultdict, deque
+from typing import Dict, Deque, Iterator, List, Optional, Tuple
+from WeatherCollectors.TempestUdpCollector import TempestUdpCollector, UDP_PORT
+from WeatherCollectors.AggregateCollector import AggregateCollector
+
+CAPTURE_MAGIC = b'TWXCAP01'
+RECORD_HEADER = struct.Struct('<d4sHH') # Seconds since the capture started, source IPv4 address, source port, payload length.
+
+def write_record(f, offset : float, addr : Tuple[str, int], data : bytes):
+    """Appends one datagram to a capture file."""
+    f.write(RECORD_HEADER.pack(offset, socket.inet_aton(addr[0]), addr[1], len(data)))
+    f.write(data)
+
+
+def read_capture(path : str) -> Iterator[Tuple[float, Tuple[str, int], bytes]]:
+    """Yields (offset, addr, data) for every datagram in a capture file."""
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f'{path} is not a Tempest capture file.')
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            offset, ip, port, length = RECORD_HEADER.unpack(header)
+            yield offset, (socket.inet_ntoa(ip), port), f.read(length)
+
+
+class _RecorderProtocol(asyncio.DatagramProtocol):
+    def __init__(self, f):
+        self._f = f
+        self._start = time.monotonic()
+        self.count = 0
+
+    def datagram_received(self, data, addr):
+        write_record(self._f, time.monotonic() - self._start, addr, data)
+        self.count += 1
+
+
+async def record(path : str, duration : Optional[float], port : int = UDP_PORT):
+    """Writes every datagram received on the Tempest port to a capture file."""
+    with open(path, 'wb') as f:
+        f.write(CAPTURE_MAGIC)
+        transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _RecorderProtocol(f),
+            local_addr=('0.0.0.0', port))
+        try:
+            if duration is None:
+                await asyncio.Event().wait() # Until cancelled.
+            else:
+                await asyncio.sleep(duration)
+        finally:
+            transport.close()
+            print(f'Recorded {protocol.count} packets to {path}')
+
+
+class _InstrumentedCollector(TempestUdpCollector):
+    """A TempestUdpCollector that times how long each datagram takes to get from the replayer through every callback."""
+
+    def __init__(self, config : dict, port : int):
+        super().__init__(config, port=port, host='127.0.0.1')
+        self.sent_at : Dict[bytes, Deque[float]] = defaultdict(deque)
+        self.latencies : List[float] = []
+        self.received = 0
+        self.last_received = 0.0
+
+    def _handle_datagram(self, data : bytes, addr):
+        super()._handle_datagram(data, addr) # Delivery is synchronous, so every callback has run once this returns.
+        done = time.perf_counter()
+        self.received += 1
+        self.last_received = done
+        sent = self.sent_at.get(data)
+        if sent:
+            self.latencies.append(done - sent.popleft())
+
+
+def _percentile(values : List[float], pct : float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+async def replay(path : str, speed : float = 1.0, port : int = UDP_PORT, config : Optional[dict] = None, send_only : bool = False) -> dict:
+    """
+    Sends a capture to the loopback address at the given speed multiplier (0 for as fast as possible).
+    Unless send_only is set, a collector and aggregate collector are run in-process to measure throughput and latency.
+    """
+    packets = list(read_capture(path))
+    loop = asyncio.get_running_loop()
+
+    collector = None
+    aggregate_updates = 0
+    if not send_only:
+        collector = _InstrumentedCollector(config or {}, port)
+        aggregate = AggregateCollector([collector])
+        def on_update(status):
+            nonlocal aggregate_updates
+            aggregate_updates += 1
+        aggregate.register_callback(on_update)
+        listen_task = asyncio.create_task(aggregate.listen())
+        await asyncio.sleep(0.1) # Let the collector bind its socket.
+
+    transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=('127.0.0.1', port))
+    start = time.perf_counter()
+    try:
+        for offset, _, data in packets:
+            if speed > 0:
+                delay = start + offset / speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if collector is not None:
+                collector.sent_at[data].append(time.perf_counter())
+            transport.sendto(data)
+            await asyncio.sleep(0) # Give the receiver a chance to run.
+        await asyncio.sleep(0.5) # Let packets still in flight arrive.
+    finally:
+        transport.close()
+        elapsed = time.perf_counter() - start
+        if collector is not None:
+            listen_task.cancel()
+            try:
+                await listen_task
+            except asyncio.CancelledError:
+                pass
+
+    report = {'sent': len(packets), 'elapsed_s': elapsed}
+    if collector is not None:
+        processing_time = collector.last_received - start # Excludes the time spent waiting for stragglers.
+        report.update({
+            'received': collector.received,
+            'dropped': len(packets) - collector.received,
+            'aggregate_updates': aggregate_updates,
+            'packets_per_s': collector.received / processing_time if processing_time > 0 else 0.0,
+            'latency_p50_ms': _percentile(collector.latencies, 0.50) * 1000,
+            'latency_p95_ms': _percentile(collector.latencies, 0.95) * 1000,
+            'latency_max_ms': max(collector.latencies, default=0.0) * 1000,
+            'accepted_by_type': dict(collector.accepted_packets),
+            'dropped_by_type': dict(collector.dropped_packets),
+        })
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Record and replay Tempest UDP traffic.')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    rec = sub.add_parser('record', help='Record datagrams from the LAN to a capture file.')
+    rec.add_argument('path')
+    rec.add_argument('--duration', type=float, default=None, help='Seconds to record for. Records until interrupted if not given.')
+    rec.add_argument('--port', type=int, default=UDP_PORT)
+
+    rep = sub.add_parser('replay', help='Replay a capture file to the loopback address.')
+    rep.add_argument('path')
+    rep.add_argument('--speed', type=float, default=1.0, help='Playback speed multiplier. 0 sends as fast as possible.')
+    rep.add_argument('--port', type=int, default=UDP_PORT)
+    rep.add_argument('--send-only', action='store_true', help="Only send the packets. Use this when UnicornHatWeather.py is already listening.")
+
+    args = parser.parse_args(argv)
+    try:
+        if args.command == 'record':
+            asyncio.run(record(args.path, args.duration, args.port))
+        else:
+            print(json.dumps(asyncio.run(replay(args.path, args.speed, args.port, send_only=args.send_only)), indent=2))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,43 @@
+import os, time
+from datetime import datetime, timezone
+from WeatherCollectors.ObservationLog import ObservationLog, RECORD_TRAILER
+from WeatherCollectors.WeatherCollector import WeatherStatus, Datapoint
+
+def status(timestamp, temp_c):
+    return WeatherStatus(station_id='ST-00000001', host_timestamp=datetime.fromtimestamp(timestamp, timezone.utc), temp_c=Datapoint(temp_c, 1.0))
+
+def utc(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc)
+
+def test_latest_skips_a_record_torn_mid_payload(tmp_path):
+    log = ObservationLog(str(tmp_path))
+    base = time.time() - 60
+    log._write([('tempest', base + i, status(base + i, 10.0 + i)) for i in range(3)])
+    log._close_segment()
+
+    # Cut the last record off part way through its payload, as a crash mid-append would.
+    (path,) = log._segments()
+    os.truncate(path, os.path.getsize(path) - RECORD_TRAILER.size - 5)
+
+    latest = log.latest()
+    assert latest[('tempest', 'ST-00000001')].temp_c.value == 11.0
+
+def test_read_skips_segments_outside_the_range(tmp_path):
+    log = ObservationLog(str(tmp_path), segment_duration=50.0)
+    base = time.time() - 3600
+    for i in range(4):
+        log._write([('tempest', base + i * 100, status(base + i * 100, 10.0 + i))]) # One segment each.
+    log._close_segment()
+    segments = log._segments()
+    assert len(segments) == 4
+
+    opened = []
+    read_forwards = log._read_forwards
+    def spy(path, since):
+        opened.append(path)
+        return read_forwards(path, since)
+    log._read_forwards = spy
+
+    records = list(log.read(utc(base + 150), utc(base + 250)))
+    assert [s.temp_c.value for _, s in records] == [12.0]
+    assert opened == segments[1:3] # The first ends before the range and the last starts after it.
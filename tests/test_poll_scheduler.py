@@ -0,0 +1,86 @@
+import asyncio, random
+from datetime import datetime, timezone
+from WeatherCollectors.PollScheduler import PollScheduler, RequestBudget, VirtualClock
+from WeatherCollectors.WeatherCollector import WeatherStatus, Datapoint
+
+START = 1_700_000_000.0
+
+def run_polls(clock, scheduler, hours, status_at):
+    """Polls on the virtual clock for a number of hours. Returns the seconds since START that each poll was made at."""
+    polls = []
+
+    async def poll():
+        while True:
+            await scheduler.wait()
+            elapsed = clock.time() - START
+            polls.append(elapsed)
+            status = status_at(elapsed)
+            if status is None:
+                scheduler.failed()
+            else:
+                scheduler.succeeded(status)
+
+    async def main():
+        task = asyncio.create_task(poll())
+        await clock.advance(hours * 3600)
+        task.cancel()
+
+    asyncio.run(main())
+    return polls
+
+def gaps(polls):
+    return [b - a for a, b in zip(polls, polls[1:])]
+
+def test_backoff_grows_and_is_capped_with_jitter():
+    clock = VirtualClock(START)
+    scheduler = PollScheduler('test', 300.0, min_backoff=5.0, max_backoff=60.0, clock=clock, rng=random.Random(1))
+    polls = run_polls(clock, scheduler, 0.25, lambda elapsed: None)
+
+    for failures, gap in enumerate(gaps(polls)[:8], 1):
+        backoff = min(60.0, 5.0 * 2 ** (failures - 1))
+        assert backoff / 2 <= gap <= backoff
+    capped = gaps(polls)[4:]
+    assert capped and all(30.0 <= gap <= 60.0 for gap in capped)
+    assert len(set(capped)) > 1 # Jittered, so a fleet of displays doesn't retry in lockstep.
+
+def test_budget_holds_polls_back_once_the_window_is_used_up():
+    clock = VirtualClock(START)
+    budget = RequestBudget(3, 600.0, clock)
+    scheduler = PollScheduler('test', 60.0, min_interval=60.0, max_interval=60.0, jitter=0.0, budget=budget, clock=clock)
+    polls = run_polls(clock, scheduler, 0.5, lambda elapsed: WeatherStatus(temp_c=Datapoint(20.0, 1.0)))
+
+    assert polls[:3] == [0.0, 60.0, 120.0]
+    assert polls[3] == 600.0 # The fourth request waits for the first to leave the window.
+    for i in range(len(polls)):
+        assert sum(1 for t in polls if polls[i] - 600.0 < t <= polls[i]) <= 3
+
+def test_polls_faster_while_the_weather_is_changing():
+    clock = VirtualClock(START)
+    scheduler = PollScheduler('test', 300.0, min_interval=75.0, max_interval=600.0, jitter=0.0, clock=clock)
+
+    def status_at(elapsed):
+        temp = 20.0 if elapsed < 3600 else 20.0 + (elapsed - 3600) / 60 # Steady for an hour, then warming a degree a minute.
+        return WeatherStatus(temp_c=Datapoint(temp, 1.0))
+
+    polls = run_polls(clock, scheduler, 2, status_at)
+    steady = gaps([t for t in polls if t < 3600])
+    changing = gaps([t for t in polls if t >= 3600])
+
+    assert steady == sorted(steady) and steady[-1] == 600.0 # Slows down to max_interval while nothing changes.
+    assert changing[-1] == 75.0 # Speeds up to min_interval once it does.
+    assert max(changing[-5:]) < min(steady)
+
+def test_polls_are_aligned_to_upstream_updates():
+    period, publish_lag = 600.0, 90.0
+    clock = VirtualClock(START)
+    scheduler = PollScheduler('test', 240.0, max_interval=1200.0, clock=clock, rng=random.Random(1))
+
+    def status_at(elapsed):
+        published = START + ((elapsed - publish_lag) // period) * period # Each update can be fetched publish_lag after its timestamp.
+        return WeatherStatus(source_timestamp=datetime.fromtimestamp(published, timezone.utc), temp_c=Datapoint(20.0, 1.0))
+
+    polls = run_polls(clock, scheduler, 12, status_at)
+
+    assert scheduler.upstream_period == period
+    late = [t for t in polls if t > 4 * 3600]
+    assert late and all(publish_lag - 15 <= t % period <= publish_lag + 45 for t in late) # Just after each update is published.
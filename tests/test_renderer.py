@@ -0,0 +1,58 @@
+import asyncio
+from renderer import FakeBackend, RendererSession
+
+SWITCH_DELAY = 0.05
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_switch_latency_is_the_time_the_backend_takes():
+    async def switch():
+        backend = FakeBackend(switch_delay=SWITCH_DELAY)
+        session = RendererSession(backend)
+        await session.start()
+        try:
+            assert await session.show('a.gif')
+            assert await session.show('b.gif')
+        finally:
+            await session.close()
+        return backend, session
+
+    backend, session = run(switch())
+    assert [filename for _, filename in backend.switches] == ['a.gif', 'b.gif']
+    assert len(session.switch_latencies) == 2
+    assert all(SWITCH_DELAY <= latency < SWITCH_DELAY * 4 for latency in session.switch_latencies)
+
+def test_showing_the_same_frame_again_skips_the_switch():
+    async def switch():
+        backend = FakeBackend(switch_delay=SWITCH_DELAY)
+        session = RendererSession(backend)
+        await session.start()
+        try:
+            await session.show('a.gif')
+            await session.show('a.gif')
+        finally:
+            await session.close()
+        return backend, session
+
+    backend, session = run(switch())
+    assert len(backend.switches) == 1
+    assert session.skipped_switches == 1
+    assert session.switch_latencies[-1] < SWITCH_DELAY # Nothing had to be restarted.
+
+def test_only_the_newest_queued_frame_is_shown():
+    async def switch():
+        backend = FakeBackend(switch_delay=SWITCH_DELAY)
+        session = RendererSession(backend)
+        await session.start()
+        try:
+            first = session.show('a.gif')
+            await asyncio.sleep(0) # Let the session pick up the first request.
+            stale, newest = session.show('b.gif'), session.show('c.gif')
+            return backend, await first, await stale, await newest
+        finally:
+            await session.close()
+
+    backend, first, stale, newest = run(switch())
+    assert (first, stale, newest) == (True, False, True)
+    assert [filename for _, filename in backend.switches] == ['a.gif', 'c.gif']
@@ -0,0 +1,38 @@
+import json
+from WeatherCollectors.TempestUdpCollector import TempestUdpCollector
+
+HUB_SN = 'HB-00000001'
+HUB_ADDR = ('192.168.1.20', 50222)
+
+def obs_st(serial_number, epoch, temp_c):
+    obs = [epoch, 0.1, 0.5, 1.0, 180, 3, 1000.0, temp_c, 50, 20000, 2, 150, 0.0, 0, 0, 0, 2.6, 1]
+    return json.dumps({'serial_number': serial_number, 'type': 'obs_st', 'hub_sn': HUB_SN, 'obs': [obs]}).encode('utf-8')
+
+def obs_air(serial_number, epoch, temp_c):
+    obs = [epoch, 1000.0, temp_c, 50, 0, 0, 3.4, 1]
+    return json.dumps({'serial_number': serial_number, 'type': 'obs_air', 'hub_sn': HUB_SN, 'obs': [obs]}).encode('utf-8')
+
+def test_stations_behind_one_hub_keep_their_own_readings():
+    collector = TempestUdpCollector({})
+    delivered = []
+    collector.register_callback(lambda status: delivered.append((status.station_id, status.temp_c.value)))
+
+    collector._handle_datagram(obs_st('ST-00000001', 1700000000, 10.0), HUB_ADDR)
+    collector._handle_datagram(obs_st('ST-00000002', 1700000001, 20.0), HUB_ADDR)
+    collector._handle_datagram(obs_st('ST-00000001', 1700000060, 11.0), HUB_ADDR)
+
+    assert delivered == [('ST-00000001', 10.0), ('ST-00000002', 20.0), ('ST-00000001', 11.0)]
+    assert set(collector._stations) == {'ST-00000001', 'ST-00000002'}
+
+def test_obs_st_freshness_is_tracked_per_device():
+    collector = TempestUdpCollector({})
+    delivered = []
+    collector.register_callback(lambda status: delivered.append(status.station_id))
+
+    collector._handle_datagram(obs_st('ST-00000001', 1700000000, 10.0), HUB_ADDR)
+    collector._handle_datagram(obs_air('ST-00000001', 1700000001, 12.0), HUB_ADDR) # Ignored. The Tempest's obs_st is fresh.
+    collector._handle_datagram(obs_air('AR-00000001', 1700000002, 15.0), HUB_ADDR) # Another device on the same hub.
+
+    assert delivered == ['ST-00000001', 'AR-00000001']
+    assert collector._stations['ST-00000001'].status.temp_c.value == 10.0
+    assert collector._stations['AR-00000001'].status.temp_c.value == 15.0